@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Microbenchmark for the lists of applied, unapplied and hidden patches
+kept by a stack transaction.
+
+Runs the list operations that pushing, popping, going to, floating and
+sinking patches do on stacks of increasing size, both with L{PatchList}
+and with the plain lists it replaced, and prints the time per patch.
+It should stay flat for PatchList.
+
+Usage: python perf/patchlist.py [max-patches] [max-naive-patches]
+"""
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals,
+)
+
+import datetime
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from stgit.lib.patchlist import PatchList  # noqa: E402 isort:skip
+
+
+def duration(t1, t2):
+    d = t2 - t1
+    return 86400 * d.days + d.seconds + 1e-6 * d.microseconds
+
+
+def push(make, names, order):
+    """Push all the patches, in the given order."""
+    applied = make([])
+    unapplied = make(names)
+    for pn in order:
+        if isinstance(unapplied, PatchList):
+            unapplied.remove(pn)
+        else:
+            del unapplied[unapplied.index(pn)]
+        applied.append(pn)
+    return applied
+
+
+def goto(applied, order):
+    """Find where each patch is, as goto and refresh do."""
+    for pn in order:
+        applied[applied.index(pn) + 1:applied.index(pn) + 2]
+
+
+def filter_out(applied, order):
+    """Take half of the patches out, as float and sink do."""
+    patches = applied.__class__(order[::2])
+    return [pn for pn in applied if pn not in patches]
+
+
+def bench(make, n):
+    names = ['patch-%d' % i for i in range(n)]
+    order = list(names)
+    random.Random(n).shuffle(order)
+    times = []
+    start = datetime.datetime.now()
+    applied = push(make, names, order)
+    times.append(duration(start, datetime.datetime.now()))
+    start = datetime.datetime.now()
+    goto(applied, order)
+    times.append(duration(start, datetime.datetime.now()))
+    start = datetime.datetime.now()
+    filter_out(applied, order)
+    times.append(duration(start, datetime.datetime.now()))
+    return times
+
+
+def main(args):
+    max_n = int(args[0]) if args else 50000
+    max_naive_n = int(args[1]) if len(args) > 1 else 10000
+    print('%8s  %-9s %12s %12s %12s'
+          % ('patches', '', 'push', 'goto', 'filter'))
+    for n in [1000, 10000, 50000]:
+        if n > max_n:
+            break
+        for label, make in [('PatchList', PatchList), ('list', list)]:
+            if make is list and n > max_naive_n:
+                continue
+            times = bench(make, n)
+            print('%8d  %-9s' % (n, label) + ''.join(
+                ' %9.3f us' % (1e6 * t / n) for t in times
+            ))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
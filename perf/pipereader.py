@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""Microbenchmark for the pipe reader used with the long-running git
+helper processes.
+
+Feeds cat-file style replies ("<header>\\n<content>\\n") of increasing
+size through a pipe and times how long it takes to read them back,
+both with L{PipeReader} and with the naive bytes concatenation it
+replaced. The time per megabyte should stay flat for PipeReader.
+
+Usage: python perf/pipereader.py [max-size-in-MB] [max-naive-size-in-MB]
+"""
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals,
+)
+
+import datetime
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from stgit.lib.git.repository import PipeReader  # noqa: E402 isort:skip
+
+
+def duration(t1, t2):
+    d = t2 - t1
+    return 86400 * d.days + d.seconds + 1e-6 * d.microseconds
+
+
+def writer(fd, size):
+    header = ('%s blob %d\n' % ('0' * 40, size)).encode('utf-8')
+    os.write(fd, header)
+    block = b'x' * min(size, 1 << 20)
+    left = size
+    while left:
+        n = os.write(fd, block[:left])
+        left -= n
+    os.write(fd, b'\n')
+    os.close(fd)
+
+
+def read_pipereader(fd):
+    reader = PipeReader(fd)
+    header = reader.read_line().split()
+    content = reader.read(int(header[2]))
+    reader.read(1)
+    return content
+
+
+def read_naive(fd):
+    s = b''
+    while b'\n' not in s:
+        s += os.read(fd, 4096)
+    h, b = s.split(b'\n', 1)
+    size = int(h.split()[2])
+    while len(b) < size + 1:
+        b += os.read(fd, 4096)
+    return b[:size]
+
+
+def bench(read, size):
+    r, w = os.pipe()
+    t = threading.Thread(target=writer, args=(w, size))
+    start = datetime.datetime.now()
+    t.start()
+    content = read(r)
+    stop = datetime.datetime.now()
+    t.join()
+    os.close(r)
+    assert len(content) == size
+    return duration(start, stop)
+
+
+def main(args):
+    max_mb = int(args[0]) if args else 500
+    max_naive_mb = int(args[1]) if len(args) > 1 else 16
+    sizes = [1 << 10, 16 << 10, 256 << 10, 1 << 20, 4 << 20, 16 << 20,
+             64 << 20, 256 << 20, 500 << 20]
+    print('%12s  %12s %10s  %12s %10s'
+          % ('size', 'PipeReader', 's/MB', 'naive', 's/MB'))
+    for size in sizes:
+        if size > max_mb << 20:
+            break
+        mb = size / float(1 << 20)
+        t = bench(read_pipereader, size)
+        line = '%12d  %12.4f %10.4f' % (size, t, t / mb)
+        if size <= max_naive_mb << 20:
+            t = bench(read_naive, size)
+            line += '  %12.4f %10.4f' % (t, t / mb)
+        print(line)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
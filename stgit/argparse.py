@@ -364,6 +364,21 @@ def keep_option():
     ]
 
 
+def check_option():
+    return [
+        opt(
+            '--check',
+            action='store_true',
+            short='Only report the patches that would conflict',
+            long="""
+            Report the patches that would conflict when pushed, without
+            pushing anything. The patches are checked in parallel, which
+            is much faster than pushing them for long series, but the
+            result is only a prediction.""",
+        )
+    ]
+
+
 def merged_option():
     return [
         opt(
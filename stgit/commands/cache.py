@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals,
+)
+
+from stgit.argparse import opt
+from stgit.commands.common import CmdException, DirectoryHasRepository
+from stgit.out import out
+
+__copyright__ = """
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 2 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see http://www.gnu.org/licenses/.
+"""
+
+help = 'Manage the persistent commit cache'
+kind = 'repo'
+usage = ['[--stats]', '--clear']
+description = """
+StGit remembers the commits it has read in a cache in the
+stgit-cache directory of the git repository, so that later commands
+don't have to ask git for them again. The cache holds at most
+stgit.commitcachesize commits (0 disables it); the least recently used
+ones are dropped when there are more.
+
+Without options, or with --stats, print how many commits are in the
+cache, how big it is, and how often it has been used."""
+
+args = []
+options = [
+    opt(
+        '-s',
+        '--stats',
+        action='store_true',
+        short='Print cache statistics',
+    ),
+    opt(
+        '-c',
+        '--clear',
+        action='store_true',
+        short='Remove all commits from the cache',
+    ),
+]
+
+directory = DirectoryHasRepository()
+
+
+def func(parser, options, args):
+    if args:
+        parser.error('incorrect number of arguments')
+    if options.stats and options.clear:
+        parser.error('cannot use --stats and --clear together')
+
+    cache = directory.repository.commit_cache
+    if cache is None:
+        raise CmdException('The commit cache is disabled')
+    if options.clear:
+        cache.clear()
+        out.info('Commit cache cleared')
+        return
+    stats = cache.stats()
+    out.stdout('Entries: %d' % stats['entries'])
+    out.stdout('Size:    %d bytes' % stats['size'])
+    out.stdout('Hits:    %d' % stats['hits'])
+    out.stdout('Misses:  %d' % stats['misses'])
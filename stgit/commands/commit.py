@@ -111,11 +111,15 @@ def func(parser, options, args):
                 common_prefix += 1
             else:
                 break
+        committed = set(patches)
         if common_prefix < len(patches):
-            to_push = [pn for pn in stack.patchorder.applied[common_prefix:]
-                       if pn not in patches[common_prefix:]]
+            to_push = [
+                pn for pn in stack.patchorder.applied[common_prefix:]
+                if pn not in committed
+            ]
+            popped = set(to_push)
             # this pops all the applied patches from common_prefix
-            trans.pop_patches(lambda pn: pn in to_push)
+            trans.pop_patches(lambda pn: pn in popped)
             for pn in patches[common_prefix:]:
                 trans.push_patch(pn, iw)
         else:
@@ -123,7 +127,7 @@ def func(parser, options, args):
         new_base = trans.patches[patches[-1]]
         for pn in patches:
             trans.patches[pn] = None
-        trans.applied = [pn for pn in trans.applied if pn not in patches]
+        trans.applied = [pn for pn in trans.applied if pn not in committed]
         trans.base = new_base
         out.info('Committed %d patch%s' % (len(patches),
                                            ['es', ''][len(patches) == 1]))
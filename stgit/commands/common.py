@@ -17,7 +17,8 @@ from stgit.compat import decode_utf8_with_latin1
 from stgit.config import config
 from stgit.exception import StgException
 from stgit.lib.git import CommitData, MergeException, RepositoryException
-from stgit.lib.stack import StackRepository
+from stgit.lib.patchlist import PatchList
+from stgit.lib.stack import StackRepository, snapshot_ref
 from stgit.lib.transaction import (
     StackTransaction,
     TransactionException,
@@ -26,6 +27,8 @@ from stgit.lib.transaction import (
 from stgit.out import out
 from stgit.run import Run, RunException
 from stgit.utils import (
+    STGIT_CONFLICT,
+    STGIT_SUCCESS,
     EditorException,
     add_trailer,
     edit_bytes,
@@ -101,7 +104,15 @@ def git_commit(name, repository, branch_name=None):
                                     strip_prefix('{public}', patch),
                                     discard_stderr=True)
 
-    # Other combination of branch and patch
+    # Other combination of branch and patch. Patches in a stack
+    # snapshot have no refs for git to find.
+    if repository.refs.exists(snapshot_ref(branch)):
+        name_part, suffix = re.match(r'([^~^]*)(.*)$', patch).groups()
+        stack = repository.get_stack(branch)
+        if stack.patches.exists(name_part):
+            return repository.rev_parse(
+                stack.patches.get(name_part).commit.sha1 + suffix
+            )
     try:
         return repository.rev_parse('patches/%s/%s' % (branch, patch),
                                     discard_stderr=True)
@@ -178,9 +189,8 @@ def parse_patches(patch_args, patch_list, boundary=0, ordered=False):
     a list. The names can be individual patches and/or in the
     patch1..patch2 format.
     """
-    # in case it receives a tuple
-    patch_list = list(patch_list)
-    patches = []
+    patch_list = PatchList(patch_list)
+    patches = PatchList()
 
     for name in patch_args:
         pair = name.split('..')
@@ -230,12 +240,12 @@ def parse_patches(patch_args, patch_list, boundary=0, ordered=False):
             if p in patches:
                 raise CmdException('Duplicate patch name: %s' % p)
 
-        patches += pl
+        patches.extend(pl)
 
     if ordered:
-        patches = [p for p in patch_list if p in patches]
-
-    return patches
+        return [p for p in patch_list if p in patches]
+    else:
+        return list(patches)
 
 
 def name_email(address):
@@ -336,6 +346,19 @@ def rebase(stack, iw, target_commit=None):
     out.done()
 
 
+def report_conflicts(trans, patches, tree=None):
+    """Print the patches that would conflict if they were pushed on top of
+    C{tree}, for the --check option of commands that push patches. The
+    transaction is aborted; nothing is pushed."""
+    try:
+        conflicts = trans.check_conflicts(patches, tree)
+    finally:
+        trans.abort()
+    for pn in conflicts:
+        out.info('%s would conflict' % pn)
+    return STGIT_CONFLICT if conflicts else STGIT_SUCCESS
+
+
 def post_rebase(stack, applied, cmd_name, check_merged):
     iw = stack.repository.default_iw
     trans = StackTransaction(stack, '%s (reapply)' % cmd_name)
@@ -344,10 +367,9 @@ def post_rebase(stack, applied, cmd_name, check_merged):
             merged = set(trans.check_merged(applied))
         else:
             merged = set()
-        for pn in applied:
-            trans.push_patch(
-                pn, iw, allow_interactive=True, already_merged=pn in merged
-            )
+        trans.push_patches(
+            applied, iw, allow_interactive=True, merged=merged
+        )
     except TransactionHalted:
         pass
     return trans.run(iw)
@@ -198,7 +198,8 @@ def func(parser, options, args):
     trans = transaction.StackTransaction(stack, 'edit', allow_conflicts=True)
     if patchname in trans.applied:
         popped = trans.applied[trans.applied.index(patchname) + 1:]
-        popped_extra = trans.pop_patches(lambda pn: pn in popped)
+        to_pop = set(popped)
+        popped_extra = trans.pop_patches(lambda pn: pn in to_pop)
         assert not popped_extra
     else:
         popped = []
@@ -86,10 +86,11 @@ def func(parser, options, args):
     if not patches:
         raise CmdException('No patches to float')
 
+    floated = set(patches)
     applied = [
-        p for p in stack.patchorder.applied if p not in patches
+        p for p in stack.patchorder.applied if p not in floated
     ] + patches
-    unapplied = [p for p in stack.patchorder.unapplied if p not in patches]
+    unapplied = [p for p in stack.patchorder.unapplied if p not in floated]
 
     iw = stack.repository.default_iw
     clean_iw = (not options.keep and iw) or None
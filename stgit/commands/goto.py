@@ -11,6 +11,7 @@ from stgit.commands.common import (
     CmdException,
     DirectoryHasRepository,
     get_patch_from_list,
+    report_conflicts,
 )
 from stgit.lib import transaction
 
@@ -38,7 +39,11 @@ Push/pop patches to/from the stack until the one given on the command
 line becomes current."""
 
 args = ['other_applied_patches', 'unapplied_patches']
-options = argparse.keep_option() + argparse.merged_option()
+options = (
+    argparse.keep_option()
+    + argparse.merged_option()
+    + argparse.check_option()
+)
 
 directory = DirectoryHasRepository()
 
@@ -62,20 +67,24 @@ def func(parser, options, args):
         patch = candidate
 
     if patch in trans.applied:
+        if options.check:
+            # Going to an applied patch only pops patches.
+            return report_conflicts(trans, [])
         to_pop = set(trans.applied[trans.applied.index(patch) + 1:])
         popped_extra = trans.pop_patches(lambda pn: pn in to_pop)
         assert not popped_extra
     elif patch in trans.unapplied:
         try:
             to_push = trans.unapplied[:trans.unapplied.index(patch) + 1]
+            if options.check:
+                return report_conflicts(trans, to_push)
             if options.merged:
                 merged = set(trans.check_merged(to_push))
             else:
                 merged = set()
-            for pn in to_push:
-                trans.push_patch(
-                    pn, iw, allow_interactive=True, already_merged=pn in merged
-                )
+            trans.push_patches(
+                to_push, iw, allow_interactive=True, merged=merged
+            )
         except transaction.TransactionHalted:
             pass
     else:
@@ -59,10 +59,11 @@ def func(parser, options, args):
     for p in patches:
         if p in trans.hidden:
             out.warn('Patch "%s" already hidden' % p)
-    patches = [p for p in patches if p not in set(trans.hidden)]
+    patches = [p for p in patches if p not in trans.hidden]
+    to_hide = set(patches)
 
-    applied = [p for p in trans.applied if p not in set(patches)]
-    unapplied = [p for p in trans.unapplied if p not in set(patches)]
+    applied = [p for p in trans.applied if p not in to_hide]
+    unapplied = [p for p in trans.unapplied if p not in to_hide]
     hidden = patches + trans.hidden
 
     trans.reorder_patches(applied, unapplied, hidden)
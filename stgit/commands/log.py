@@ -10,6 +10,7 @@ import os
 
 from stgit.argparse import opt, patch_range
 from stgit.commands.common import DirectoryHasRepository, parse_patches
+from stgit.config import config
 from stgit.lib import log
 from stgit.out import out
 from stgit.run import Run
@@ -44,7 +45,14 @@ stack. "stg reset" lets you go directly to any state.
 
 Given the --clear option, the log history will be deleted.
 This may be useful if the tree view has become too cluttered
-to be useful."""
+to be useful.
+
+Given the --compact option, only the most recent part of the log
+history is kept: the last stgit.logkeep entries (or --number
+entries), plus all the entries written in the last stgit.logkeepdays
+days. The rest is forgotten, so that "git gc" can get rid of the
+patch versions that only they referred to. Undo and redo keep
+working within the entries that are kept."""
 
 args = [patch_range('applied_patches', 'unapplied_patches', 'hidden_patches')]
 options = [
@@ -83,6 +91,11 @@ options = [
         action='store_true',
         short='Clear the log history',
     ),
+    opt(
+        '--compact',
+        action='store_true',
+        short='Drop all but the most recent log history',
+    ),
 ]
 
 directory = DirectoryHasRepository()
@@ -113,6 +126,18 @@ def func(parser, options, args):
         elif args:
             parser.error('cannot combine --clear with patch arguments')
 
+    if options.compact:
+        if (
+            options.clear
+            or options.diff
+            or options.full
+            or options.graphical
+        ):
+            parser.error('cannot combine --compact with other options '
+                         'than --number')
+        elif args:
+            parser.error('cannot combine --compact with patch arguments')
+
     if options.graphical:
         for o in ['diff', 'number', 'full']:
             if getattr(options, o):
@@ -131,6 +156,24 @@ def func(parser, options, args):
         log.delete_log(stack.repository, stack.name)
         return
 
+    if options.compact:
+        if options.number is not None:
+            keep = options.number
+        else:
+            keep = config.getint('stgit.logkeep')
+        kept = log.compact_log(
+            stack.repository,
+            stack.name,
+            keep,
+            config.getint('stgit.logkeepdays'),
+            'log --compact',
+        )
+        if kept is None:
+            out.info('Nothing to compact')
+        else:
+            out.info('Kept the last %d log entries' % kept)
+        return
+
     stacklog = log.get_log_entry(stack.repository, logref, logcommit)
     pathlim = [os.path.join('patches', pn) for pn in patches]
 
@@ -106,9 +106,10 @@ def func(parser, options, args):
             parser.error('Can only spill topmost applied patches')
         iw = None  # don't touch index+worktree
 
+    to_pop = set(patches)
     try:
         trans.reorder_patches(
-            applied=[p for p in trans.applied if p not in patches],
+            applied=[p for p in trans.applied if p not in to_pop],
             unapplied=patches + trans.unapplied,
             iw=iw,
             allow_interactive=True,
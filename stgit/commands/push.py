@@ -6,11 +6,18 @@ from __future__ import (
     unicode_literals,
 )
 
-from stgit.argparse import keep_option, merged_option, opt, patch_range
+from stgit.argparse import (
+    check_option,
+    keep_option,
+    merged_option,
+    opt,
+    patch_range,
+)
 from stgit.commands.common import (
     CmdException,
     DirectoryHasRepository,
     parse_patches,
+    report_conflicts,
 )
 from stgit.lib import transaction
 
@@ -63,6 +70,16 @@ options = [
 
         With a negative number, push all but that many patches.''',
     ),
+    opt(
+        '--resume',
+        action='store_true',
+        short='Resume an interrupted push',
+        long='''
+        Push the patches that an interrupted push, goto or rebase of
+        many patches didn't get to, without pushing again the patches
+        it had already pushed. This also continues after resolving a
+        conflict that halted a push.''',
+    ),
     opt(
         '--reverse',
         action='store_true',
@@ -83,7 +100,7 @@ options = [
         avoid conflicts and only the remaining changes will be in the
         patch.""",
     )
-] + keep_option() + merged_option()
+] + keep_option() + merged_option() + check_option()
 
 directory = DirectoryHasRepository()
 
@@ -100,6 +117,15 @@ def func(parser, options, args):
         # explicitly allow this without any warning/error message
         return
 
+    if options.resume:
+        if args or options.all or options.number is not None:
+            parser.error('cannot combine --resume with patches to push')
+        try:
+            trans.resume_patches(iw, allow_interactive=True)
+        except transaction.TransactionHalted:
+            pass
+        return trans.run(iw)
+
     if not trans.unapplied:
         raise CmdException('No patches to push')
 
@@ -130,6 +156,9 @@ def func(parser, options, args):
     if options.reverse:
         patches.reverse()
 
+    if options.check:
+        return report_conflicts(trans, patches)
+
     if options.set_tree:
         for pn in patches:
             trans.push_tree(pn)
@@ -139,9 +168,8 @@ def func(parser, options, args):
                 merged = set(trans.check_merged(patches))
             else:
                 merged = set()
-            for pn in patches:
-                trans.push_patch(pn, iw, allow_interactive=True,
-                                 already_merged=pn in merged)
+            trans.push_patches(patches, iw, allow_interactive=True,
+                               merged=merged)
         except transaction.TransactionHalted:
             pass
     return trans.run(iw)
@@ -6,7 +6,7 @@ from __future__ import (
     unicode_literals,
 )
 
-from stgit.argparse import opt
+from stgit.argparse import check_option, opt
 from stgit.commands.common import (
     CmdException,
     DirectoryGotoTopLevel,
@@ -14,7 +14,9 @@ from stgit.commands.common import (
     post_rebase,
     prepare_rebase,
     rebase,
+    report_conflicts,
 )
+from stgit.lib.transaction import StackTransaction, TransactionHalted
 
 __copyright__ = """
 Copyright (C) 2005, Catalin Marinas <catalin.marinas@gmail.com>
@@ -34,7 +36,7 @@ along with this program; if not, see http://www.gnu.org/licenses/.
 
 help = 'Move the stack base to another point in history'
 kind = 'stack'
-usage = ['[options] [--] <new-base-id>']
+usage = ['[options] [--] <new-base-id>', '--continue']
 description = """
 Pop all patches from current stack, move the stack base to the given
 <new-base-id> and push the patches back.
@@ -44,7 +46,11 @@ the rebase by executing the following sequence:
 
         $ git add --update
         $ stg refresh
-        $ stg goto top-patch
+        $ stg rebase --continue
+
+The same 'stg rebase --continue' picks up a rebase of many patches
+that was interrupted, without pushing again the patches it had
+already pushed.
 
 Or if you want to skip that patch:
 
@@ -65,7 +71,13 @@ options = [
         action='store_true',
         short='Check for patches merged upstream',
     ),
-]
+    opt(
+        '--continue',
+        dest='resume',
+        action='store_true',
+        short='Push the rest of the patches of a halted rebase',
+    ),
+] + check_option()
 
 directory = DirectoryGotoTopLevel()
 
@@ -73,13 +85,23 @@ directory = DirectoryGotoTopLevel()
 def func(parser, options, args):
     """Rebase the current stack
     """
-    if len(args) != 1:
-        parser.error('incorrect number of arguments')
-
     repository = directory.repository
     stack = repository.get_stack()
     iw = repository.default_iw
 
+    if options.resume:
+        if args:
+            parser.error('--continue takes no arguments')
+        trans = StackTransaction(stack, 'rebase (reapply)')
+        try:
+            trans.resume_patches(iw, allow_interactive=True)
+        except TransactionHalted:
+            pass
+        return trans.run(iw)
+
+    if len(args) != 1:
+        parser.error('incorrect number of arguments')
+
     if stack.protected:
         raise CmdException('This branch is protected. Rebase is not permitted')
 
@@ -87,6 +109,10 @@ def func(parser, options, args):
 
     applied = stack.patchorder.applied
 
+    if options.check:
+        trans = StackTransaction(stack, 'rebase (check)')
+        return report_conflicts(trans, applied, target.data.tree)
+
     retval = prepare_rebase(stack, 'rebase')
     if retval:
         return retval
@@ -225,7 +225,8 @@ def absorb_applied(trans, iw, patch_name, temp_name, edit_fun):
         # Pop any patch on top of the patch we're refreshing.
         to_pop = trans.applied[trans.applied.index(patch_name) + 1:]
         if len(to_pop) > 1:
-            popped_extra = trans.pop_patches(lambda pn: pn in to_pop)
+            popped = set(to_pop)
+            popped_extra = trans.pop_patches(lambda pn: pn in popped)
             assert not popped_extra  # no other patches were popped
             trans.push_patch(temp_name, iw)
         top_name = to_pop.pop()
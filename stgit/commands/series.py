@@ -213,7 +213,7 @@ def func(parser, options, args):
         stack = directory.repository.get_stack(options.missing)
 
     # current series patches
-    applied = unapplied = hidden = ()
+    applied = unapplied = hidden = []
     if options.applied or options.unapplied or options.hidden:
         if options.all:
             raise CmdException(
@@ -234,9 +234,9 @@ def func(parser, options, args):
         unapplied = stack.patchorder.unapplied
 
     if options.missing:
-        cmp_patches = cmp_stack.patchorder.all
+        cmp_patches = set(cmp_stack.patchorder.all)
     else:
-        cmp_patches = ()
+        cmp_patches = set()
 
     # the filtering range covers the whole series
     if args:
@@ -246,7 +246,7 @@ def func(parser, options, args):
         show_patches = applied + unapplied + hidden
 
     # missing filtering
-    show_patches = [p for p in show_patches if p not in cmp_patches]
+    show_patches = set(p for p in show_patches if p not in cmp_patches)
 
     # filter the patches
     applied = [p for p in applied if p in show_patches]
@@ -272,6 +272,13 @@ def func(parser, options, args):
     if not patches:
         return
 
+    if options.description or options.author or options.empty:
+        # Read all the patch commits we are about to look at in one go.
+        commits = [stack.patches.get(p).commit for p in patches]
+        stack.repository.prefetch_commits(commits)
+        if options.empty:
+            stack.repository.prefetch_commits(c.data.parent for c in commits)
+
     if options.showbranch:
         branch_str = stack.name + ':'
     else:
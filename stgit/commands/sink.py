@@ -96,13 +96,14 @@ def func(parser, options, args):
     if options.to and options.to in patches:
         raise CmdException('Cannot have a sinked patch as target')
 
-    applied = [p for p in stack.patchorder.applied if p not in patches]
+    sunk = set(patches)
+    applied = [p for p in stack.patchorder.applied if p not in sunk]
     if options.to:
         insert_idx = applied.index(options.to)
     else:
         insert_idx = 0
     applied = applied[:insert_idx] + patches + applied[insert_idx:]
-    unapplied = [p for p in stack.patchorder.unapplied if p not in patches]
+    unapplied = [p for p in stack.patchorder.unapplied if p not in sunk]
 
     iw = stack.repository.default_iw
     clean_iw = (not options.keep and iw) or None
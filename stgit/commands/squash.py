@@ -127,9 +127,11 @@ def _squash_patches(trans, patches, msg, save_template, no_verify=False):
 
 
 def _squash(stack, iw, name, msg, save_template, patches, no_verify=False):
+    squashed = set(patches)
+
     # If a name was supplied on the command line, make sure it's OK.
     def bad_name(pn):
-        return pn not in patches and stack.patches.exists(pn)
+        return pn not in squashed and stack.patches.exists(pn)
 
     def get_name(cd):
         return name or utils.make_patch_name(cd.message_str, bad_name)
@@ -143,25 +145,25 @@ def _squash(stack, iw, name, msg, save_template, patches, no_verify=False):
         trans.unapplied.insert(0, name)
 
     trans = StackTransaction(stack, 'squash', allow_conflicts=True)
-    push_new_patch = bool(set(patches) & set(trans.applied))
+    push_new_patch = bool(squashed & set(trans.applied))
     try:
         new_commit_data = _squash_patches(trans, patches, msg, save_template,
                                           no_verify)
         if new_commit_data:
             # We were able to construct the squashed commit
             # automatically. So just delete its constituent patches.
-            to_push = trans.delete_patches(lambda pn: pn in patches)
+            to_push = trans.delete_patches(lambda pn: pn in squashed)
         else:
             # Automatic construction failed. So push the patches
             # consecutively, so that a second construction attempt is
             # guaranteed to work.
-            to_push = trans.pop_patches(lambda pn: pn in patches)
+            to_push = trans.pop_patches(lambda pn: pn in squashed)
             for pn in patches:
                 trans.push_patch(pn, iw)
             new_commit_data = _squash_patches(
                 trans, patches, msg, save_template, no_verify
             )
-            popped_extra = trans.delete_patches(lambda pn: pn in patches)
+            popped_extra = trans.delete_patches(lambda pn: pn in squashed)
             assert not popped_extra
         make_squashed_patch(trans, new_commit_data)
 
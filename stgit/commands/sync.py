@@ -17,6 +17,7 @@ from stgit.commands.common import (
     parse_patches,
 )
 from stgit.lib.git import CommitData
+from stgit.lib.patchlist import PatchList
 from stgit.lib.transaction import StackTransaction, TransactionHalted
 from stgit.out import out
 
@@ -175,7 +176,7 @@ def func(parser, options, args):
     # pop to the one before the first patch to be synchronised
     first_patch = sync_patches[0]
     if first_patch in applied:
-        to_pop = applied[applied.index(first_patch) + 1:]
+        to_pop = PatchList(applied[applied.index(first_patch) + 1:])
         if to_pop:
             trans = StackTransaction(stack, 'sync (pop)', check_clean_iw=iw)
             popped_extra = trans.pop_patches(lambda pn: pn in to_pop)
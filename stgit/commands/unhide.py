@@ -65,7 +65,8 @@ def func(parser, options, args):
 
     applied = list(trans.applied)
     unapplied = trans.unapplied + patches
-    hidden = [p for p in trans.hidden if p not in set(patches)]
+    to_unhide = set(patches)
+    hidden = [p for p in trans.hidden if p not in to_unhide]
 
     trans.reorder_patches(applied, unapplied, hidden)
     return trans.run()
@@ -37,8 +37,16 @@ DEFAULTS = [
     ('stgit.alias.rm', ['git rm']),
     ('stgit.alias.status', ['git status -s']),
     ('stgit.autoimerge', ['no']),
+    ('stgit.commitcachesize', ['10000']),
     ('stgit.fetchcmd', ['git fetch']),
+    ('stgit.journalinterval', ['100']),
     ('stgit.keepoptimized', ['no']),
+    ('stgit.logindex', ['yes']),
+    ('stgit.logkeep', ['100']),
+    ('stgit.logkeepdays', ['0']),
+    ('stgit.mergetree', ['yes']),
+    ('stgit.nativeobjects', ['no']),
+    ('stgit.objectcachesize', ['20000']),
     ('stgit.pager', ['less']),
     ('stgit.pull-policy', ['pull']),
     ('stgit.pullcmd', ['git pull']),
@@ -46,6 +54,8 @@ DEFAULTS = [
     ('stgit.shortnr', ['5']),
     ('stgit.smtpdelay', ['5']),
     ('stgit.smtpserver', ['localhost:25']),
+    ('stgit.stacksnapshot', ['no']),
+    ('stgit.unpacklimit', ['100']),
 ]
 
 
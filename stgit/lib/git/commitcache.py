@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""A cache of parsed commit objects that is kept on disk between StGit
+invocations.
+
+Commits never change once they have been written, so what we learned
+by parsing a commit can be reused by all later StGit commands instead
+of asking git for the commit again. L{CommitCache} keeps the tree,
+parents, author, committer, encoding and message of commits in an
+SQLite database in C{.git/stgit-cache/}. The database is only a cache:
+if it can't be opened or written, for example because the repository
+is read-only or another StGit process holds the lock for too long, we
+just do without it."""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals,
+)
+
+import os
+import time
+
+try:
+    import sqlite3
+except ImportError:  # pragma: no cover
+    sqlite3 = None
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS commits (
+           sha1 TEXT PRIMARY KEY,
+           tree TEXT NOT NULL,
+           parents TEXT NOT NULL,
+           author BLOB NOT NULL,
+           committer BLOB NOT NULL,
+           encoding TEXT,
+           message BLOB NOT NULL,
+           used INTEGER NOT NULL
+       )''',
+    'CREATE INDEX IF NOT EXISTS commits_used ON commits (used)',
+    '''CREATE TABLE IF NOT EXISTS stats (
+           name TEXT PRIMARY KEY,
+           value INTEGER NOT NULL
+       )''',
+]
+
+
+def cache_dir(common_dir):
+    """Return the directory the cache of the repository with the given
+    common git directory lives in."""
+    return os.path.join(common_dir, 'stgit-cache')
+
+
+class CommitCache(object):
+    """The on-disk cache of parsed commits of one repository.
+
+    Lookups go straight to the database. New entries, and the fact that
+    existing ones were used, are collected in memory and written by
+    L{flush} in a single database transaction; that's also when the
+    least recently used entries are dropped if there are more than
+    C{max_entries} of them."""
+
+    filename = 'commits.sqlite'
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self._max_entries = max_entries
+        self._db = None
+        self._new = {}
+        self._used = set()
+        self.hits = self.misses = 0
+
+    @classmethod
+    def open(cls, common_dir, max_entries):
+        """Open the commit cache of a repository, creating it if needed.
+        Return C{None} if that's not possible."""
+        if sqlite3 is None:  # pragma: no cover
+            return None
+        cache = cls(
+            os.path.join(cache_dir(common_dir), cls.filename), max_entries
+        )
+        try:
+            cache._connect()
+        except (EnvironmentError, sqlite3.Error):
+            return None
+        return cache
+
+    def _connect(self):
+        d = os.path.dirname(self.path)
+        if not os.path.isdir(d):
+            os.mkdir(d)
+        self._db = sqlite3.connect(self.path, timeout=1)
+        with self._db:
+            for statement in _SCHEMA:
+                self._db.execute(statement)
+
+    def get(self, sha1):
+        """Return the (tree, parents, author, committer, encoding, message)
+        of the given commit, as given to L{add}, or C{None} if it isn't
+        in the cache."""
+        if sha1 in self._new:
+            return self._new[sha1]
+        try:
+            row = self._db.execute(
+                'SELECT tree, parents, author, committer, encoding, message'
+                ' FROM commits WHERE sha1 = ?',
+                (sha1,),
+            ).fetchone()
+        except sqlite3.Error:
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._used.add(sha1)
+        tree, parents, author, committer, encoding, message = row
+        return (
+            tree,
+            parents.split(),
+            bytes(author),
+            bytes(committer),
+            encoding,
+            bytes(message),
+        )
+
+    def add(self, sha1, tree, parents, author, committer, encoding, message):
+        """Remember a parsed commit. C{parents} is a list of sha1s, and
+        C{author}, C{committer} and C{message} are the raw bytes from the
+        commit object."""
+        self._new[sha1] = (
+            tree, list(parents), author, committer, encoding, message
+        )
+
+    def flush(self):
+        """Write the collected changes to the database, and drop the least
+        recently used entries if there are too many."""
+        if not (self._new or self._used or self.hits or self.misses):
+            return
+        now = int(time.time())
+        try:
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO commits'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [
+                        (
+                            sha1,
+                            tree,
+                            ' '.join(parents),
+                            sqlite3.Binary(author),
+                            sqlite3.Binary(committer),
+                            encoding,
+                            sqlite3.Binary(message),
+                            now,
+                        )
+                        for sha1, (
+                            tree, parents, author, committer, encoding, message
+                        ) in self._new.items()
+                    ],
+                )
+                self._db.executemany(
+                    'UPDATE commits SET used = ? WHERE sha1 = ?',
+                    [(now, sha1) for sha1 in self._used],
+                )
+                for name in ['hits', 'misses']:
+                    self._db.execute(
+                        'INSERT OR IGNORE INTO stats VALUES (?, 0)', (name,)
+                    )
+                    self._db.execute(
+                        'UPDATE stats SET value = value + ? WHERE name = ?',
+                        (getattr(self, name), name),
+                    )
+                if self._max_entries:
+                    self._evict()
+        except sqlite3.Error:
+            pass
+        self._new.clear()
+        self._used.clear()
+        self.hits = self.misses = 0
+
+    def _evict(self):
+        count, = self._db.execute('SELECT COUNT(*) FROM commits').fetchone()
+        if count > self._max_entries:
+            self._db.execute(
+                'DELETE FROM commits WHERE sha1 IN'
+                ' (SELECT sha1 FROM commits ORDER BY used LIMIT ?)',
+                (count - self._max_entries,),
+            )
+
+    def stats(self):
+        """Return a dictionary with the number of entries in the cache, the
+        size of the database file, and how many lookups have found what
+        they were looking for (C{hits}) or not (C{misses}) so far."""
+        self.flush()
+        entries, = self._db.execute('SELECT COUNT(*) FROM commits').fetchone()
+        result = {'entries': entries, 'hits': 0, 'misses': 0}
+        result.update(self._db.execute('SELECT name, value FROM stats'))
+        result['size'] = os.path.getsize(self.path)
+        return result
+
+    def close(self):
+        if self._db is not None:
+            self.flush()
+            self._db.close()
+            self._db = None
+
+    def clear(self):
+        """Throw away everything in the cache."""
+        self._new.clear()
+        self._used.clear()
+        self.hits = self.misses = 0
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        d = os.path.dirname(self.path)
+        for name in os.listdir(d):
+            if name.startswith(self.filename):
+                os.remove(os.path.join(d, name))
+        self._connect()
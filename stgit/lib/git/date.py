@@ -7,7 +7,9 @@ from __future__ import (
 )
 
 from datetime import datetime, timedelta, tzinfo
+import calendar
 import re
+import time
 
 from stgit.compat import rfc2822_format
 from stgit.exception import StgException
@@ -81,6 +83,23 @@ def system_date(datestring):
         raise DateException(datestring, "date")
 
 
+def format_git_date(timestamp, offset):
+    """Format a timestamp and a L{timedelta} time zone offset the way
+    git stores them in commit objects."""
+    minutes = (offset.days * 86400 + offset.seconds) // 60
+    sign = '-' if minutes < 0 else '+'
+    minutes = abs(minutes)
+    return '%d %s%02d%02d' % (timestamp, sign, minutes // 60, minutes % 60)
+
+
+def git_now():
+    """Return the current time formatted like L{format_git_date}, in the
+    local time zone."""
+    now = int(time.time())
+    offset = calendar.timegm(time.localtime(now)) - now
+    return format_git_date(now, timedelta(seconds=offset))
+
+
 def git_date(datestring=''):
     try:
         ident = (
@@ -164,6 +183,25 @@ class Date(Immutable):
         """Format date in RFC-2822 format, as used in email."""
         return rfc2822_format(self._time)
 
+    def timestamp(self):
+        """Seconds since the epoch."""
+        return calendar.timegm(self._time.utctimetuple())
+
+    def git_accepts(self):
+        """Whether C{git commit-tree} would take this date as it is. It
+        refuses dates before 1970 or after 2099, and ignores time zone
+        offsets of a day or more."""
+        return (
+            self.timestamp() >= 0
+            and self._time.year < 2100
+            and abs(self._time.utcoffset()) < timedelta(days=1)
+        )
+
+    def git_format(self):
+        """Format date the way git stores it in commit objects: seconds
+        since the epoch, and the time zone offset."""
+        return format_git_date(self.timestamp(), self._time.utcoffset())
+
     @classmethod
     def maybe(cls, datestring):
         """Return a new object initialized with the argument if it contains a
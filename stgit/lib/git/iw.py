@@ -13,6 +13,7 @@ from stgit.run import Run, RunException
 from stgit.utils import add_dict
 
 from .objects import Commit, Tree
+from .treemerge import merge_trees
 
 
 class MergeException(StgException):
@@ -52,6 +53,9 @@ class Index(object):
         )
 
     def run(self, args, env=()):
+        # Objects we have only collected in memory so far must be
+        # written out before git can see them.
+        self._repository.checkpoint_objects()
         return Run(*args).env(add_dict(self.env, env))
 
     def read_tree(self, tree):
@@ -81,10 +85,16 @@ class Index(object):
         else:
             return True
 
-    def apply(self, patch_bytes, quiet):
-        """In-index patch application, no worktree involved."""
+    def apply(self, patch_bytes, quiet, three_way=False, env=()):
+        """In-index patch application, no worktree involved. With
+        C{three_way}, files the patch doesn't apply to are merged with
+        their versions in the patch, and only conflicts make this
+        fail."""
+        args = ['git', 'apply', '--cached']
+        if three_way:
+            args.append('--3way')
         try:
-            r = self.run(['git', 'apply', '--cached'])
+            r = self.run(args, env)
             r.encoding(None).raw_input(patch_bytes)
             if quiet:
                 r = r.discard_stderr()
@@ -129,6 +139,16 @@ class Index(object):
         if ours == theirs:
             return (ours, current)
 
+        # Most of the time, the two sides changed different paths, and
+        # the trees can be merged without touching the index.
+        result = merge_trees(self._repository, base, ours, theirs)
+        if result is not None:
+            return (result, current)
+        if self._repository.merge_tree_enabled:
+            return (
+                self._repository.merge_tree(base, ours, theirs), current
+            )
+
         if current == theirs:
             # Swap the trees. It doesn't matter since merging is
             # symmetric, and will allow us to avoid the read_tree()
@@ -196,10 +216,12 @@ class IndexAndWorktree(object):
         return self._worktree.directory
 
     def run(self, args, env=()):
-        return Run(*args).env(add_dict(self.env, env)).cwd(self.cwd)
+        return self.index.run(args, add_dict(self._worktree.env, env)).cwd(
+            self.cwd
+        )
 
     def run_in_cwd(self, args):
-        return Run(*args).env(add_dict(self.env, self.env_in_cwd))
+        return self.index.run(args, self.env_in_cwd)
 
     def checkout_hard(self, tree):
         assert isinstance(tree, (Commit, Tree))
@@ -231,6 +253,17 @@ class IndexAndWorktree(object):
         assert isinstance(base, Tree)
         assert isinstance(ours, Tree)
         assert isinstance(theirs, Tree)
+        repository = self.index._repository
+        if repository.merge_tree_enabled:
+            # Only conflicts need to be spilled to the worktree; a clean
+            # result is simply checked out.
+            result = repository.merge_tree(base, ours, theirs)
+            if result is not None:
+                try:
+                    self.checkout(ours, result)
+                except CheckoutException:
+                    raise MergeException('Index/worktree dirty')
+                return
         try:
             r = self.run(
                 [
@@ -6,15 +6,60 @@ from __future__ import (
     unicode_literals,
 )
 
-import re
+import binascii
 
-from stgit.compat import text
+from stgit.compat import environ_get, fsencode_utf8, text
 from stgit.config import config
 
 from .base import Immutable
+from .date import Date, git_now
 from .person import Person
 
 
+def _clean_ident_part(s):
+    """Check that git would use a name or email address as is. (It
+    strips certain characters from the ends, and removes others
+    altogether.)"""
+    crud = '.,:;<>"\\\''
+    return (
+        bool(s)
+        and not (s[0] in crud or s[0] <= ' ')
+        and not (s[-1] in crud or s[-1] <= ' ')
+        and not any(c in s for c in '\n<>')
+    )
+
+
+def _git_ident(role, person):
+    """Return the ident line git commit-tree would write for the given
+    L{Person}, or C{None} if git would do something we don't."""
+    for part in [person.name, person.email]:
+        if not _clean_ident_part(part):
+            return None
+    date = person.date
+    if date is None:
+        # git takes the date from the environment, or uses the current
+        # time.
+        date = Date.maybe(environ_get('GIT_%s_DATE' % role.upper()))
+    if date is not None and not date.git_accepts():
+        # Let git refuse it.
+        return None
+    return '%s <%s> %s' % (
+        person.name,
+        person.email,
+        date.git_format() if date is not None else git_now(),
+    )
+
+
+def _is_git_utf8(raw):
+    """Check that git considers C{raw} to be valid UTF-8. Unlike Python,
+    git also rejects the noncharacters U+FFFE and U+FFFF."""
+    try:
+        s = raw.decode('utf-8')
+    except UnicodeDecodeError:
+        return False
+    return '\ufffe' not in s and '\uffff' not in s
+
+
 class GitObject(Immutable):
     """Base class for all git objects. One git object is represented by at
     most one C{GitObject}, which makes it possible to compare them
@@ -33,12 +78,14 @@ class BlobData(Immutable):
         """Commit the blob.
         @return: The committed blob
         @rtype: L{Blob}"""
-        sha1 = (
-            repository.run(['git', 'hash-object', '-w', '--stdin'])
-            .encoding(None)
-            .raw_input(self.bytes)
-            .output_one_line()
-        )
+        sha1 = repository.write_object(Blob.typename, self.bytes)
+        if sha1 is None:
+            sha1 = (
+                repository.run(['git', 'hash-object', '-w', '--stdin'])
+                .encoding(None)
+                .raw_input(self.bytes)
+                .output_one_line()
+            )
         return repository.get_blob(sha1)
 
 
@@ -66,14 +113,41 @@ class Blob(GitObject):
         return BlobData(content)
 
 
+def perm_typename(perm):
+    """Return the type of object a tree entry with the given permission
+    points to."""
+    if perm == Tree.default_perm:
+        return Tree.typename
+    elif perm == '160000':
+        return Commit.typename
+    else:
+        return Blob.typename
+
+
+# The permissions git writes, as they appear in raw tree objects.
+_RAW_PERMS = dict(
+    (perm.lstrip('0').encode('ascii'), perm)
+    for perm in ['040000', '100644', '100755', '120000', '160000']
+)
+
+
 class TreeData(Immutable):
-    """Represents the data contents of a git tree object."""
+    """Represents the data contents of a git tree object.
+
+    The entries are kept in parallel lists of names, permissions and
+    objects. The objects of a tree parsed by L{parse_raw} start out as
+    just their sha1s, and only become L{Blob}, L{Tree} or L{Commit}
+    objects when they are asked for."""
 
     def __init__(self, entries):
         """Create a new L{TreeData} object from the given mapping from names
         (strings) to either (I{permission}, I{object}) tuples or just
         objects."""
-        self._entries = {}
+        self._repository = None
+        self._names = []
+        self._perms = []
+        self._objects = []
+        self._index = None
         for name, po in entries.items():
             assert '/' not in name, (
                 'tree entry name contains slash: %s' % name
@@ -82,42 +156,134 @@ class TreeData(Immutable):
                 perm, obj = po.default_perm, po
             else:
                 perm, obj = po
-            self._entries[name] = (perm, obj)
+            self._names.append(name)
+            self._perms.append(perm)
+            self._objects.append(obj)
+
+    def _object(self, i):
+        obj = self._objects[i]
+        if not isinstance(obj, GitObject):
+            obj = self._objects[i] = self._repository.get_object(
+                perm_typename(self._perms[i]), obj
+            )
+        return obj
 
     def __getitem__(self, key):
-        return self._entries[key]
+        if self._index is None:
+            self._index = dict((n, i) for i, n in enumerate(self._names))
+        i = self._index[key]
+        return self._perms[i], self._object(i)
 
     def __iter__(self):
-        for name, (perm, obj) in self._entries.items():
-            yield name, (perm, obj)
+        for i, name in enumerate(self._names):
+            yield name, (self._perms[i], self._object(i))
+
+    def __len__(self):
+        return len(self._names)
+
+    def sha1_entries(self):
+        """Iterate over (I{name}, I{permission}, I{sha1}) tuples for all
+        entries, without making objects for them."""
+        for name, perm, obj in zip(self._names, self._perms, self._objects):
+            yield name, perm, obj.sha1 if isinstance(obj, GitObject) else obj
+
+    @classmethod
+    def from_sha1_entries(cls, repository, entries):
+        """Create a new L{TreeData} object from (I{name}, I{permission},
+        I{sha1}) tuples, like the ones L{sha1_entries} returns, without
+        making objects for them."""
+        data = cls({})
+        data._repository = repository
+        for name, perm, sha1 in entries:
+            data._names.append(name)
+            data._perms.append(perm)
+            data._objects.append(sha1)
+        return data
 
     def commit(self, repository):
         """Commit the tree.
         @return: The committed tree
         @rtype: L{Tree}"""
-        listing = [
-            '%s %s %s\t%s' % (perm, obj.typename, obj.sha1, name)
-            for name, (perm, obj) in self
-        ]
-        sha1 = (
-            repository.run(['git', 'mktree', '-z'])
-            .input_nulterm(listing)
-            .output_one_line()
-        )
+        sha1 = None
+        if repository.write_object_enabled:
+            raw = self._raw()
+            if raw is not None:
+                sha1 = repository.write_object(Tree.typename, raw)
+        if sha1 is None:
+            listing = [
+                '%s %s %s\t%s' % (perm, obj.typename, obj.sha1, name)
+                for name, (perm, obj) in self
+            ]
+            sha1 = (
+                repository.run(['git', 'mktree', '-z'])
+                .input_nulterm(listing)
+                .output_one_line()
+            )
         return repository.get_tree(sha1)
 
+    def _raw(self):
+        """Return the raw tree object that git mktree would write for this
+        tree, or C{None} if mktree would reject it."""
+        entries = []
+        for name, perm, obj in zip(self._names, self._perms, self._objects):
+            mode = int(perm, 8)
+            if mode & 0o170000 == 0o040000:
+                typename = Tree.typename
+            elif mode & 0o170000 == 0o160000:
+                typename = Commit.typename
+            else:
+                typename = Blob.typename
+            if isinstance(obj, GitObject):
+                obj_typename, sha1 = obj.typename, obj.sha1
+            else:
+                obj_typename, sha1 = perm_typename(perm), obj
+            if typename != obj_typename:
+                return None
+            name = name.encode('utf-8')
+            # Git sorts subtrees as if their names ended with a slash.
+            key = name + b'/' if typename == Tree.typename else name
+            entries.append((key, name, mode, sha1))
+        entries.sort()
+        return b''.join(
+            ('%o ' % mode).encode('ascii')
+            + name
+            + b'\0'
+            + binascii.unhexlify(sha1)
+            for key, name, mode, sha1 in entries
+        )
+
     @classmethod
-    def parse(cls, repository, lines):
-        """Parse a raw git tree description.
+    def parse_raw(cls, repository, content):
+        """Parse the contents of a raw git tree object.
 
         @return: A new L{TreeData} object
         @rtype: L{TreeData}"""
-        entries = {}
-        for line in lines:
-            m = re.match(r'^([0-7]{6}) ([a-z]+) ([0-9a-f]{40})\t(.*)$', line)
-            perm, type, sha1, name = m.groups()
-            entries[name] = (perm, repository.get_object(type, sha1))
-        return cls(entries)
+        perms = []
+        names = []
+        sha1s = []
+        find = content.find
+        pos = 0
+        end = len(content)
+        while pos < end:
+            sp = find(b' ', pos)
+            nul = find(b'\0', sp)
+            perms.append(content[pos:sp])
+            names.append(content[sp + 1:nul])
+            pos = nul + 21
+            sha1s.append(content[nul + 1:pos])
+        hex_sha1s = binascii.hexlify(b''.join(sha1s)).decode('ascii')
+
+        data = cls({})
+        data._repository = repository
+        data._perms = [
+            _RAW_PERMS.get(perm) or perm.decode('ascii').zfill(6)
+            for perm in perms
+        ]
+        data._names = [name.decode('utf-8') for name in names]
+        data._objects = [
+            hex_sha1s[i:i + 40] for i in range(0, len(hex_sha1s), 40)
+        ]
+        return data
 
 
 class Tree(GitObject):
@@ -135,15 +301,20 @@ class Tree(GitObject):
 
     @property
     def data(self):
-        if self._data is None:
-            self._data = TreeData.parse(
-                self._repository,
-                self._repository.run(
-                    ['git', 'ls-tree', '-z', self.sha1]
-                ).output_lines('\0'),
+        loaded = self._data is None
+        if loaded:
+            type_, content = self._repository.cat_object(self.sha1)
+            assert type_ == 'tree', (
+                'expected "tree", got "%s" for %s' % (type_, self.sha1)
             )
+            self._data = TreeData.parse_raw(self._repository, content)
+        self._repository.object_data_used(self, loaded)
         return self._data
 
+    def unload(self):
+        """Forget the data; it will be read again when needed."""
+        self._data = None
+
     def __repr__(self):  # pragma: no cover
         return 'Tree<sha1: %s>' % self.sha1
 
@@ -271,23 +442,86 @@ class CommitData(Immutable):
         """Commit the commit.
         @return: The committed commit
         @rtype: L{Commit}"""
-        c = ['git', 'commit-tree', self.tree.sha1]
-        for p in self.parents:
-            c.append('-p')
-            c.append(p.sha1)
-        sha1 = (
-            repository.run(c, env=self.env)
-            .encoding(None)
-            .raw_input(self.message)
-            .output_one_line()
-        )
+        sha1 = None
+        if repository.write_object_enabled:
+            raw = self._raw()
+            if raw is not None:
+                sha1 = repository.write_object(Commit.typename, raw)
+            if sha1 is not None:
+                commit = repository.get_commit(sha1)
+                if commit._data is None:
+                    # Save reading back what we just wrote; the next
+                    # commit made is often a child of this one.
+                    commit._set_data(Commit.typename, raw)
+                return commit
+        if sha1 is None:
+            c = ['git', 'commit-tree', self.tree.sha1]
+            for p in self.parents:
+                c.append('-p')
+                c.append(p.sha1)
+            sha1 = (
+                repository.run(c, env=self.env)
+                .encoding(None)
+                .raw_input(self.message)
+                .output_one_line()
+            )
         return repository.get_commit(sha1)
 
+    def _raw(self):
+        """Return the raw commit object that git commit-tree would write
+        for this commit, or C{None} if we can't be sure to get it
+        exactly right (signed commits, identities that git would clean
+        up or look up elsewhere, and so on)."""
+        if config.getbool('commit.gpgsign'):
+            return None
+        lines = ['tree %s' % self.tree.sha1]
+        lines.extend('parent %s' % p.sha1 for p in self.parents)
+        for role, person in [
+            ('author', self.author),
+            ('committer', self.committer),
+        ]:
+            ident = _git_ident(role, person)
+            if ident is None:
+                return None
+            lines.append('%s %s' % (role, ident))
+        encoding = config.get('i18n.commitencoding')
+        utf8 = encoding.lower() in ('utf-8', 'utf8')
+        if not utf8:
+            lines.append('encoding %s' % encoding)
+        raw = fsencode_utf8('\n'.join(lines)) + b'\n\n' + self.message
+        if utf8 and not _is_git_utf8(raw):
+            # commit-tree would reencode this from Latin-1.
+            return None
+        return raw
+
     @classmethod
     def parse(cls, repository, content):
         """Parse a raw git commit description.
         @return: A new L{CommitData} object
         @rtype: L{CommitData}"""
+        return cls.from_fields(repository, *cls.parse_fields(content))
+
+    @classmethod
+    def from_fields(
+        cls, repository, tree, parents, author, committer, encoding, message
+    ):
+        """Make a L{CommitData} object from what L{parse_fields} returns.
+        @rtype: L{CommitData}"""
+        return cls(
+            repository.get_tree(tree),
+            [repository.get_commit(p) for p in parents],
+            message,
+            encoding,
+            author,
+            committer,
+        )
+
+    @staticmethod
+    def parse_fields(content):
+        """Split a raw git commit description into its parts: the sha1 of
+        the tree, a list of the sha1s of the parents, the raw author and
+        committer, the encoding (or C{None} if there is no encoding
+        header) and the raw message."""
         required_keys = set(['tree', 'author', 'committer'])
         parents = []
         encoding = None
@@ -302,12 +536,10 @@ class CommitData(Immutable):
                 key_b, value_b = line.split(b' ', 1)
                 key = key_b.decode('utf-8')
                 if key == 'tree':
-                    tree = repository.get_tree(value_b.decode('utf-8'))
+                    tree = value_b.decode('utf-8')
                     required_keys.remove(key)
                 elif key == 'parent':
-                    parents.append(
-                        repository.get_commit(value_b.decode('utf-8'))
-                    )
+                    parents.append(value_b.decode('utf-8'))
                 elif key == 'author':
                     author = value_b
                     required_keys.remove(key)
@@ -322,7 +554,7 @@ class CommitData(Immutable):
             else:
                 break
         assert not required_keys, 'commit data missing keys %s' % required_keys
-        return cls(tree, parents, content, encoding, author, committer)
+        return tree, parents, author, committer, encoding, content
 
 
 class Commit(GitObject):
@@ -339,13 +571,34 @@ class Commit(GitObject):
 
     @property
     def data(self):
-        if self._data is None:
-            type_, content = self._repository.cat_object(self.sha1)
-            assert type_ == 'commit', (
-                'expected "commit", got "%s" for %s' % (type_, self.sha1)
-            )
-            self._data = CommitData.parse(self._repository, content)
+        if self._data is not None:
+            self._repository.object_data_used(self, False)
+        elif not self._set_cached_data():
+            self._set_data(*self._repository.cat_object(self.sha1))
         return self._data
 
+    def _set_data(self, type_, content):
+        assert type_ == 'commit', (
+            'expected "commit", got "%s" for %s' % (type_, self.sha1)
+        )
+        fields = CommitData.parse_fields(content)
+        self._data = CommitData.from_fields(self._repository, *fields)
+        self._repository.object_data_used(self, True)
+        self._repository.cache_commit_fields(self.sha1, fields)
+
+    def _set_cached_data(self):
+        """Take the data from the repository's persistent commit cache.
+        Return C{False} if it isn't there."""
+        fields = self._repository.cached_commit_fields(self.sha1)
+        if fields is None:
+            return False
+        self._data = CommitData.from_fields(self._repository, *fields)
+        self._repository.object_data_used(self, True)
+        return True
+
+    def unload(self):
+        """Forget the data; it will be read again when needed."""
+        self._data = None
+
     def __repr__(self):  # pragma: no cover
         return 'Commit<sha1: %s, data: %s>' % (self.sha1, self._data)
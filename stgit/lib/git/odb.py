@@ -0,0 +1,555 @@
+# -*- coding: utf-8 -*-
+"""Direct access to the git object database, without going through
+git subprocesses.
+
+L{ObjectDatabase} reads loose objects and objects stored in version 2
+pack files (including deltified ones). Anything it cannot find or
+does not understand makes it return C{None}, in which case the caller
+is expected to fall back to asking git.
+
+It can also write new objects, either as loose objects or, for the
+many objects a big stack transaction creates, collected into a single
+pack file. L{write_pack} also serves to hand a batch of objects to git
+in one go."""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals,
+)
+
+import binascii
+from collections import OrderedDict
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+from stgit.compat import environ_get
+
+_PACK_TYPES = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+_PACK_TYPE_NUMBERS = dict((t, n) for n, t in _PACK_TYPES.items())
+_OFS_DELTA = 6
+_REF_DELTA = 7
+
+
+class _PackIndex(object):
+    """A memory-mapped version 2 pack index (C{.idx}) file."""
+
+    _magic = b'\377tOc'
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:4] != self._magic:
+            raise ValueError('%s: unsupported index version' % path)
+        version, = struct.unpack_from('>I', self._map, 4)
+        if version != 2:
+            raise ValueError('%s: unsupported index version' % path)
+        self._fanout = struct.unpack_from('>256I', self._map, 8)
+        self.count = self._fanout[255]
+        self._sha1s = 8 + 256 * 4
+        self._offsets = self._sha1s + 24 * self.count
+        self._large_offsets = self._offsets + 4 * self.count
+
+    def _sha1_at(self, i):
+        pos = self._sha1s + 20 * i
+        return self._map[pos:pos + 20]
+
+    def find(self, binsha):
+        """Return the pack offset of the object, or C{None} if it's not in
+        this pack."""
+        first = bytearray(binsha[:1])[0]
+        lo = self._fanout[first - 1] if first else 0
+        hi = self._fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            s = self._sha1_at(mid)
+            if s < binsha:
+                lo = mid + 1
+            elif s > binsha:
+                hi = mid
+            else:
+                return self._offset_at(mid)
+        return None
+
+    def _offset_at(self, i):
+        offset, = struct.unpack_from('>I', self._map, self._offsets + 4 * i)
+        if offset & 0x80000000:
+            pos = self._large_offsets + 8 * (offset & 0x7fffffff)
+            offset, = struct.unpack_from('>Q', self._map, pos)
+        return offset
+
+    def close(self):
+        self._map.close()
+
+
+class _Pack(object):
+    """A memory-mapped pack file together with its index."""
+
+    def __init__(self, path):
+        self.path = path
+        self.index = _PackIndex(path[:-len('.pack')] + '.idx')
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:4] != b'PACK':
+            raise ValueError('%s: not a pack file' % path)
+
+    def _entry_header(self, offset):
+        """Parse the entry header at C{offset}. Return the type number,
+        the (inflated) size, and the offset of the data following the
+        header."""
+        m = self._map
+        c = bytearray(m[offset:offset + 1])[0]
+        offset += 1
+        type_ = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        while c & 0x80:
+            c = bytearray(m[offset:offset + 1])[0]
+            offset += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        return type_, size, offset
+
+    def _inflate(self, offset, size):
+        d = zlib.decompressobj()
+        parts = []
+        got = 0
+        chunk = max(size, 4096)
+        while got < size:
+            data = self._map[offset:offset + chunk]
+            if not data:
+                raise zlib.error('truncated pack entry')
+            parts.append(d.decompress(data))
+            got += len(parts[-1])
+            offset += chunk
+        content = b''.join(parts)
+        if len(content) != size:
+            raise zlib.error('bad pack entry size')
+        return content
+
+    def read(self, odb, offset):
+        """Read the object at C{offset}. Return a (type, content) tuple,
+        or C{None} if a delta base can't be found."""
+        obj = odb._base_cache.get((self, offset))
+        if obj is None:
+            obj = self._read(odb, offset)
+            if obj is not None:
+                odb._cache_base((self, offset), obj)
+        return obj
+
+    def _read(self, odb, offset):
+        type_, size, pos = self._entry_header(offset)
+        if type_ in _PACK_TYPES:
+            return _PACK_TYPES[type_], self._inflate(pos, size)
+        if type_ == _OFS_DELTA:
+            c = bytearray(self._map[pos:pos + 1])[0]
+            pos += 1
+            rel = c & 0x7f
+            while c & 0x80:
+                c = bytearray(self._map[pos:pos + 1])[0]
+                pos += 1
+                rel = ((rel + 1) << 7) | (c & 0x7f)
+            base = self.read(odb, offset - rel)
+        elif type_ == _REF_DELTA:
+            base = odb.read_binsha(self._map[pos:pos + 20])
+            pos += 20
+        else:
+            return None
+        if base is None:
+            return None
+        base_type, base_content = base
+        return base_type, _apply_delta(base_content, self._inflate(pos, size))
+
+    def close(self):
+        self._map.close()
+        self.index.close()
+
+
+def _delta_varint(delta, pos):
+    n = shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        n |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return n, pos
+
+
+def _apply_delta(base, delta):
+    """Apply a git binary delta to C{base}."""
+    delta = bytearray(delta)
+    src_size, pos = _delta_varint(delta, 0)
+    dst_size, pos = _delta_varint(delta, pos)
+    if src_size != len(base):
+        raise zlib.error('delta base size mismatch')
+    out = bytearray()
+    end = len(delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            out += base[offset:offset + size]
+        elif op:
+            out += delta[pos:pos + op]
+            pos += op
+        else:
+            raise zlib.error('bad delta opcode')
+    if len(out) != dst_size:
+        raise zlib.error('delta result size mismatch')
+    return bytes(out)
+
+
+def _pack_entry_header(type_, size):
+    """Return the header of an undeltified pack entry."""
+    c = (_PACK_TYPE_NUMBERS[type_] << 4) | (size & 15)
+    size >>= 4
+    header = bytearray()
+    while size:
+        header.append(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    header.append(c)
+    return bytes(header)
+
+
+def object_sha1(type_, content):
+    """Return the sha1 git gives an object of the given type and
+    content."""
+    h = hashlib.sha1(('%s %d\0' % (type_, len(content))).encode('ascii'))
+    h.update(content)
+    return h.hexdigest()
+
+
+def write_pack(f, objects, compression=-1):
+    """Write a version 2 pack holding the given (sha1, (type, content))
+    pairs, none of them deltified, to the file C{f}. Return the
+    (binsha, crc32, offset) entries for its index, sorted, and the sha1
+    of the pack."""
+    h = hashlib.sha1()
+    entries = []
+    data = struct.pack('>4sII', b'PACK', 2, len(objects))
+    offset = 0
+    for sha1, (type_, content) in objects:
+        h.update(data)
+        f.write(data)
+        offset += len(data)
+        data = _pack_entry_header(type_, len(content))
+        data += zlib.compress(content, compression)
+        entries.append((
+            binascii.unhexlify(sha1),
+            zlib.crc32(data) & 0xffffffff,
+            offset,
+        ))
+    h.update(data)
+    f.write(data)
+    pack_sha = h.digest()
+    f.write(pack_sha)
+    entries.sort()
+    return entries, pack_sha
+
+
+def _pack_index(entries, pack_sha):
+    """Return the contents of a version 2 pack index for the given
+    (binsha, crc32, offset) entries, which must be sorted."""
+    fanout = [0] * 256
+    for binsha, _, _ in entries:
+        fanout[bytearray(binsha[:1])[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+    offsets = []
+    large_offsets = []
+    for _, _, offset in entries:
+        if offset < 0x80000000:
+            offsets.append(offset)
+        else:
+            offsets.append(0x80000000 | len(large_offsets))
+            large_offsets.append(offset)
+    n = len(entries)
+    idx = b''.join([
+        _PackIndex._magic,
+        struct.pack('>I', 2),
+        struct.pack('>256I', *fanout),
+        b''.join(binsha for binsha, _, _ in entries),
+        struct.pack('>%dI' % n, *(crc for _, crc, _ in entries)),
+        struct.pack('>%dI' % n, *offsets),
+        struct.pack('>%dQ' % len(large_offsets), *large_offsets),
+        pack_sha,
+    ])
+    return idx + hashlib.sha1(idx).digest()
+
+
+class ObjectDatabase(object):
+    """Reads objects straight out of a repository's object directory
+    and its alternates."""
+
+    _base_cache_size = 256
+    _base_cache_max_object = 1 << 20
+
+    def __init__(self, git_dir, compression=None, pack_compression=None):
+        self._dirs = self._object_dirs(git_dir)
+        # Like git, favor speed over size for loose objects by default.
+        if compression is None:
+            compression = zlib.Z_BEST_SPEED
+        if pack_compression is None:
+            pack_compression = zlib.Z_DEFAULT_COMPRESSION
+        self._compression = compression
+        self._pack_compression = pack_compression
+        self._umask = None
+        self._pending = None  # sha1 -> (type, content) while packing
+        self._packs = {}  # path -> _Pack
+        self._pack_dir_mtimes = {}
+        self._base_cache = {}
+        self._scan_packs()
+
+    @staticmethod
+    def _object_dirs(git_dir):
+        objdir = environ_get('GIT_OBJECT_DIRECTORY', None)
+        if not objdir:
+            common = os.path.join(git_dir, 'commondir')
+            if os.path.isfile(common):
+                with open(common) as f:
+                    git_dir = os.path.join(git_dir, f.read().strip())
+            objdir = os.path.join(git_dir, 'objects')
+        dirs = [objdir]
+        alternates = os.path.join(objdir, 'info', 'alternates')
+        if os.path.isfile(alternates):
+            with open(alternates) as f:
+                for line in f:
+                    line = line.strip()
+                    # Quoted paths and nested alternates are left to git.
+                    if not line or line.startswith(('#', '"')):
+                        continue
+                    dirs.append(os.path.normpath(os.path.join(objdir, line)))
+        return dirs
+
+    def _scan_packs(self):
+        """Open any pack files we haven't seen yet. Return true if the
+        pack directories changed since the last scan."""
+        changed = False
+        for d in self._dirs:
+            pack_dir = os.path.join(d, 'pack')
+            try:
+                mtime = os.stat(pack_dir).st_mtime
+            except OSError:
+                continue
+            if self._pack_dir_mtimes.get(pack_dir) == mtime:
+                continue
+            self._pack_dir_mtimes[pack_dir] = mtime
+            changed = True
+            for fn in sorted(os.listdir(pack_dir)):
+                path = os.path.join(pack_dir, fn)
+                if not fn.endswith('.pack') or path in self._packs:
+                    continue
+                try:
+                    self._packs[path] = _Pack(path)
+                except (EnvironmentError, ValueError):
+                    # Possibly a pack that's still being written; try
+                    # again on the next scan.
+                    pass
+        return changed
+
+    def _cache_base(self, key, obj):
+        """Remember a pack entry, since it's likely to be the base of other
+        deltas too. Big objects are not worth keeping around."""
+        if len(obj[1]) > self._base_cache_max_object:
+            return
+        if len(self._base_cache) >= self._base_cache_size:
+            self._base_cache.clear()
+        self._base_cache[key] = obj
+
+    def _read_loose(self, hexsha):
+        for d in self._dirs:
+            path = os.path.join(d, hexsha[:2], hexsha[2:])
+            try:
+                with open(path, 'rb') as f:
+                    raw = zlib.decompress(f.read())
+            except (EnvironmentError, zlib.error):
+                continue
+            header, content = raw.split(b'\0', 1)
+            type_, size = header.decode('ascii').split()
+            if int(size) != len(content):
+                continue
+            return type_, content
+        return None
+
+    def _read_packed(self, binsha):
+        for pack in self._packs.values():
+            offset = pack.index.find(binsha)
+            if offset is not None:
+                try:
+                    return pack.read(self, offset)
+                except (zlib.error, IndexError, struct.error):
+                    return None
+        return None
+
+    def read_binsha(self, binsha):
+        return self.read(binascii.hexlify(binsha).decode('ascii'))
+
+    def read(self, sha1):
+        """Return the (type, content) tuple of the given object, or
+        C{None} if it can't be read without help from git."""
+        if len(sha1) != 40:
+            return None
+        try:
+            binsha = binascii.unhexlify(sha1)
+        except (TypeError, ValueError):
+            return None
+        if self._pending and sha1 in self._pending:
+            return self._pending[sha1]
+        obj = self._read_packed(binsha) or self._read_loose(sha1)
+        if obj is None and self._scan_packs():
+            # The object may have been packed since we last looked.
+            obj = self._read_packed(binsha)
+        return obj
+
+    def _freshen(self, sha1, binsha):
+        """If the object exists, update its timestamp the way git does to
+        protect it from being pruned, and return true."""
+        paths = [os.path.join(self._dirs[0], sha1[:2], sha1[2:])]
+        paths.extend(
+            pack.path for pack in self._packs.values()
+            if pack.index.find(binsha) is not None
+        )
+        for path in paths:
+            try:
+                os.utime(path, None)
+                return True
+            except EnvironmentError:
+                pass
+        return False
+
+    def _get_umask(self):
+        if self._umask is None:
+            self._umask = os.umask(0)
+            os.umask(self._umask)
+        return self._umask
+
+    def write(self, type_, content):
+        """Write an object, unless it already exists. Return its sha1.
+
+        Between L{start_pack} and L{end_pack}, the object is only kept in
+        memory until the next L{checkpoint}."""
+        header = ('%s %d\0' % (type_, len(content))).encode('ascii')
+        h = hashlib.sha1(header)
+        h.update(content)
+        sha1 = h.hexdigest()
+        if self._pending is not None and sha1 in self._pending:
+            return sha1
+        if self._freshen(sha1, h.digest()):
+            return sha1
+        if self._pending is not None:
+            self._pending[sha1] = (type_, content)
+        else:
+            self._write_loose(sha1, header, content)
+        return sha1
+
+    def _write_loose(self, sha1, header, content):
+        obj_dir = os.path.join(self._dirs[0], sha1[:2])
+        if not os.path.isdir(obj_dir):
+            try:
+                os.mkdir(obj_dir)
+            except OSError:
+                # Somebody else may have created it in the meantime.
+                if not os.path.isdir(obj_dir):
+                    raise
+
+        # Write to a temporary file and rename it into place, so that
+        # nobody ever sees a half-written object.
+        fd, tmp = tempfile.mkstemp(prefix='tmp_obj_', dir=obj_dir)
+        try:
+            z = zlib.compressobj(self._compression)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(z.compress(header))
+                f.write(z.compress(content))
+                f.write(z.flush())
+            os.chmod(tmp, 0o444 & ~self._get_umask())
+            os.rename(tmp, os.path.join(obj_dir, sha1[2:]))
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def _write_pack(self, objects):
+        """Write the given (sha1, (type, content)) pairs to a new pack
+        file with its index, and start reading from it."""
+        pack_dir = os.path.join(self._dirs[0], 'pack')
+        if not os.path.isdir(pack_dir):
+            os.mkdir(pack_dir)
+        mode = 0o444 & ~self._get_umask()
+        fd, tmp_pack = tempfile.mkstemp(prefix='tmp_pack_', dir=pack_dir)
+        tmp_idx = None
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                entries, pack_sha = write_pack(
+                    f, objects, self._pack_compression
+                )
+            fd, tmp_idx = tempfile.mkstemp(prefix='tmp_idx_', dir=pack_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_pack_index(entries, pack_sha))
+            path = os.path.join(
+                pack_dir,
+                'pack-%s.pack' % binascii.hexlify(pack_sha).decode('ascii'),
+            )
+            # Like git, put the pack in place before its index, since
+            # readers look for the index.
+            for tmp, dst in [(tmp_pack, path),
+                             (tmp_idx, path[:-len('.pack')] + '.idx')]:
+                os.chmod(tmp, mode)
+                os.rename(tmp, dst)
+        except BaseException:
+            for tmp in [tmp_pack, tmp_idx]:
+                if tmp and os.path.exists(tmp):
+                    os.remove(tmp)
+            raise
+        if path not in self._packs:
+            self._packs[path] = _Pack(path)
+
+    def start_pack(self):
+        """Keep the objects written from now on in memory, so that
+        L{checkpoint} can write them out together. They can be read
+        back before that."""
+        if self._pending is None:
+            self._pending = OrderedDict()
+
+    def checkpoint(self, unpack_limit):
+        """Write out the objects collected since L{start_pack} or the last
+        checkpoint. Only if there are at least C{unpack_limit} of them do
+        they go into a pack file; fewer are written as loose objects,
+        since lots of tiny packs slow git down."""
+        pending = self._pending
+        if not pending:
+            return
+        if len(pending) >= unpack_limit:
+            self._write_pack(list(pending.items()))
+        else:
+            for sha1, (type_, content) in pending.items():
+                header = ('%s %d\0' % (type_, len(content))).encode('ascii')
+                self._write_loose(sha1, header, content)
+        self._pending = OrderedDict()
+
+    def end_pack(self, unpack_limit):
+        """Do a final L{checkpoint} and go back to writing loose
+        objects."""
+        self.checkpoint(unpack_limit)
+        self._pending = None
+
+    def close(self):
+        for pack in self._packs.values():
+            pack.close()
+        self._packs = {}
@@ -7,19 +7,30 @@ from __future__ import (
 )
 
 import atexit
+from collections import OrderedDict
+import io
+import mmap
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import os
 import re
+import shutil
 import signal
+import tempfile
 
 from stgit import utils
 from stgit.compat import environ_get
+from stgit.config import config
 from stgit.exception import StgException
 from stgit.lib.objcache import ObjectCache
 from stgit.run import Run, RunException
 from stgit.utils import add_dict
 
+from .commitcache import CommitCache
 from .iw import Index, IndexAndWorktree, MergeException, Worktree
-from .objects import Blob, Commit, Tree
+from .objects import Blob, Commit, CommitData, Tree
+from .odb import ObjectDatabase, object_sha1, write_pack
+from .treediff import diff_trees
 
 
 class RepositoryException(StgException):
@@ -34,34 +45,237 @@ class DetachedHeadException(RepositoryException):
         RepositoryException.__init__(self, 'Not on any branch')
 
 
+def _line_start(m, pos):
+    return m.rfind(b'\n', 0, pos) + 1
+
+
+def _packed_refs(path, prefix):
+    """Yield the (ref, sha1) pairs of all refs starting with C{prefix} in
+    the given C{packed-refs} file. If the file says it's sorted, which
+    it is unless it was written by a very old git, the first matching
+    ref is found with a binary search."""
+    try:
+        f = open(path, 'rb')
+    except EnvironmentError:
+        return
+    with f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        prefix = prefix.encode('utf-8')
+        pos = 0
+        sorted_ = False
+        if m[:1] == b'#':
+            pos = m.find(b'\n') + 1 or len(m)
+            sorted_ = b' sorted' in m[:pos]
+        if sorted_:
+            pos = _bisect_packed_refs(m, pos, prefix)
+        while pos < len(m):
+            end = m.find(b'\n', pos)
+            if end < 0:
+                end = len(m)
+            line = m[pos:end]
+            pos = end + 1
+            if line[:1] in (b'^', b'#') or len(line) < 42:
+                continue
+            ref = line[41:]
+            if ref.startswith(prefix):
+                yield ref.decode('utf-8'), line[:40].decode('ascii')
+            elif sorted_:
+                break
+    finally:
+        m.close()
+
+
+def _bisect_packed_refs(m, lo, prefix):
+    """Return the offset of the first line in the sorted part of the
+    packed-refs file C{m} starting at C{lo} whose ref name is not less
+    than C{prefix}."""
+    hi = len(m)
+    while lo < hi:
+        start = _line_start(m, (lo + hi) // 2)
+        if m[start:start + 1] == b'^' and start > lo:
+            # A peeled tag; the ref it belongs to is on the line above.
+            start = _line_start(m, start - 1)
+        end = m.find(b'\n', start)
+        if end < 0:
+            end = len(m)
+        if m[start + 41:end] < prefix:
+            lo = end + 1
+        else:
+            hi = start
+    return lo
+
+
+# Control characters, space, and the characters that mean something in
+# revisions or refspecs.
+_bad_ref_chars = re.compile(r'[\x00-\x20\x7f~^:?*\[\\]')
+
+
+def check_ref_format(ref):
+    """Return whether C{ref} is a valid ref name, by the rules of
+    C{git check-ref-format} without any options, but without running
+    git."""
+    if ref == '@' or ref.endswith('.'):
+        return False
+    components = ref.split('/')
+    if len(components) < 2:
+        return False
+    for c in components:
+        if not c or c.startswith('.') or c.endswith('.lock'):
+            return False
+    return not (
+        '..' in ref or '@{' in ref or _bad_ref_chars.search(ref)
+    )
+
+
 class Refs(object):
     """Accessor for the refs stored in a git repository. Will
-    transparently cache the values of all refs."""
+    transparently cache the values of the refs.
+
+    Refs are read straight from the C{packed-refs} file and the loose
+    ref files, and only one namespace (directory) at a time, so that
+    looking up a few refs doesn't cost time proportional to the number
+    of tags and remote refs in the repository. A cached namespace is
+    reread if the C{packed-refs} file or the namespace's directory has
+    changed.
+
+    Between L{start_transaction} and L{commit_transaction}, updates are
+    only queued up, and then all written in one go with the reflog
+    message given to L{commit_transaction}."""
+
+    # These refs are specific to each worktree; all others live in the
+    # common git directory.
+    _per_worktree = ('refs/bisect/', 'refs/worktree/', 'refs/rewritten/')
 
     def __init__(self, repository):
         self._repository = repository
-        self._refs = None
+        self._refs = {}
+        self._stamps = {}  # namespace -> stamp when it was read
+        self._queue = None  # ref -> sha1 before the transaction, or None
+
+    def _ref_dir(self, ref):
+        if ref.startswith(self._per_worktree):
+            return self._repository.directory
+        return self._repository.common_dir
+
+    def _stamp(self, namespace):
+        stamp = []
+        for path in [
+            os.path.join(self._ref_dir(namespace), 'packed-refs'),
+            os.path.join(self._ref_dir(namespace), namespace),
+        ]:
+            try:
+                st = os.stat(path)
+            except OSError:
+                stamp.append(None)
+            else:
+                stamp.append((st.st_mtime, st.st_size, st.st_ino))
+        return tuple(stamp)
 
-    def _ensure_refs_cache(self):
-        """(Re-)Build the cache of all refs in the repository."""
-        if self._refs is not None:
+    def _ensure_namespace(self, namespace):
+        """Make sure the cache has up-to-date values for all refs whose
+        names start with C{namespace}, which ends with a slash."""
+        if namespace in self._stamps and (
+            # The cache has the queued values during a transaction.
+            self._queue is not None
+            or self._stamps[namespace] == self._stamp(namespace)
+        ):
             return
-        self._refs = {}
-        runner = self._repository.run(['git', 'show-ref'])
+        stamp = self._stamp(namespace)
+        queued = dict(
+            (ref, self._refs.get(ref))
+            for ref in self._queue or ()
+            if ref.startswith(namespace)
+        )
+        for ref in [r for r in self._refs if r.startswith(namespace)]:
+            del self._refs[ref]
+        if config.get('extensions.refstorage') not in (None, 'files'):
+            self._refs.update(self._read_with_git(namespace))
+        else:
+            ref_dir = self._ref_dir(namespace)
+            self._refs.update(_packed_refs(
+                os.path.join(ref_dir, 'packed-refs'), namespace
+            ))
+            self._refs.update(self._read_loose(ref_dir, namespace))
+        for ref, sha1 in queued.items():
+            if sha1 is None:
+                self._refs.pop(ref, None)
+            else:
+                self._refs[ref] = sha1
+        self._stamps[namespace] = stamp
+
+    def _read_with_git(self, namespace):
+        runner = self._repository.run([
+            'git', 'for-each-ref', '--format=%(objectname) %(refname)',
+            namespace,
+        ])
         try:
             lines = runner.output_lines()
         except RunException:
-            # as this happens both in non-git trees and empty git
-            # trees, we silently ignore this error
+            # as this happens in non-git trees, we silently ignore this
+            # error
             return
         for line in lines:
-            m = re.match(r'^([0-9a-f]{40})\s+(\S+)$', line)
-            sha1, ref = m.groups()
-            self._refs[ref] = sha1
+            sha1, ref = line.split(' ', 1)
+            yield ref, sha1
+
+    def _read_loose(self, ref_dir, namespace):
+        """Yield the (ref, sha1) pairs of all loose refs in the
+        namespace."""
+        top = os.path.join(ref_dir, namespace)
+        for dirpath, _, filenames in os.walk(top):
+            prefix = namespace + os.path.relpath(dirpath, top) + '/'
+            if prefix.startswith(namespace + './'):
+                prefix = namespace
+            for fn in filenames:
+                if fn.endswith('.lock'):
+                    continue
+                sha1 = self._resolve_loose(ref_dir, prefix + fn)
+                if sha1:
+                    yield prefix + fn, sha1
+
+    def _resolve_loose(self, ref_dir, ref, depth=0):
+        """Return the sha1 the loose ref points to, following symbolic
+        refs, or C{None} if it can't be read."""
+        try:
+            with open(os.path.join(ref_dir, ref), 'rb') as f:
+                content = f.read(256).decode('utf-8').strip()
+        except (EnvironmentError, UnicodeDecodeError):
+            return None
+        if content.startswith('ref: ') and depth < 5:
+            target = content[len('ref: '):]
+            sha1 = self._resolve_loose(self._ref_dir(target), target,
+                                       depth + 1)
+            if sha1 is None:
+                for r, sha1 in _packed_refs(
+                    os.path.join(self._ref_dir(target), 'packed-refs'),
+                    target,
+                ):
+                    if r == target:
+                        break
+                else:
+                    sha1 = None
+            return sha1
+        if re.match(r'^[0-9a-f]{40}$', content):
+            return content
+        return None
+
+    @staticmethod
+    def _namespace(ref):
+        if not ref.startswith('refs/'):
+            raise KeyError(ref)
+        return ref.rsplit('/', 1)[0] + '/'
+
+    def namespace(self, prefix):
+        """Return the names of all refs whose names start with
+        C{prefix}, which should end with a slash."""
+        self._ensure_namespace(prefix)
+        return [ref for ref in self._refs if ref.startswith(prefix)]
 
     def __iter__(self):
-        self._ensure_refs_cache()
-        return iter(self._refs)
+        return iter(self.namespace('refs/'))
 
     def reset_cache(self):
         """Reset cached refs such that cache is rebuilt on next access.
@@ -70,12 +284,13 @@ class Refs(object):
         such as `git pull`.
 
         """
-        self._refs = None
+        self._refs = {}
+        self._stamps = {}
 
     def get(self, ref):
         """Get the Commit the given ref points to. Throws KeyError if ref
         doesn't exist."""
-        self._ensure_refs_cache()
+        self._ensure_namespace(self._namespace(ref))
         return self._repository.get_commit(self._refs[ref])
 
     def exists(self, ref):
@@ -90,10 +305,14 @@ class Refs(object):
     def set(self, ref, commit, msg):
         """Write the sha1 of the given Commit to the ref. The ref may or may
         not already exist."""
-        self._ensure_refs_cache()
+        self._ensure_namespace(self._namespace(ref))
         old_sha1 = self._refs.get(ref, '0' * 40)
         new_sha1 = commit.sha1
-        if old_sha1 != new_sha1:
+        if self._queue is not None:
+            self._queue.setdefault(ref, self._refs.get(ref))
+            self._refs[ref] = new_sha1
+        elif old_sha1 != new_sha1:
+            self._repository.checkpoint_objects()
             self._repository.run(
                 ['git', 'update-ref', '-m', msg, ref, new_sha1, old_sha1]
             ).no_output()
@@ -101,17 +320,130 @@ class Refs(object):
 
     def delete(self, ref):
         """Delete the given ref. Throws KeyError if ref doesn't exist."""
-        self._ensure_refs_cache()
-        self._repository.run(
-            ['git', 'update-ref', '-d', ref, self._refs[ref]]
-        ).no_output()
+        self._ensure_namespace(self._namespace(ref))
+        if self._queue is not None:
+            self._queue.setdefault(ref, self._refs[ref])
+        else:
+            self._repository.run(
+                ['git', 'update-ref', '-d', ref, self._refs[ref]]
+            ).no_output()
         del self._refs[ref]
 
+    def start_transaction(self):
+        """Queue up all ref updates from now on, until
+        L{commit_transaction} or L{abort_transaction} is called. The
+        new values are visible through this object right away."""
+        assert self._queue is None
+        self._queue = OrderedDict()
+
+    def commit_transaction(self, msg=None):
+        """Write all queued ref updates with a single C{git update-ref
+        --stdin}. Either all of them are made, or none is, and only if
+        none of the refs was changed behind our back in the meantime."""
+        queue, self._queue = self._queue, None
+        lines = []
+        for ref, old_sha1 in queue.items():
+            new_sha1 = self._refs.get(ref)
+            if new_sha1 == old_sha1:
+                if old_sha1 is not None:
+                    lines.append('verify %s %s\n' % (ref, old_sha1))
+            elif new_sha1 is None:
+                lines.append('delete %s %s\n' % (ref, old_sha1))
+            else:
+                lines.append('update %s %s %s\n'
+                             % (ref, new_sha1, old_sha1 or '0' * 40))
+        if not any(line.startswith(('update', 'delete')) for line in lines):
+            return
+        self._repository.checkpoint_objects()
+        args = ['git', 'update-ref']
+        if msg is not None:
+            args.extend(['-m', msg])
+        try:
+            self._repository.run(args + ['--stdin']).raw_input(
+                ''.join(lines)
+            ).discard_output()
+        except RunException:
+            self.reset_cache()
+            raise RepositoryException('Failed to update refs')
+
+    def abort_transaction(self):
+        """Forget all queued ref updates."""
+        if self._queue is not None:
+            self._queue = None
+            self.reset_cache()
+
+
+class PipeReader(object):
+    """Buffered reader for the stdout pipe of a long-running git helper
+    process.
+
+    Data is read into one growable buffer, in chunks that grow while
+    the pipe keeps filling them, and consumed data is only dropped
+    from the front of the buffer once it makes up half of it. Reading
+    an object of size I{n} is thus O(I{n}), unlike repeatedly
+    concatenating C{bytes} objects."""
+
+    min_chunk = 4096
+    max_chunk = 1 << 20
+
+    def __init__(self, fd):
+        self._fd = fd
+        self._buf = bytearray()
+        self._pos = 0
+        self._chunk = self.min_chunk
+
+    def _fill(self):
+        data = os.read(self._fd, self._chunk)
+        if not data:
+            raise RepositoryException('Unexpected end of git output')
+        if len(data) == self._chunk:
+            self._chunk = min(2 * self._chunk, self.max_chunk)
+        self._buf += data
+
+    def _consume(self, n):
+        self._pos += n
+        if self._pos > len(self._buf) // 2:
+            del self._buf[:self._pos]
+            self._pos = 0
+
+    def read_line(self):
+        """Return the next line, without its trailing newline."""
+        start = self._pos
+        while True:
+            i = self._buf.find(b'\n', start)
+            if i >= 0:
+                break
+            start = len(self._buf)
+            self._fill()
+        line = bytes(self._buf[self._pos:i])
+        self._consume(i + 1 - self._pos)
+        return line
+
+    def read(self, size):
+        """Return exactly C{size} bytes."""
+        while len(self._buf) - self._pos < size:
+            self._fill()
+        data = bytes(self._buf[self._pos:self._pos + size])
+        self._consume(size)
+        return data
+
+    def read_until(self, *ends):
+        """Read until the pipe has no more data buffered for us and what we
+        have ends with one of C{ends}, and return all of it."""
+        while not (
+            len(self._buf) > self._pos and self._buf.endswith(ends)
+        ):
+            self._fill()
+        data = bytes(self._buf[self._pos:])
+        self._consume(len(self._buf) - self._pos)
+        return data
+
 
 class CatFileProcess(object):
     def __init__(self, repo):
         self._repository = repo
         self._proc = None
+        self._reader = None
         atexit.register(self._shutdown)
 
     def _get_process(self):
@@ -119,6 +451,7 @@ class CatFileProcess(object):
             self._proc = self._repository.run(
                 ['git', 'cat-file', '--batch']
             ).run_background()
+            self._reader = PipeReader(self._proc.stdout.fileno())
         return self._proc
 
     def _shutdown(self):
@@ -127,29 +460,51 @@ class CatFileProcess(object):
             os.kill(self._proc.pid(), signal.SIGTERM)
             self._proc.wait()
 
-    def cat_file(self, sha1):
+    # Number of requests written to cat-file before reading back the
+    # replies. Must be small enough that the requests fit in the pipe
+    # buffer, or we could deadlock against cat-file's output.
+    _batch_size = 512
+
+    def _read_reply(self):
+        """Read one reply from the cat-file process. Return the reply
+        header and the object contents."""
+        header = self._reader.read_line().decode('utf-8').split()
+        if len(header) != 3:
+            # "<object> missing" or "<object> ambiguous"
+            return header, None
+        content = self._reader.read(int(header[2]))
+        # Skip the newline following the object contents.
+        self._reader.read(1)
+        return header, content
+
+    def cat_files(self, sha1s):
+        """Read the given objects, writing requests for several of them
+        to cat-file before reading back the replies. Return a list of
+        (type, content) tuples in the same order as C{sha1s}."""
+        sha1s = list(sha1s)
+        if not sha1s:
+            return []
         p = self._get_process()
-        p.stdin.write('%s\n' % sha1)
-        p.stdin.flush()
+        objects = []
+        missing = []
+        for i in range(0, len(sha1s), self._batch_size):
+            batch = sha1s[i:i + self._batch_size]
+            p.stdin.write(''.join('%s\n' % sha1 for sha1 in batch))
+            p.stdin.flush()
+            for sha1 in batch:
+                header, content = self._read_reply()
+                if content is None:
+                    missing.append(sha1)
+                    objects.append(None)
+                else:
+                    objects.append((header[1], content))
+        if missing:
+            raise RepositoryException('Cannot cat %s' % ', '.join(missing))
+        return objects
 
-        # Read until we have the entire status line.
-        s = b''
-        while b'\n' not in s:
-            s += os.read(p.stdout.fileno(), 4096)
-        h, b = s.split(b'\n', 1)
-        header = h.decode('utf-8')
-        if header == '%s missing' % sha1:
-            raise RepositoryException('Cannot cat %s' % sha1)
-        name, type_, size = header.split()
-        assert name == sha1
-        size = int(size)
-
-        # Read until we have the entire object plus the trailing
-        # newline.
-        while len(b) < size + 1:
-            b += os.read(p.stdout.fileno(), 4096)
-        content = b[:size]
-        return type_, content
+    def cat_file(self, sha1):
+        [obj] = self.cat_files([sha1])
+        return obj
 
 
 class DiffTreeProcesses(object):
@@ -161,30 +516,46 @@ class DiffTreeProcesses(object):
     def _get_process(self, args):
         args = tuple(args)
         if args not in self._procs:
-            self._procs[args] = self._repository.run(
+            p = self._repository.run(
                 ['git', 'diff-tree', '--stdin'] + list(args)
             ).run_background()
+            self._procs[args] = (p, PipeReader(p.stdout.fileno()))
         return self._procs[args]
 
     def _shutdown(self):
-        for p in self._procs.values():
+        for p, reader in self._procs.values():
             os.kill(p.pid(), signal.SIGTERM)
             p.wait()
 
     def diff_trees(self, args, sha1a, sha1b):
-        p = self._get_process(args)
+        p, reader = self._get_process(args)
         query = ('%s %s\n' % (sha1a, sha1b)).encode('utf-8')
         end = b'EOF\n'  # arbitrary string that's not a 40-digit hex number
         os.write(p.stdin.fileno(), query + end)
         p.stdin.flush()
-        data = bytes()
-        while not (data.endswith(b'\n' + end) or data.endswith(b'\0' + end)):
-            data += os.read(p.stdout.fileno(), 4096)
+        data = reader.read_until(b'\n' + end, b'\0' + end)
         assert data.startswith(query)
         assert data.endswith(end)
         return data[len(query):-len(end)]
 
 
+# The version of git, as a tuple of integers. Looked up at most once.
+_git_version = []
+
+
+def git_version():
+    """Return the version of the git we're running, as a tuple of
+    integers such as C{(2, 38)}."""
+    if not _git_version:
+        m = re.search(
+            r'(\d+)\.(\d+)', Run('git', '--version').output_one_line()
+        )
+        _git_version.append(
+            (int(m.group(1)), int(m.group(2))) if m else (0, 0)
+        )
+    return _git_version[0]
+
+
 class Repository(object):
     """Represents a git repository."""
 
@@ -192,13 +563,26 @@ class Repository(object):
         self._git_dir = directory
         self.refs = Refs(self)
         self._blobs = ObjectCache(lambda sha1: Blob(self, sha1))
-        self._trees = ObjectCache(lambda sha1: Tree(self, sha1))
-        self._commits = ObjectCache(lambda sha1: Commit(self, sha1))
+        max_loaded = config.getint('stgit.objectcachesize')
+        self._trees = ObjectCache(
+            lambda sha1: Tree(self, sha1), 'trees', max_loaded, Tree.unload
+        )
+        self._commits = ObjectCache(
+            lambda sha1: Commit(self, sha1), 'commits', max_loaded,
+            Commit.unload,
+        )
         self._default_index = None
         self._default_worktree = None
         self._default_iw = None
         self._catfile = CatFileProcess(self)
         self._difftree = DiffTreeProcesses(self)
+        self._odb = None
+        self._packing = None
+        self._batch = None  # sha1 -> (type, content) while batching
+        self._common_dir = None
+        self._commit_cache = None
+        self._merge_tree_enabled = None
+        self._last_merge_tree = None
 
     @property
     def env(self):
@@ -263,12 +647,238 @@ class Repository(object):
     def directory(self):
         return self._git_dir
 
+    @property
+    def common_dir(self):
+        """The git directory shared by all worktrees of the repository."""
+        if self._common_dir is None:
+            common = os.path.join(self._git_dir, 'commondir')
+            if os.path.isfile(common):
+                with open(common) as f:
+                    self._common_dir = os.path.join(
+                        self._git_dir, f.read().strip()
+                    )
+            else:
+                self._common_dir = self._git_dir
+        return self._common_dir
+
     def run(self, args, env=()):
+        # Objects we have only collected in memory so far must be
+        # written out before git can see them.
+        self.checkpoint_objects()
         return Run(*args).env(add_dict(self.env, env))
 
+    @property
+    def odb(self):
+        """An L{ObjectDatabase} reading and writing objects directly on
+        disk, or C{None} if that's disabled with the
+        C{stgit.nativeobjects} config option.
+
+        It's also disabled if there are replace refs, since git applies
+        those when reading objects, and in repositories that don't use
+        SHA-1 object names."""
+        if self._odb is None:
+            object_format = config.get('extensions.objectformat')
+            if (
+                config.getbool('stgit.nativeobjects')
+                and object_format in (None, 'sha1')
+                and not self.refs.namespace('refs/replace/')
+            ):
+                level, pack_level = [
+                    config.get(name) or config.get('core.compression')
+                    for name in ['core.loosecompression', 'pack.compression']
+                ]
+                self._odb = ObjectDatabase(
+                    self._git_dir,
+                    int(level) if level else None,
+                    int(pack_level) if pack_level else None,
+                )
+            else:
+                self._odb = False
+        return self._odb or None
+
+    @property
+    def commit_cache(self):
+        """The L{CommitCache} keeping parsed commits between StGit
+        invocations, or C{None} if it's disabled by setting
+        C{stgit.commitcachesize} to 0 or can't be used.
+
+        Like L{odb}, it's also disabled if there are replace refs, since
+        git applies those when reading objects."""
+        if self._commit_cache is None:
+            size = config.getint('stgit.commitcachesize')
+            cache = None
+            if size != 0 and not self.refs.namespace('refs/replace/'):
+                cache = CommitCache.open(self.common_dir, size)
+            if cache is None:
+                self._commit_cache = False
+            else:
+                atexit.register(cache.close)
+                self._commit_cache = cache
+        return self._commit_cache or None
+
+    def cached_commit_fields(self, sha1):
+        """Return what L{CommitData.parse_fields} said about the given
+        commit in this or an earlier StGit invocation, or C{None}."""
+        cache = self.commit_cache
+        return cache.get(sha1) if cache else None
+
+    def cache_commit_fields(self, sha1, fields):
+        """Remember what L{CommitData.parse_fields} said about a commit
+        for later StGit invocations."""
+        cache = self.commit_cache
+        if cache:
+            cache.add(sha1, *fields)
+
     def cat_object(self, sha1):
+        if self._batch and sha1 in self._batch:
+            return self._batch[sha1]
+        odb = self.odb
+        if odb:
+            obj = odb.read(sha1)
+            if obj is not None:
+                return obj
+        self._checkpoint_for_catfile([sha1])
         return self._catfile.cat_file(sha1)
 
+    def cat_objects(self, sha1s):
+        """Read several objects in one batch. Return a list of (type,
+        content) tuples in the same order as C{sha1s}."""
+        sha1s = list(sha1s)
+        odb = self.odb
+        if odb:
+            objects = [odb.read(sha1) for sha1 in sha1s]
+        else:
+            objects = [None] * len(sha1s)
+        if self._batch:
+            objects = [
+                self._batch.get(sha1) if obj is None else obj
+                for sha1, obj in zip(sha1s, objects)
+            ]
+        missing = [sha1 for sha1, obj in zip(sha1s, objects) if obj is None]
+        if missing:
+            self._checkpoint_for_catfile(missing)
+            fetched = iter(self._catfile.cat_files(missing))
+            objects = [
+                next(fetched) if obj is None else obj for obj in objects
+            ]
+        return objects
+
+    def _checkpoint_for_catfile(self, names):
+        """Objects we have only collected in memory are read back from
+        there when asked for by name, but a name like
+        C{I{commit}:I{path}} is looked up by C{git cat-file}, which
+        can't see them; write them out first."""
+        if any(':' in name for name in names):
+            self.checkpoint_objects()
+
+    def prefetch_commits(self, commits, others=()):
+        """Read the data of all the given L{Commit}s that haven't been read
+        yet in one batch, so that accessing C{commit.data} later on
+        doesn't have to wait for git once per commit.
+
+        Any other object names in C{others} are read in the same batch;
+        their (type, content) tuples are returned in order."""
+        todo = []
+        seen = set()
+        for c in commits:
+            if c._data is None and c not in seen:
+                seen.add(c)
+                if not c._set_cached_data():
+                    todo.append(c)
+        others = list(others)
+        objects = self.cat_objects([c.sha1 for c in todo] + others)
+        for c, (type_, content) in zip(todo, objects):
+            c._set_data(type_, content)
+        return objects[len(todo):]
+
+    def write_object(self, type_, content):
+        """Write an object straight into the object database, or add it to
+        the batch started by L{start_object_batch}. Return its sha1, or
+        C{None} if that's disabled and the caller needs to ask git to do
+        it instead."""
+        if self._batch is not None:
+            sha1 = object_sha1(type_, content)
+            self._batch[sha1] = (type_, content)
+            return sha1
+        if not self._native_writes_enabled:
+            return None
+        return self.odb.write(type_, content)
+
+    @property
+    def write_object_enabled(self):
+        """Whether L{write_object} will write objects, so that it's worth
+        making up their raw contents."""
+        return self._batch is not None or self._native_writes_enabled
+
+    @property
+    def _native_writes_enabled(self):
+        # Leave getting the permissions of shared repositories right to
+        # git.
+        return (
+            self.odb is not None
+            and not config.get('core.sharedrepository')
+        )
+
+    def start_object_pack(self):
+        """Collect the objects written from now on in memory, and write
+        them out together when L{checkpoint_objects} is called. If there
+        are enough of them (C{stgit.unpacklimit}), they go into a single
+        pack file instead of lots of loose objects.
+
+        Objects written this way can be read back through this
+        L{Repository} right away, but git won't see them until the next
+        checkpoint, which is done automatically before any ref is
+        updated."""
+        if self._native_writes_enabled and not self._packing:
+            if self._packing is None:
+                atexit.register(self.end_object_pack)
+            self._packing = True
+            self.odb.start_pack()
+
+    def start_object_batch(self):
+        """Like L{start_object_pack}, but for when objects can't be
+        written natively: collect the objects written from now on in
+        memory, and hand them all to one C{git unpack-objects} when
+        L{checkpoint_objects} is called, instead of running C{git
+        hash-object}, C{git mktree} or C{git commit-tree} for each of
+        them.
+
+        Nothing changes if objects are written natively anyway, or if
+        the repository doesn't name its objects by SHA-1."""
+        if (
+            self._batch is None
+            and not self._native_writes_enabled
+            and config.get('extensions.objectformat') in (None, 'sha1')
+        ):
+            self._batch = OrderedDict()
+
+    def checkpoint_objects(self):
+        """Write out any objects collected since L{start_object_pack} or
+        L{start_object_batch}."""
+        if self._packing:
+            self.odb.checkpoint(config.getint('stgit.unpacklimit'))
+        if self._batch:
+            objects = list(self._batch.items())
+            self._batch.clear()
+            f = io.BytesIO()
+            write_pack(f, objects, 1)
+            p = self.run(['git', 'unpack-objects', '-q']).encoding(None)
+            p.raw_input(f.getvalue()).no_output()
+
+    def end_object_pack(self):
+        """Write out any collected objects and go back to writing each
+        object as it's created."""
+        if self._packing:
+            self._packing = False
+            self.odb.end_pack(config.getint('stgit.unpacklimit'))
+
+    def end_object_batch(self):
+        """Hand any objects collected since L{start_object_batch} to git,
+        and go back to writing each object as it's created."""
+        if self._batch is not None:
+            self.checkpoint_objects()
+            self._batch = None
+
     def rev_parse(self, rev, discard_stderr=False, object_type='commit'):
         assert object_type in ('commit', 'tree', 'blob')
         getter = getattr(self, 'get_' + object_type)
@@ -297,6 +907,14 @@ class Repository(object):
             Commit.typename: self.get_commit,
         }[type](sha1)
 
+    def object_data_used(self, obj, loaded):
+        """Called by L{Tree} and L{Commit} objects whenever their data is
+        used, and whether it had to be loaded first."""
+        if obj.typename == Commit.typename:
+            self._commits.used(obj.sha1, loaded)
+        else:
+            self._trees.used(obj.sha1, loaded)
+
     def commit(self, objectdata):
         return objectdata.commit(self)
 
@@ -328,6 +946,51 @@ class Repository(object):
             .raw_output()
         )
 
+    @property
+    def merge_tree_enabled(self):
+        """Whether L{merge_tree} can be used. It needs git 2.38 or later,
+        and can be turned off with the C{stgit.mergetree} config
+        option."""
+        if self._merge_tree_enabled is None:
+            self._merge_tree_enabled = (
+                config.getbool('stgit.mergetree')
+                and git_version() >= (2, 38)
+            )
+        return self._merge_tree_enabled
+
+    def merge_tree(self, base, ours, theirs):
+        """Do a three-way merge of the L{Tree}s C{base}, C{ours} and
+        C{theirs} with C{git merge-tree}, without using an index or a
+        worktree. Return the resulting L{Tree}, or C{None} if there were
+        conflicts."""
+        assert self.merge_tree_enabled
+        key = (base, ours, theirs)
+        if self._last_merge_tree and self._last_merge_tree[0] == key:
+            # A failed merge is often retried in the worktree right
+            # away.
+            return self._last_merge_tree[1]
+        if git_version() >= (2, 45):
+            args = ['--merge-base=' + base.sha1, ours.sha1, theirs.sha1]
+        else:
+            # Older versions only merge commits, so make some up.
+            parent = self.commit(
+                CommitData(tree=base, parents=[], message='base')
+            )
+            args = [
+                self.commit(
+                    CommitData(tree=tree, parents=[parent], message=name)
+                ).sha1
+                for tree, name in [(ours, 'current'), (theirs, 'patched')]
+            ]
+        r = self.run(
+            ['git', 'merge-tree', '--write-tree', '--no-messages'] + args
+        )
+        r.returns([0, 1])
+        output = r.output_lines()
+        result = None if r.exitcode else self.get_tree(output[0])
+        self._last_merge_tree = (key, result)
+        return result
+
     def simple_merge(self, base, ours, theirs):
         index = self.temp_index()
         try:
@@ -354,6 +1017,60 @@ class Repository(object):
         finally:
             index.delete()
 
+    def check_apply(self, tree, patches, three_way=False):
+        """Tell whether each of the given patches applies cleanly to the
+        L{Tree} C{tree} on its own. Return a list of booleans.
+
+        Every patch is applied in a temporary index of its own, with as
+        many C{git apply} processes running at a time as there are CPUs.
+        With C{three_way}, patches only fail to apply if a three-way
+        merge would conflict (this needs git 2.32 or later to be of any
+        use).
+
+        Nothing is written to the repository: C{git apply} gets a
+        scratch object directory for the objects a three-way merge
+        makes, which is thrown away afterwards."""
+        assert isinstance(tree, Tree)
+        objdir = ObjectDatabase._object_dirs(self._git_dir)[0]
+        alternates = [os.path.abspath(objdir)]
+        extra = environ_get('GIT_ALTERNATE_OBJECT_DIRECTORIES', None)
+        if extra:
+            alternates.append(extra)
+        scratch = tempfile.mkdtemp(prefix='objects.temp-', dir=self._git_dir)
+        env = {
+            'GIT_OBJECT_DIRECTORY': os.path.abspath(scratch),
+            'GIT_ALTERNATE_OBJECT_DIRECTORIES': os.pathsep.join(alternates),
+        }
+
+        def applies(patch_bytes):
+            index = self.temp_index()
+            try:
+                index.read_tree(tree)
+                index.apply(
+                    patch_bytes, quiet=True, three_way=three_way, env=env
+                )
+                return True
+            except MergeException:
+                return False
+            finally:
+                index.delete()
+
+        patches = list(patches)
+        try:
+            if len(patches) < 2:
+                return [applies(p) for p in patches]
+            # Write out any pending objects here, rather than
+            # concurrently from all the threads.
+            self.checkpoint_objects()
+            pool = ThreadPool(min(len(patches), cpu_count()))
+            try:
+                return pool.map(applies, patches)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
     def submodules(self, tree):
         """Given a L{Tree}, return list of paths which are submodules."""
         assert isinstance(tree, Tree)
@@ -389,6 +1106,7 @@ class Repository(object):
         if pathlimits:
             args.append('--')
             args.extend(pathlimits)
+        self.checkpoint_objects()
         return self._difftree.diff_trees(args, t1.sha1, t2.sha1)
 
     def diff_tree_files(self, t1, t2):
@@ -397,39 +1115,35 @@ class Repository(object):
         file mode, the new file mode, the old blob, the new blob, the
         status, the old filename, and the new filename. Except in case
         of a copy or a rename, the old and new filenames are
-        identical."""
+        identical.
+
+        The trees are compared in-process by L{diff_trees}, which
+        doesn't detect copies or renames."""
         assert isinstance(t1, Tree)
         assert isinstance(t2, Tree)
-        dt = self._difftree.diff_trees(['-r', '-z'], t1.sha1, t2.sha1)
-        i = iter(dt.decode('utf-8').split('\0'))
-        try:
-            while True:
-                x = next(i)
-                if not x:
-                    continue
-                omode, nmode, osha1, nsha1, status = x[1:].split(' ')
-                fn1 = next(i)
-                if status[0] in ['C', 'R']:
-                    fn2 = next(i)
-                else:
-                    fn2 = fn1
-                yield (
-                    omode,
-                    nmode,
-                    self.get_blob(osha1),
-                    self.get_blob(nsha1),
-                    status,
-                    fn1,
-                    fn2,
-                )
-        except StopIteration:
-            pass
+        for omode, nmode, osha1, nsha1, status, fn in diff_trees(t1, t2):
+            yield (
+                omode,
+                nmode,
+                self.get_blob(osha1),
+                self.get_blob(nsha1),
+                status,
+                fn,
+                fn,
+            )
 
     def repack(self):
         """Repack all objects into a single pack."""
         self.run(['git', 'repack', '-a', '-d', '-f']).run()
 
-    def copy_notes(self, old_sha1, new_sha1):
-        """Copy git notes from the old object to the new one."""
-        p = self.run(['git', 'notes', 'copy', old_sha1, new_sha1])
+    def copy_notes(self, rewrites):
+        """Copy git notes from old objects to new ones, given as (old
+        sha1, new sha1) pairs, with a single C{git notes copy}. Nothing
+        is run if there are no notes refs at all."""
+        rewrites = list(rewrites)
+        if not rewrites or not self.refs.namespace('refs/notes/'):
+            return
+        self.checkpoint_objects()
+        p = self.run(['git', 'notes', 'copy', '--stdin'])
+        p.raw_input(''.join('%s %s\n' % r for r in rewrites))
         p.discard_exitcode().discard_stderr().discard_output()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Comparing git trees without running git diff-tree.
+
+L{diff_trees} walks two L{Tree}s side by side, the way C{git diff-tree
+-r} does, and yields the files that differ. Subtrees with the same
+sha1 on both sides are skipped without being read, so comparing two
+big trees only costs as much as the parts of them that actually
+changed."""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals,
+)
+
+from .objects import Tree
+
+NULL_MODE = '000000'
+NULL_SHA1 = '0' * 40
+
+
+def _sorted_entries(tree):
+    """Return the entries of a tree (or of no tree at all) as (key, name,
+    permission, sha1) tuples, in the order git sorts them: by name, with
+    subtrees sorted as if their names ended with a slash."""
+    if tree is None:
+        return []
+    entries = [
+        (name + '/' if perm == Tree.default_perm else name, name, perm, sha1)
+        for name, perm, sha1 in tree.data.sha1_entries()
+    ]
+    entries.sort()
+    return entries
+
+
+def _file_type(perm):
+    return int(perm, 8) & 0o170000
+
+
+def diff_trees(t1, t2, prefix=''):
+    """Yield an (old mode, new mode, old sha1, new sha1, status, path)
+    tuple for every file that differs between the L{Tree}s C{t1} and
+    C{t2}, in the same order as C{git diff-tree -r}. Either tree may be
+    C{None}, meaning an empty tree.
+
+    The status is C{A} for added files, C{D} for deleted ones, C{T} if
+    the type changed (for example from a file to a symlink), and C{M}
+    for all other changes. Added and deleted files have the mode
+    L{NULL_MODE} and sha1 L{NULL_SHA1} on the side they are missing
+    from."""
+    if t1 is t2:
+        return
+    repository = (t1 or t2)._repository
+    old = _sorted_entries(t1)
+    new = _sorted_entries(t2)
+    i = j = 0
+    while i < len(old) or j < len(new):
+        if j == len(new) or (i < len(old) and old[i][0] < new[j][0]):
+            o, n = old[i], None
+            i += 1
+        elif i == len(old) or new[j][0] < old[i][0]:
+            o, n = None, new[j]
+            j += 1
+        else:
+            o, n = old[i], new[j]
+            i += 1
+            j += 1
+            if o[2:] == n[2:]:
+                continue
+        key, name, perm, sha1 = o or n
+        if key.endswith('/'):
+            # The same key on both sides means both are trees.
+            subtrees = [
+                repository.get_tree(e[3]) if e else None for e in (o, n)
+            ]
+            for d in diff_trees(
+                subtrees[0], subtrees[1], prefix + name + '/'
+            ):
+                yield d
+            continue
+        if o is None:
+            status = 'A'
+        elif n is None:
+            status = 'D'
+        elif _file_type(o[2]) != _file_type(n[2]):
+            status = 'T'
+        else:
+            status = 'M'
+        yield (
+            o[2] if o else NULL_MODE,
+            n[2] if n else NULL_MODE,
+            o[3] if o else NULL_SHA1,
+            n[3] if n else NULL_SHA1,
+            status,
+            prefix + name,
+        )
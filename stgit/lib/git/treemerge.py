@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""Three-way merging of git trees without an index file.
+
+When pushing a patch, the changes it makes and the changes made below
+it usually touch different files. L{merge_trees} handles that case
+without any git subprocess, by taking every entry from whichever side
+changed it and writing new trees only for the directories that need
+them. As soon as the same path has changed differently on both sides,
+it gives up, and the caller has to merge the trees some other way.
+
+A L{Rebase} does the same for a whole series of stacked patches that
+is moved onto a new base."""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals,
+)
+
+from bisect import bisect_left
+
+from stgit.run import add_profile_stats
+
+from .objects import Tree, TreeData
+
+# How many merges were done in memory, how many had to fall back, and
+# how many trees were moved by a L{Rebase}.
+_counts = {'memory': 0, 'fallback': 0, 'rebased': 0}
+
+
+def _entries(tree):
+    if tree is None:
+        return {}
+    return dict(
+        ((name, perm == Tree.default_perm), (perm, sha1))
+        for name, perm, sha1 in tree.data.sha1_entries()
+    )
+
+
+def _merge(repository, base, ours, theirs, write=True):
+    """Merge three L{Tree}s, any of which may be C{None} for a missing
+    tree. Return the merged L{Tree}, C{None} if it's empty, or C{False}
+    if the same path changed differently in C{ours} and C{theirs}. If
+    C{write} is false, no trees are written, and C{True} stands in for
+    a merged tree that isn't one of C{ours} and C{theirs}."""
+    trees = [_entries(t) for t in (base, ours, theirs)]
+    keys = set()
+    for t in trees:
+        keys.update(t)
+    merged = {}
+    names = set()
+    for key in keys:
+        b, o, t = [entries.get(key) for entries in trees]
+        if o == t or b == t:
+            m = o
+        elif b == o:
+            m = t
+        elif key[1]:
+            # Both sides changed the same directory; merge it too.
+            sub = _merge(
+                repository,
+                *[repository.get_tree(e[1]) if e else None for e in (b, o, t)],
+                write=write
+            )
+            if sub is False:
+                return False
+            m = sub and (Tree.default_perm, sub.sha1 if write else sub)
+        else:
+            return False
+        if m is None:
+            continue
+        name = key[0]
+        if name in names:
+            # A file and a directory with the same name.
+            return False
+        names.add(name)
+        merged[key] = m
+    if not merged:
+        return None
+    for side, entries in [(ours, trees[1]), (theirs, trees[2])]:
+        if merged == entries:
+            return side
+    if not write:
+        return True
+    return _commit(repository, merged)
+
+
+def _commit(repository, entries):
+    return TreeData.from_sha1_entries(
+        repository,
+        ((name, perm, sha1) for (name, _), (perm, sha1) in entries.items()),
+    ).commit(repository)
+
+
+def merge_trees(repository, base, ours, theirs):
+    """Do a three-way merge of the L{Tree}s C{base}, C{ours} and
+    C{theirs} in memory. Return the resulting L{Tree}, or C{None} if the
+    trees can't be merged this way because both C{ours} and C{theirs}
+    changed the same path."""
+    result = _merge(repository, base, ours, theirs)
+    if result is False:
+        _counts['fallback'] += 1
+        return None
+    _counts['memory'] += 1
+    if result is None:
+        result = TreeData({}).commit(repository)
+    return result
+
+
+def can_merge_trees(repository, base, ours, theirs):
+    """Tell whether L{merge_trees} would merge the L{Tree}s C{base},
+    C{ours} and C{theirs}, without writing any tree objects."""
+    return _merge(repository, base, ours, theirs, write=False) is not False
+
+
+def _raw_entries(content):
+    """Split the contents of a raw git tree object into entries. Return
+    the keys git sorts the entries by, which are their names with a
+    slash added for subtrees, and the offsets where they start,
+    followed by the end of the tree."""
+    keys = []
+    starts = []
+    find = content.find
+    pos = 0
+    end = len(content)
+    while pos < end:
+        sp = find(b' ', pos)
+        nul = find(b'\0', sp)
+        name = content[sp + 1:nul]
+        keys.append(name + b'/' if content[pos:sp] == b'40000' else name)
+        starts.append(pos)
+        pos = nul + 21
+    starts.append(end)
+    return keys, starts
+
+
+class Rebase(object):
+    """Moves the L{Tree}s of a series of patches from one base tree to
+    another in memory.
+
+    When a series of stacked patches is pushed onto a new base, most of
+    them usually change other paths than what changed between the old
+    and the new base. Merging each of them on its own reads and
+    compares all three trees every time; here the top-level entries
+    that changed between the bases are found once, and each patch tree
+    only has to be checked against those and have them replaced in its
+    raw contents."""
+
+    def __init__(self, repository, old_base, new_base):
+        self._repository = repository
+        self._old_base = old_base
+        self._new_base = new_base
+        # The keys of the changed entries, with their raw entries in
+        # the old and the new base, or None where they're missing.
+        self._changes = []
+        # The keys that mustn't be in a tree for the entries the new
+        # base adds, since they are files and directories of the same
+        # names.
+        self._clashes = []
+        if old_base == new_base:
+            return
+        old, new = [self._raw_entry_map(t) for t in (old_base, new_base)]
+        for key in sorted(set(old) | set(new)):
+            if old.get(key) != new.get(key):
+                self._changes.append((key, old.get(key), new.get(key)))
+        changed = set(key for key, _, _ in self._changes)
+        for key, _, e in self._changes:
+            other = key[:-1] if key.endswith(b'/') else key + b'/'
+            if e is not None and other not in changed:
+                self._clashes.append(other)
+
+    def _raw(self, tree):
+        type_, content = self._repository.cat_object(tree.sha1)
+        assert type_ == Tree.typename, (
+            'expected "tree", got "%s" for %s' % (type_, tree.sha1)
+        )
+        return content
+
+    def _raw_entry_map(self, tree):
+        content = self._raw(tree)
+        keys, starts = _raw_entries(content)
+        return dict(
+            (key, content[starts[i]:starts[i + 1]])
+            for i, key in enumerate(keys)
+        )
+
+    def rebase(self, tree):
+        """Return the L{Tree} C{tree}, which is based on the old base,
+        moved onto the new base. Return C{None} if C{tree} changed
+        something that also changed between the bases; the patch then
+        needs a real merge, and the trees of the patches stacked on it
+        need another L{Rebase}."""
+        if not self._changes:
+            return tree
+        if tree == self._old_base:
+            return self._new_base
+        content = self._raw(tree)
+        keys, starts = _raw_entries(content)
+        if keys != sorted(keys):
+            # Not written by git; leave it to a real merge.
+            return None
+        for key in self._clashes:
+            i = bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                return None
+        pieces = []
+        pos = 0
+        for key, old, new in self._changes:
+            i = bisect_left(keys, key)
+            end = i + 1 if i < len(keys) and keys[i] == key else i
+            if content[starts[i]:starts[end]] != (old or b''):
+                return None
+            pieces.append(content[pos:starts[i]])
+            if new is not None:
+                pieces.append(new)
+            pos = starts[end]
+        pieces.append(content[pos:])
+        raw = b''.join(pieces)
+        _counts['rebased'] += 1
+        repository = self._repository
+        if not repository.write_object_enabled:
+            return TreeData.parse_raw(repository, raw).commit(repository)
+        return repository.get_tree(repository.write_object(Tree.typename, raw))
+
+
+def merge_stats():
+    """Return a line of statistics about L{merge_trees} and L{Rebase}
+    for the profiling log, if they have been used."""
+    if not any(_counts.values()):
+        return []
+    return [
+        'Tree merges: %d in memory, %d fell back to git, %d rebased'
+        % (_counts['memory'], _counts['fallback'], _counts['rebased'])
+    ]
+
+
+add_profile_stats(merge_stats)
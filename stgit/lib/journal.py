@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Journals that make long pushes of patches resumable.
+
+A L{StackTransaction} only updates the stack when it's run at the end,
+so if StGit is killed while pushing a long series of patches (for
+example when rebasing), all the merging done so far is lost. To avoid
+that, the transaction records the patches pushed so far in a journal
+every C{stgit.journalinterval} patches, and a later push can pick up
+the pushed commits from there instead of merging the patches again.
+A push that halts on a conflict is recorded the same way, however
+few patches it pushes, so that it can be continued once the conflict
+is resolved.
+
+For a branch C{I{foo}}, the journal is a commit stored in
+C{refs/journals/I{foo}}. (A name next to the patch refs, such as
+C{refs/patches/I{foo}.journal}, could be taken by the patch refs of a
+branch called C{I{foo}.journal}; branch names can't clash with each
+other like that.) Its only parent is the last commit
+pushed (or the commit the patches are pushed onto), which keeps all
+the pushed commits safe from garbage collection. Its tree has one
+blob, C{journal}::
+
+    Version: 1
+    Base: <sha1 of the commit the patches are pushed onto>
+    Patches:
+      <the patches to push, in order, one per line>
+    Pushed:
+      <patch name>: <sha1 of original commit> <sha1 of pushed commit>
+
+The commit message is the message of the transaction.
+
+The journal is deleted when the transaction is run, unless it halted
+part-way through, in which case it's updated with the patches pushed
+before the halt."""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals,
+)
+
+from stgit.exception import StgException
+from stgit.lib.git import BlobData, CommitData, RepositoryException, TreeData
+
+
+class JournalException(StgException):
+    pass
+
+
+def journal_ref(branch):
+    return 'refs/journals/%s' % branch
+
+
+class Journal(object):
+    def __init__(self, repo, message, base, patches, pushed):
+        self._repo = repo
+        self.message = message
+        self.base = base
+        self.patches = patches
+        # (patch name, original commit, pushed commit) for each patch
+        # pushed so far, in order.
+        self.pushed = pushed
+
+    @classmethod
+    def read(cls, repo, branch):
+        """Return the journal of the given branch, or C{None} if there
+        isn't any."""
+        ref = journal_ref(branch)
+        if not repo.refs.exists(ref):
+            return None
+        commit = repo.refs.get(ref)
+        try:
+            [(jtype, jcontent)] = repo.prefetch_commits(
+                [commit], ['%s:journal' % commit.sha1]
+            )
+        except RepositoryException:
+            jtype = None
+        if jtype != 'blob':
+            raise JournalException('%s is not a push journal' % ref)
+        lines = jcontent.decode('utf-8').splitlines()
+        if not lines or lines.pop(0) != 'Version: 1':
+            raise JournalException('Unknown journal version in %s' % ref)
+        parsed = {}
+        key = None
+        for line in lines:
+            if line.startswith(' '):
+                parsed[key].append(line.strip())
+            else:
+                key, val = [x.strip() for x in line.split(':', 1)]
+                parsed[key] = val or []
+        pushed = []
+        for entry in parsed['Pushed']:
+            pn, sha1s = [x.strip() for x in entry.split(':')]
+            old, new = sha1s.split()
+            pushed.append((pn, repo.get_commit(old), repo.get_commit(new)))
+        return cls(
+            repo,
+            commit.data.message_str,
+            repo.get_commit(parsed['Base']),
+            parsed['Patches'],
+            pushed,
+        )
+
+    def _content(self):
+        lines = ['Version: 1', 'Base: %s' % self.base.sha1, 'Patches:']
+        lines.extend('  %s' % pn for pn in self.patches)
+        lines.append('Pushed:')
+        lines.extend(
+            '  %s: %s %s' % (pn, old.sha1, new.sha1)
+            for pn, old, new in self.pushed
+        )
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def write(self, branch):
+        """Write the journal to the journal ref of the given branch."""
+        tree = self._repo.commit(
+            TreeData({'journal': self._repo.commit(BlobData(self._content()))})
+        )
+        top = self.pushed[-1][2] if self.pushed else self.base
+        commit = self._repo.commit(
+            CommitData(tree=tree, parents=[top], message=self.message)
+        )
+        self._repo.refs.set(journal_ref(branch), commit, self.message)
+
+
+def delete_journal(repo, branch):
+    ref = journal_ref(branch)
+    if repo.refs.exists(ref):
+        repo.refs.delete(ref)
@@ -108,11 +108,18 @@ from __future__ import (
 )
 
 import re
+import time
 
 from stgit import utils
 from stgit.exception import StgException
-from stgit.lib.git import BlobData, CommitData, TreeData
+from stgit.lib.git import (
+    BlobData,
+    CommitData,
+    RepositoryException,
+    TreeData,
+)
 from stgit.lib.stack import StackRepository
+from stgit.lib.timing import timed
 from stgit.out import out
 
 
@@ -236,14 +243,20 @@ class LogEntry(object):
     @classmethod
     def from_commit(cls, repo, commit):
         """Parse a (full or simplified) stack log commit."""
-        message = commit.data.message_str
+        # Read the commit and its meta blob in one batch, without
+        # having to list the commit's tree.
         try:
-            perm, meta = commit.data.tree.data['meta']
-        except KeyError:
+            [(mtype, mcontent)] = repo.prefetch_commits(
+                [commit], ['%s:meta' % commit.sha1]
+            )
+        except RepositoryException:
+            raise LogParseException('Not a stack log')
+        if mtype != 'blob':
             raise LogParseException('Not a stack log')
+        message = commit.data.message_str
         (
             prev, head, applied, unapplied, hidden, patches
-        ) = cls._parse_metadata(repo, meta.data.bytes.decode('utf-8'))
+        ) = cls._parse_metadata(repo, mcontent.decode('utf-8'))
         lg = cls(
             repo, prev, head, applied, unapplied, hidden, patches, message
         )
@@ -323,6 +336,17 @@ class LogEntry(object):
         )
 
     def write_commit(self):
+        """Write the log entry: its blobs, trees, and simplified, full
+        and parent grouping commits. They are all handed to git in one
+        batch, so that logging costs about the same whatever the number
+        of changed patches."""
+        self._repo.start_object_batch()
+        try:
+            self._write_commit()
+        finally:
+            self._repo.end_object_batch()
+
+    def _write_commit(self, author=None, committer=None):
         metadata = self._metadata_string()
         tree = self._tree(metadata)
         self._simplified = self._repo.commit(
@@ -333,7 +357,9 @@ class LogEntry(object):
                     prev.simplified
                     for prev in [self.prev]
                     if prev is not None
-                ]
+                ],
+                author=author,
+                committer=committer,
             )
         )
         parents = list(self._parents())
@@ -343,6 +369,8 @@ class LogEntry(object):
                     tree=tree,
                     parents=parents[-self._max_parents:],
                     message='Stack log parent grouping',
+                    author=author,
+                    committer=committer,
                 )
             )
             parents[-self._max_parents:] = [g]
@@ -351,6 +379,8 @@ class LogEntry(object):
                 tree=tree,
                 message=self.message,
                 parents=[self.simplified] + parents,
+                author=author,
+                committer=committer,
             )
         )
 
@@ -369,6 +399,7 @@ def same_state(log1, log2):
     return s[0] == s[1]
 
 
+@timed('log_entry')
 def log_entry(stack, msg):
     """Write a new log entry for the stack."""
     ref = log_ref(stack.name)
@@ -389,6 +420,69 @@ def log_entry(stack, msg):
         return
     new_log.write_commit()
     stack.repository.refs.set(ref, new_log.commit, msg)
+    index = stack.repository.log_index
+    if index:
+        index.add([_index_row(new_log)])
+
+
+def compact_log(repo, branch, keep, keep_days, msg):
+    """Rewrite the stack log of C{branch} so that it only has its last
+    C{keep} entries, plus any older entries written less than
+    C{keep_days} days ago (if C{keep_days} is positive). The oldest
+    entry left gets no previous entry, so the patch commits that only
+    the dropped entries referred to can be garbage collected.
+
+    The entries left keep their messages and dates, so undo and redo
+    work as before within them.
+
+    @return: The number of entries left, or C{None} if no entries
+             would be dropped and the log was left alone"""
+    ref = log_ref(branch)
+    try:
+        commit = repo.refs.get(ref)
+    except KeyError:
+        return None
+    if keep_days and keep_days > 0:
+        cutoff = time.time() - keep_days * 24 * 60 * 60
+    else:
+        cutoff = None
+
+    def is_recent(c):
+        return (
+            cutoff is not None
+            and c.data.committer.date.timestamp() >= cutoff
+        )
+
+    entries = [get_log_entry(repo, ref, commit)]
+    while True:
+        prev = entries[-1].prev
+        if prev is None:
+            return None
+        if len(entries) >= max(keep, 1) and not is_recent(prev.commit):
+            break
+        entries.append(prev)
+
+    repo.start_object_batch()
+    try:
+        new_log = None
+        rows = []
+        for lg in reversed(entries):
+            new_log = LogEntry(
+                repo, new_log, lg.head, lg.applied, lg.unapplied,
+                lg.hidden, lg.patches, lg.message,
+            )
+            new_log._write_commit(
+                author=lg.commit.data.author,
+                committer=lg.commit.data.committer,
+            )
+            rows.append(_index_row(new_log))
+    finally:
+        repo.end_object_batch()
+    repo.refs.set(ref, new_log.commit, msg)
+    index = repo.log_index
+    if index:
+        index.add(rows)
+    return len(entries)
 
 
 def delete_log(repo, branch):
@@ -479,6 +573,79 @@ def reset_stack_partially(trans, iw, state, only_patches):
             trans.push_patch(pn, iw)
 
 
+def _undo_redo_counts(message):
+    """Return how many steps a log entry with the given message undid
+    and redid."""
+    msg = message.strip()
+    um = re.match(r'^undo\s+(\d+)$', msg)
+    rm = re.match(r'^redo\s+(\d+)$', msg)
+    return (int(um.group(1)) if um else 0, int(rm.group(1)) if rm else 0)
+
+
+def _index_row(lg):
+    """Return what the L{LogIndex} needs to know about a L{LogEntry}."""
+    undo, redo = _undo_redo_counts(lg.message)
+    prev = lg.prev
+    return (lg.commit.sha1, prev.commit.sha1 if prev else None, undo, redo)
+
+
+def _indexed_entry(repo, index, commit):
+    """Return the L{LogIndex} entry of a log entry commit. If it isn't
+    in the index yet, first index it and the entries before it back to
+    the first one that is, reading only their message and previous
+    entry. Return C{None} if that fails."""
+    rows = []
+    sha1 = commit.sha1
+    while sha1 is not None and index.get(sha1) is None:
+        c = repo.get_commit(sha1)
+        try:
+            [(mtype, mcontent)] = repo.prefetch_commits(
+                [c], ['%s:meta' % sha1]
+            )
+        except RepositoryException:
+            return None
+        m = re.search(br'^Previous: (\S+)$', mcontent, re.MULTILINE)
+        if mtype != 'blob' or not m:
+            return None
+        prev = m.group(1).decode('ascii')
+        if prev == 'None':
+            prev = None
+        rows.append((sha1, prev) + _undo_redo_counts(c.data.message_str))
+        sha1 = prev
+    if rows and not index.add(reversed(rows)):
+        return None
+    return index.get(commit.sha1)
+
+
+def _indexed_undo_state(repo, index, commit, undo_steps):
+    """Find the destination of L{undo_state} with the L{LogIndex}, and
+    return its sha1, or C{None} if the index can't be used."""
+    entry = _indexed_entry(repo, index, commit)
+    if entry is None:
+        return None
+    if undo_steps > 0:
+        try:
+            dest = index.find_balance(entry, entry.balance + undo_steps)
+        except KeyError:
+            return None
+        if dest is None:
+            raise LogException('Not enough undo information available')
+        return dest.sha1
+    while undo_steps != 0:
+        if entry.undo:
+            undo_steps += 1
+        elif entry.redo:
+            undo_steps -= entry.redo
+        else:
+            raise LogException('No more redo information available')
+        if entry.prev is None:
+            raise LogException('Not enough undo information available')
+        entry = index.get(entry.prev)
+        if entry is None:
+            return None
+    return entry.sha1
+
+
 def undo_state(stack, undo_steps):
     """Find the log entry C{undo_steps} steps in the past. (Successive
     undo operations are supposed to "add up", so if we find other undo
@@ -487,6 +654,9 @@ def undo_state(stack, undo_steps):
 
     If C{undo_steps} is negative, redo instead of undo.
 
+    With the L{LogIndex}, only the destination entry is read;
+    otherwise, all the entries on the way are.
+
     @return: The log entry that is the destination of the undo
              operation
     @rtype: L{LogEntry}"""
@@ -495,21 +665,28 @@ def undo_state(stack, undo_steps):
         commit = stack.repository.refs.get(ref)
     except KeyError:
         raise LogException('Log is empty')
+    index = stack.repository.log_index
+    if index:
+        sha1 = _indexed_undo_state(
+            stack.repository, index, commit, undo_steps
+        )
+        if sha1 is not None:
+            return get_log_entry(
+                stack.repository, ref, stack.repository.get_commit(sha1)
+            )
     log = get_log_entry(stack.repository, ref, commit)
     while undo_steps != 0:
-        msg = log.message.strip()
-        um = re.match(r'^undo\s+(\d+)$', msg)
+        undo, redo = _undo_redo_counts(log.message)
         if undo_steps > 0:
-            if um:
-                undo_steps += int(um.group(1))
+            if undo:
+                undo_steps += undo
             else:
                 undo_steps -= 1
         else:
-            rm = re.match(r'^redo\s+(\d+)$', msg)
-            if um:
+            if undo:
                 undo_steps += 1
-            elif rm:
-                undo_steps -= int(rm.group(1))
+            elif redo:
+                undo_steps -= redo
             else:
                 raise LogException('No more redo information available')
         if not log.prev:
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""An index of stack log entries that is kept on disk between StGit
+invocations.
+
+Finding the destination of C{stg undo -n I{n}} means walking back
+through the log one entry at a time, and reading each entry's commit
+and metadata just to learn its previous entry and whether it was an
+undo or a redo. L{LogIndex} remembers those facts for every log entry
+it has seen, in an SQLite database in C{.git/stgit-cache/}, along with
+the entry's ordinal (its distance from the first entry of its log) and
+a skip pointer to an older entry, so that the destination can be found
+with a logarithmic number of lookups and then parsed on its own.
+
+Like the commit cache, the index is only a cache: log entries never
+change once written, and if the database can't be opened or written,
+we just walk the log instead."""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals,
+)
+
+from collections import namedtuple
+import os
+
+from stgit.lib.git.commitcache import cache_dir
+
+try:
+    import sqlite3
+except ImportError:  # pragma: no cover
+    sqlite3 = None
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS entries (
+           sha1 TEXT PRIMARY KEY,
+           prev TEXT,
+           ordinal INTEGER NOT NULL,
+           balance INTEGER NOT NULL,
+           undo INTEGER NOT NULL,
+           redo INTEGER NOT NULL,
+           skip TEXT,
+           skip_max INTEGER
+       )''',
+]
+
+#: What the index knows about a log entry. C{prev} is the sha1 of the
+#: previous entry, or C{None}; C{undo} and C{redo} are the number of
+#: steps the entry undid or redid (0 if it's neither). C{balance} is
+#: the sum, over the entry and all the entries before it, of the
+#: entry's C{undo} count, or -1 for entries that aren't undos: going
+#: back through the log from an entry, C{stg undo -n I{n}} stops at the
+#: first entry whose balance is I{n} more than that of the entry it
+#: started from. C{skip} is the sha1 of the entry whose ordinal is
+#: C{ordinal} with its lowest set bit cleared, and C{skip_max} the
+#: highest balance of the entries from there up to, but not including,
+#: this one.
+Entry = namedtuple(
+    'Entry',
+    'sha1 prev ordinal balance undo redo skip skip_max',
+)
+
+
+class LogIndex(object):
+    """The on-disk index of the stack log entries of one repository."""
+
+    filename = 'log-index.sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+
+    @classmethod
+    def open(cls, common_dir):
+        """Open the log index of a repository, creating it if needed.
+        Return C{None} if that's not possible."""
+        if sqlite3 is None:  # pragma: no cover
+            return None
+        index = cls(os.path.join(cache_dir(common_dir), cls.filename))
+        try:
+            index._connect()
+        except (EnvironmentError, sqlite3.Error):
+            return None
+        return index
+
+    def _connect(self):
+        d = os.path.dirname(self.path)
+        if not os.path.isdir(d):
+            os.mkdir(d)
+        self._db = sqlite3.connect(self.path, timeout=1)
+        with self._db:
+            for statement in _SCHEMA:
+                self._db.execute(statement)
+
+    def get(self, sha1):
+        """Return the L{Entry} of the given log entry commit, or C{None} if
+        it isn't in the index."""
+        try:
+            row = self._db.execute(
+                'SELECT * FROM entries WHERE sha1 = ?', (sha1,)
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        return None if row is None else Entry(*row)
+
+    def add(self, entries):
+        """Index log entries, given as (sha1, prev sha1, undo count, redo
+        count) tuples, oldest first. The previous entry of the first one
+        must be indexed already, or be C{None}. Return C{False} if the
+        entries couldn't be indexed."""
+        rows = {}
+
+        def get(sha1):
+            return rows.get(sha1) or self.get(sha1)
+
+        for sha1, prev_sha1, undo, redo in entries:
+            delta = undo if undo else -1
+            if prev_sha1 is None:
+                rows[sha1] = Entry(
+                    sha1, None, 0, delta, undo, redo, None, None
+                )
+                continue
+            prev = get(prev_sha1)
+            if prev is None:
+                return False
+            ordinal = prev.ordinal + 1
+            skip_ordinal = ordinal & (ordinal - 1)
+            # The entries between the skip target and this one are
+            # covered by following the skip pointers from the previous
+            # entry down to the skip target.
+            e = prev
+            skip_max = e.balance
+            while e.ordinal > skip_ordinal:
+                skip_max = max(skip_max, e.skip_max)
+                e = get(e.skip)
+                if e is None:
+                    return False
+                skip_max = max(skip_max, e.balance)
+            rows[sha1] = Entry(
+                sha1, prev_sha1, ordinal, prev.balance + delta, undo, redo,
+                e.sha1, skip_max,
+            )
+        try:
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO entries'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    list(rows.values()),
+                )
+        except sqlite3.Error:
+            return False
+        return True
+
+    def find_balance(self, entry, balance):
+        """Return the L{Entry} of the most recent log entry before C{entry}
+        with a balance of at least C{balance}, or C{None} if there is
+        none. Raise C{KeyError} if an entry on the way has gone missing
+        from the index."""
+        while entry.ordinal > 0:
+            if entry.skip_max < balance:
+                # Nothing from the skip target up to here (the skip
+                # target included), so jump there.
+                sha1 = entry.skip
+            else:
+                sha1 = entry.prev
+            entry = self.get(sha1)
+            if entry is None:
+                raise KeyError(sha1)
+            if entry.balance >= balance:
+                return entry
+        return None
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -6,15 +6,33 @@ from __future__ import (
     unicode_literals,
 )
 
+from collections import OrderedDict
+
+# All named caches, for reporting their statistics.
+_caches = []
+
 
 class ObjectCache(object):
     """Cache for Python objects, for making sure that we create only one
     Python object per git object. This reduces memory consumption and
-    makes object comparison very cheap."""
+    makes object comparison very cheap.
+
+    The objects themselves are never dropped, but if C{max_loaded} is
+    given, at most that many of them get to keep the data they have
+    loaded: when more objects have loaded data, the C{unload} function
+    is called on the least recently used ones. For that to work, the
+    objects must report when they use their data with L{used}."""
 
-    def __init__(self, create):
+    def __init__(self, create, name=None, max_loaded=None, unload=None):
         self.__objects = {}
         self.__create = create
+        self.__max_loaded = max_loaded
+        self.__unload = unload
+        self.__loaded = OrderedDict()  # least recently used first
+        self.name = name
+        self.hits = self.misses = self.evictions = 0
+        if name is not None:
+            _caches.append(self)
 
     def __getitem__(self, name):
         if name not in self.__objects:
@@ -27,3 +45,38 @@ class ObjectCache(object):
     def __setitem__(self, name, val):
         assert name not in self.__objects
         self.__objects[name] = val
+        return
+
+    def used(self, name, loaded):
+        """Note that the named object used its data, and whether it had
+        to load it first (a miss) or still had it (a hit)."""
+        if loaded:
+            self.misses += 1
+        else:
+            self.hits += 1
+        if not self.__max_loaded:
+            return
+        self.__loaded.pop(name, None)
+        self.__loaded[name] = None
+        while len(self.__loaded) > self.__max_loaded:
+            old, _ = self.__loaded.popitem(last=False)
+            self.__unload(self.__objects[old])
+            self.evictions += 1
+
+
+def cache_stats():
+    """Return a line of statistics for every named L{ObjectCache} that
+    has been used, with the numbers of caches of the same name added
+    up."""
+    stats = OrderedDict()
+    for cache in _caches:
+        s = stats.setdefault(cache.name, [0, 0, 0])
+        s[0] += cache.hits
+        s[1] += cache.misses
+        s[2] += cache.evictions
+    return [
+        'Object cache %s: %d hits, %d misses, %d evictions'
+        % (name, hits, misses, evictions)
+        for name, (hits, misses, evictions) in stats.items()
+        if hits or misses
+    ]
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""A list of patch names that knows where each name is."""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals,
+)
+
+
+class PatchList(object):
+    """An ordered sequence of distinct patch names, such as the applied,
+    unapplied or hidden patches of a stack.
+
+    A plain list takes time linear in its length to tell whether a name
+    is in it, to find a name, and to take a name out of its middle, so
+    pushing, popping or filtering all the patches of a big stack one at
+    a time takes quadratic time. A L{PatchList} also keeps a map from
+    each name to its position, which makes C{in}, L{index}, L{append},
+    L{remove} and L{rename} take constant (amortized) time.
+
+    Removed names leave a hole behind, which the next lookup by
+    position fills by closing up the list. So when removing many names,
+    do it before looking up positions again.
+
+    Slices and concatenations are plain lists, and a L{PatchList}
+    compares equal to a list or tuple of the same names."""
+
+    def __init__(self, names=()):
+        self._slots = []
+        self._pos = {}
+        self._holes = 0
+        self.extend(names)
+
+    def _close_up(self):
+        if self._holes:
+            self._slots = [pn for pn in self._slots if pn is not None]
+            self._pos = dict((pn, i) for i, pn in enumerate(self._slots))
+            self._holes = 0
+
+    def __len__(self):
+        return len(self._pos)
+
+    def __iter__(self):
+        for pn in self._slots:
+            if pn is not None:
+                yield pn
+
+    def __reversed__(self):
+        for pn in reversed(self._slots):
+            if pn is not None:
+                yield pn
+
+    def __contains__(self, pn):
+        return pn in self._pos
+
+    def __getitem__(self, i):
+        self._close_up()
+        return self._slots[i]
+
+    def __delitem__(self, i):
+        self._close_up()
+        if isinstance(i, slice):
+            names = self._slots[i]
+        else:
+            names = [self._slots[i]]
+        del self._slots[i]
+        for pn in names:
+            del self._pos[pn]
+        if self._slots and self._pos[self._slots[-1]] != len(self._slots) - 1:
+            # Names were deleted from before the end, so the names
+            # after them moved.
+            self._pos = dict((pn, j) for j, pn in enumerate(self._slots))
+
+    def __eq__(self, other):
+        if isinstance(other, (PatchList, list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    __hash__ = None
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __repr__(self):
+        return 'PatchList(%r)' % list(self)
+
+    def index(self, pn):
+        """Return the position of the named patch."""
+        self._close_up()
+        try:
+            return self._pos[pn]
+        except KeyError:
+            raise ValueError('%s is not in the list' % pn)
+
+    def append(self, pn):
+        if pn in self._pos:
+            raise ValueError('%s is already in the list' % pn)
+        self._pos[pn] = len(self._slots)
+        self._slots.append(pn)
+
+    def extend(self, names):
+        for pn in names:
+            self.append(pn)
+
+    def insert(self, i, pn):
+        if pn in self._pos:
+            raise ValueError('%s is already in the list' % pn)
+        self._close_up()
+        self._slots.insert(i, pn)
+        self._pos = dict((pn, j) for j, pn in enumerate(self._slots))
+
+    def remove(self, pn):
+        try:
+            i = self._pos.pop(pn)
+        except KeyError:
+            raise ValueError('%s is not in the list' % pn)
+        self._slots[i] = None
+        self._holes += 1
+        while self._slots and self._slots[-1] is None:
+            self._slots.pop()
+            self._holes -= 1
+        if self._holes > len(self._pos):
+            self._close_up()
+
+    def pop(self, i=-1):
+        pn = self[i]
+        self.remove(pn)
+        return pn
+
+    def rename(self, old_name, new_name):
+        """Give the named patch a new name, keeping its position."""
+        if new_name in self._pos:
+            raise ValueError('%s is already in the list' % new_name)
+        i = self._pos.pop(old_name)
+        self._slots[i] = new_name
+        self._pos[new_name] = i
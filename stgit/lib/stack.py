@@ -8,17 +8,29 @@ from __future__ import (
     unicode_literals,
 )
 
+import atexit
 import os
 import shutil
 
 from stgit import utils
-from stgit.compat import fsencode_utf8, text
+from stgit.compat import text
 from stgit.config import config
 from stgit.exception import StackException
 from stgit.lib import stackupgrade
-from stgit.lib.git import CommitData, Repository
+from stgit.lib.git import (
+    BlobData,
+    CommitData,
+    Repository,
+    RepositoryException,
+    TreeData,
+)
 from stgit.lib.git.branch import Branch, BranchException
+from stgit.lib.git.repository import check_ref_format
+from stgit.lib.journal import delete_journal, journal_ref
+from stgit.lib.logindex import LogIndex
 from stgit.lib.objcache import ObjectCache
+from stgit.lib.patchlist import PatchList
+from stgit.lib.timing import timed
 
 
 class Patch(object):
@@ -33,92 +45,30 @@ class Patch(object):
     def _ref(self):
         return 'refs/patches/%s/%s' % (self._stack.name, self.name)
 
-    @property
-    def _log_ref(self):
-        return self._ref + '.log'
-
     @property
     def commit(self):
+        if self._stack.snapshot:
+            return self._stack.snapshot.get_commit(self.name)
         return self._stack.repository.refs.get(self._ref)
 
-    @property
-    def _compat_dir(self):
-        return os.path.join(self._stack.directory, 'patches', self.name)
-
-    def _write_compat_files(self, new_commit, msg):
-        """Write files used by the old infrastructure."""
-        def write(name, val, multiline=False):
-            fn = os.path.join(self._compat_dir, name)
-            fn = fsencode_utf8(fn)
-            if val:
-                utils.write_string(fn, val, multiline)
-            elif os.path.isfile(fn):
-                os.remove(fn)
-
-        def write_patchlog():
-            try:
-                old_log = [self._stack.repository.refs.get(self._log_ref)]
-            except KeyError:
-                old_log = []
-            cd = CommitData(
-                tree=new_commit.data.tree,
-                parents=old_log,
-                message='%s\t%s' % (msg, new_commit.sha1),
-            )
-            c = self._stack.repository.commit(cd)
-            self._stack.repository.refs.set(self._log_ref, c, msg)
-            return c
-
-        d = new_commit.data
-        write('authname', d.author.name)
-        write('authemail', d.author.email)
-        write('authdate', d.author.date)
-        write('commname', d.committer.name)
-        write('commemail', d.committer.email)
-        write('description', d.message_str, multiline=True)
-        write('log', write_patchlog().sha1)
-        write('top', new_commit.sha1)
-        write('bottom', d.parent.sha1)
-        try:
-            old_top_sha1 = self.commit.sha1
-            old_bottom_sha1 = self.commit.data.parent.sha1
-        except KeyError:
-            old_top_sha1 = None
-            old_bottom_sha1 = None
-        write('top.old', old_top_sha1)
-        write('bottom.old', old_bottom_sha1)
-
-    def _delete_compat_files(self):
-        if os.path.isdir(self._compat_dir):
-            for f in os.listdir(self._compat_dir):
-                os.remove(os.path.join(self._compat_dir, f))
-            os.rmdir(self._compat_dir)
-        try:
-            # this compatibility log ref might not exist
-            self._stack.repository.refs.delete(self._log_ref)
-        except KeyError:
-            pass
-
+    @timed('set_commit')
     def set_commit(self, commit, msg):
-        try:
-            old_sha1 = self.commit.sha1
-        except KeyError:
-            old_sha1 = None
-        self._write_compat_files(commit, msg)
-        self._stack.repository.refs.set(self._ref, commit, msg)
-        if old_sha1 and old_sha1 != commit.sha1:
-            self._stack.repository.copy_notes(old_sha1, commit.sha1)
+        if self._stack.snapshot:
+            self._stack.snapshot.set_commit(self.name, commit, msg)
+        else:
+            self._stack.repository.refs.set(self._ref, commit, msg)
 
     def set_name(self, name, msg):
         commit = self.commit
         self.delete()
         self.name = name
-        self._write_compat_files(commit, msg)
-        self._stack.repository.refs.set(self._ref, commit, msg)
+        self.set_commit(commit, msg)
 
     def delete(self):
-        self._delete_compat_files()
-        self._stack.repository.refs.delete(self._ref)
+        if self._stack.snapshot:
+            self._stack.snapshot.delete(self.name)
+        else:
+            self._stack.repository.refs.delete(self._ref)
 
     def is_empty(self):
         return self.commit.data.is_nochange()
@@ -137,14 +87,17 @@ class Patch(object):
 
 class PatchOrder(object):
     """Keeps track of patch order, and which patches are applied.
-    Works with patch names, not actual patches."""
+    Works with patch names, not actual patches.
+
+    The lists of patches are L{PatchList}s, which must not be changed
+    in place; set a new order with L{set_order} instead."""
 
     def __init__(self, stack):
         self._stack = stack
         self._lists = {}
 
     def _read_file(self, fn):
-        return tuple(utils.read_strings(
+        return PatchList(utils.read_strings(
             os.path.join(self._stack.directory, fn))
         )
 
@@ -152,13 +105,17 @@ class PatchOrder(object):
         utils.write_strings(os.path.join(self._stack.directory, fn), val)
 
     def _get_list(self, name):
+        if self._stack.snapshot:
+            return self._stack.snapshot.get_list(name)
         if name not in self._lists:
             self._lists[name] = self._read_file(name)
         return self._lists[name]
 
     def _set_list(self, name, val):
-        val = tuple(val)
-        if val != self._lists.get(name, None):
+        val = PatchList(val)
+        if self._stack.snapshot:
+            self._stack.snapshot.set_list(name, val)
+        elif val != self._lists.get(name, None):
             self._lists[name] = val
             self._write_file(name, val)
 
@@ -183,19 +140,19 @@ class PatchOrder(object):
         return self.applied + self.unapplied
 
     def set_order(self, applied, unapplied, hidden):
+        """Set the order of the patches. With a L{Snapshot}, this also
+        writes the changes made to the patches since the last time."""
         self._set_list('applied', applied)
         self._set_list('unapplied', unapplied)
         self._set_list('hidden', hidden)
+        if self._stack.snapshot:
+            self._stack.snapshot.write()
 
     def rename_patch(self, old_name, new_name):
         for list_name in ['applied', 'unapplied', 'hidden']:
-            patch_list = list(self._get_list(list_name))
-            try:
-                index = patch_list.index(old_name)
-            except ValueError:
-                continue
-            else:
-                patch_list[index] = new_name
+            if old_name in self._get_list(list_name):
+                patch_list = PatchList(self._get_list(list_name))
+                patch_list.rename(old_name, new_name)
                 self._set_list(list_name, patch_list)
                 break
         else:
@@ -209,6 +166,187 @@ class PatchOrder(object):
         utils.create_empty_file(os.path.join(stackdir, 'unapplied'))
         utils.create_empty_file(os.path.join(stackdir, 'hidden'))
 
+    @staticmethod
+    def delete_files(stackdir):
+        for fn in ['applied', 'unapplied', 'hidden']:
+            os.remove(os.path.join(stackdir, fn))
+
+
+def snapshot_ref(branch):
+    return 'refs/stacks/%s' % branch
+
+
+class Snapshot(object):
+    """The order and commits of all the patches of a stack, kept in one
+    blob instead of the C{applied}, C{unapplied} and C{hidden} files
+    and one ref per patch. Stacks use one if C{stgit.stacksnapshot} is
+    set, so that the whole stack is read with one object lookup and
+    written with one ref update.
+
+    The blob, C{stack}, is the only entry in the tree of the commit
+    C{refs/stacks/I{branch}} points to. It has the same format as the
+    C{meta} blob of a stack log entry, without the C{Previous} and
+    C{Head} fields. The first parent of the commit is the previous
+    snapshot, and its other parents are the patch commits the previous
+    snapshot doesn't have, which keeps the patches safe from garbage
+    collection.
+
+    Changes to the patches and their order are kept in memory until
+    L{write} is called."""
+
+    _max_parents = 16
+
+    def __init__(self, stack):
+        self._stack = stack
+        self._commit = None
+        self._lists = None
+        self._patches = None
+        self._changed = False
+        self._msg = None
+
+    @property
+    def ref(self):
+        return snapshot_ref(self._stack.name)
+
+    def exists(self):
+        return self._stack.repository.refs.exists(self.ref)
+
+    def _load(self):
+        # Read the snapshot again if the ref has changed under us, as it
+        # does when a ref transaction is aborted.
+        commit = self._stack.repository.refs.get(self.ref)
+        if self._lists is not None and commit == self._commit:
+            return
+        try:
+            [(stype, content)] = self._stack.repository.prefetch_commits(
+                [commit], ['%s:stack' % commit.sha1]
+            )
+        except RepositoryException:
+            stype = None
+        if stype != 'blob':
+            raise StackException('%s is not a stack snapshot' % self.ref)
+        lines = content.decode('utf-8').splitlines()
+        if not lines or lines.pop(0) != 'Version: 1':
+            raise StackException(
+                'Unknown stack snapshot version in %s' % self.ref
+            )
+        lists = dict(applied=[], unapplied=[], hidden=[])
+        patches = {}
+        name = None
+        for line in lines:
+            if line.startswith(' '):
+                pn, sha1 = [x.strip() for x in line.split(':')]
+                lists[name].append(pn)
+                patches[pn] = self._stack.repository.get_commit(sha1)
+            else:
+                name = line.strip().rstrip(':').lower()
+                if name not in lists:
+                    raise StackException(
+                        'Malformed stack snapshot in %s' % self.ref
+                    )
+        self._commit = commit
+        self._lists = dict((n, PatchList(lst)) for n, lst in lists.items())
+        self._patches = patches
+        self._written = set(patches.values())
+        self._changed = False
+
+    def create(self, applied, unapplied, hidden, patches):
+        """Start a new snapshot of the given patches, to be written
+        with L{write}."""
+        self._commit = None
+        self._lists = dict(
+            applied=PatchList(applied),
+            unapplied=PatchList(unapplied),
+            hidden=PatchList(hidden),
+        )
+        self._patches = dict(patches)
+        self._written = set()
+        self._changed = True
+
+    def discard(self):
+        """Forget the changes that haven't been written."""
+        self._lists = None
+
+    def get_list(self, name):
+        self._load()
+        return self._lists[name]
+
+    def set_list(self, name, val):
+        self._load()
+        if val != self._lists[name]:
+            self._lists[name] = val
+            self._changed = True
+
+    def get_commit(self, pn):
+        self._load()
+        return self._patches[pn]
+
+    def set_commit(self, pn, commit, msg):
+        self._load()
+        if self._patches.get(pn) != commit:
+            self._patches[pn] = commit
+            self._changed = True
+            self._msg = msg
+
+    def delete(self, pn):
+        self._load()
+        del self._patches[pn]
+        self._changed = True
+
+    def _parents(self, tree):
+        """Return the parents the snapshot commit needs, besides the
+        previous snapshot, to keep all the patches reachable."""
+        applied = self._lists['applied']
+        patches = set(
+            self._patches[pn]
+            for pn in self._lists['unapplied'] + self._lists['hidden']
+            + applied[-1:]
+        )
+        parents = sorted(patches - self._written, key=lambda c: c.sha1)
+        while len(parents) >= self._max_parents:
+            group = self._stack.repository.commit(
+                CommitData(
+                    tree=tree,
+                    parents=parents[-self._max_parents:],
+                    message='Stack snapshot parent grouping',
+                )
+            )
+            parents[-self._max_parents:] = [group]
+        return parents
+
+    def write(self, msg=None):
+        """Write the snapshot, if anything has changed."""
+        if not self._changed:
+            return
+        repository = self._stack.repository
+        lines = ['Version: 1']
+        for name in ['applied', 'unapplied', 'hidden']:
+            lines.append('%s:' % name.capitalize())
+            lines.extend(
+                '  %s: %s' % (pn, self._patches[pn].sha1)
+                for pn in self._lists[name]
+            )
+        msg = msg or self._msg or 'stack update'
+        tree = repository.commit(TreeData({
+            'stack': repository.commit(
+                BlobData(('\n'.join(lines) + '\n').encode('utf-8'))
+            ),
+        }))
+        commit = repository.commit(
+            CommitData(
+                tree=tree,
+                parents=[
+                    c for c in [self._commit] if c is not None
+                ] + self._parents(tree),
+                message=msg,
+            )
+        )
+        repository.refs.set(self.ref, commit, msg)
+        self._commit = commit
+        self._written.update(self._patches.values())
+        self._changed = False
+        self._msg = None
+
 
 class Patches(object):
     """Creates L{Patch} objects. Makes sure there is only one such object
@@ -238,10 +376,9 @@ class Patches(object):
         if '/' in name:
             # TODO slashes in patch names could be made to be okay
             return False
-        ref_name = 'refs/patches/%s/%s' % (self._stack.name, name)
-        p = self._stack.repository.run(['git', 'check-ref-format', ref_name])
-        p.returns([0, 1]).discard_stderr().discard_output()
-        return p.exitcode == 0
+        return check_ref_format(
+            'refs/patches/%s/%s' % (self._stack.name, name)
+        )
 
     def new(self, name, commit, msg):
         assert name not in self._patches
@@ -262,8 +399,54 @@ class Stack(Branch):
         Branch.__init__(self, repository, name)
         self.patchorder = PatchOrder(self)
         self.patches = Patches(self)
+        self.snapshot = None
         if not stackupgrade.update_to_current_format_version(repository, name):
             raise StackException('%s: branch not initialized' % name)
+        self._use_snapshot(config.getbool('stgit.stacksnapshot'))
+
+    def _use_snapshot(self, use):
+        """Keep the patches in a L{Snapshot} or not, moving them there
+        or back to the order files and patch refs if needed."""
+        snapshot = Snapshot(self)
+        exists = snapshot.exists()
+        self.snapshot = snapshot if exists else None
+        if exists == use:
+            return
+        patchorder = self.patchorder
+        order = (patchorder.applied, patchorder.unapplied, patchorder.hidden)
+        patches = [self.patches.get(pn) for pn in patchorder.all]
+        commits = dict((p.name, p.commit) for p in patches)
+        refs = self.repository.refs
+        refs.start_transaction()
+        try:
+            if use:
+                for p in patches:
+                    p.delete()
+                self.snapshot = snapshot
+                snapshot.create(*order, patches=commits)
+                snapshot.write('use a stack snapshot')
+            else:
+                refs.delete(snapshot.ref)
+                self.snapshot = None
+                for p in patches:
+                    p.set_commit(
+                        commits[p.name], 'stop using a stack snapshot'
+                    )
+            refs.commit_transaction('stack format change')
+        except BaseException:
+            refs.abort_transaction()
+            raise
+        if use:
+            PatchOrder.delete_files(self.directory)
+        else:
+            PatchOrder.create(self.directory)
+            patchorder.set_order(*order)
+
+    def discard_changes(self):
+        """Forget the changes to the patches that haven't been written
+        yet, as L{Snapshot}s keep them until the order is set."""
+        if self.snapshot:
+            self.snapshot.discard()
 
     @property
     def directory(self):
@@ -274,9 +457,11 @@ class Stack(Branch):
     @property
     def base(self):
         if self.patchorder.applied:
-            return self.patches.get(
-                self.patchorder.applied[0]
-            ).commit.data.parent
+            bottom = self.patches.get(self.patchorder.applied[0]).commit
+            # Whoever wants the base nearly always goes on to look at
+            # the head as well, so read both commits at once.
+            self.repository.prefetch_commits([bottom, self.head])
+            return bottom.data.parent
         else:
             return self.head
 
@@ -320,6 +505,9 @@ class Stack(Branch):
         for pn in self.patchorder.all:
             patch = self.patches.get(pn)
             patch.delete()
+        if self.snapshot:
+            self.repository.refs.delete(self.snapshot.ref)
+        delete_journal(self.repository, self.name)
         shutil.rmtree(self.directory)
         config.remove_section('branch.%s.stgit' % self.name)
 
@@ -329,27 +517,27 @@ class Stack(Branch):
         super(Stack, self).rename(name)
         old_ref_root = 'refs/patches/%s' % old_name
         new_ref_root = 'refs/patches/%s' % name
-        empty_id = '0' * 40
-        ref_updates = ''
-        for pn in patch_names:
-            old_ref = '%s/%s' % (old_ref_root, pn)
-            new_ref = '%s/%s' % (new_ref_root, pn)
-            old_log_ref = old_ref + '.log'
-            new_log_ref = new_ref + '.log'
-            patch_commit_id = self.repository.refs.get(old_ref).sha1
-            log_commit_id = self.repository.refs.get(old_log_ref).sha1
-
-            ref_updates += 'update %s %s %s\n' % (
-                new_ref, patch_commit_id, empty_id
-            )
-            ref_updates += 'update %s %s %s\n' % (
-                new_log_ref, log_commit_id, empty_id
-            )
-            ref_updates += 'delete %s %s\n' % (old_ref, patch_commit_id)
-            ref_updates += 'delete %s %s\n' % (old_log_ref, log_commit_id)
-        self.repository.run(
-            ['git', 'update-ref', '--stdin']
-        ).raw_input(ref_updates).discard_output()
+        refs = self.repository.refs
+        refs.start_transaction()
+        try:
+            if self.snapshot:
+                old_snapshot = snapshot_ref(old_name)
+                refs.set(snapshot_ref(name), refs.get(old_snapshot), 'rename')
+                refs.delete(old_snapshot)
+            else:
+                for pn in patch_names:
+                    old_ref = '%s/%s' % (old_ref_root, pn)
+                    new_ref = '%s/%s' % (new_ref_root, pn)
+                    refs.set(new_ref, refs.get(old_ref), 'rename')
+                    refs.delete(old_ref)
+            old_journal = journal_ref(old_name)
+            if refs.exists(old_journal):
+                refs.set(journal_ref(name), refs.get(old_journal), 'rename')
+                refs.delete(old_journal)
+            refs.commit_transaction('rename')
+        except BaseException:
+            refs.abort_transaction()
+            raise
 
         config.rename_section(
             'branch.%s.stgit' % old_name, 'branch.%s.stgit' % name
@@ -372,6 +560,8 @@ class Stack(Branch):
             raise StackException('Unknown patch name: "%s"' % old_name)
         self.patchorder.rename_patch(old_name, new_name)
         self.patches.get(old_name).set_name(new_name, msg)
+        if self.snapshot:
+            self.snapshot.write(msg)
 
     @classmethod
     def initialise(cls, repository, name=None, switch_to=False):
@@ -394,8 +584,6 @@ class Stack(Branch):
 
         # create the stack directory and files
         utils.create_dirs(dir)
-        compat_dir = os.path.join(dir, 'patches')
-        utils.create_dirs(compat_dir)
         PatchOrder.create(dir)
         config.set(stackupgrade.format_version_key(name),
                    text(stackupgrade.FORMAT_VERSION))
@@ -438,6 +626,23 @@ class StackRepository(Repository):
     def __init__(self, *args, **kwargs):
         Repository.__init__(self, *args, **kwargs)
         self._stacks = {}  # name -> Stack
+        self._log_index = None
+
+    @property
+    def log_index(self):
+        """The L{LogIndex} of the stack log entries of this repository, or
+        C{None} if it's disabled with the C{stgit.logindex} config option
+        or can't be used."""
+        if self._log_index is None:
+            index = None
+            if config.getbool('stgit.logindex'):
+                index = LogIndex.open(self.common_dir)
+            if index is None:
+                self._log_index = False
+            else:
+                atexit.register(index.close)
+                self._log_index = index
+        return self._log_index or None
 
     @property
     def current_stack(self):
@@ -7,6 +7,7 @@ from __future__ import (
 )
 
 import os
+import shutil
 
 from stgit import utils
 from stgit.config import config
@@ -14,7 +15,7 @@ from stgit.exception import StackException
 from stgit.out import out
 
 # The current StGit metadata format version.
-FORMAT_VERSION = 3
+FORMAT_VERSION = 4
 
 
 def format_version_key(branch):
@@ -128,6 +129,39 @@ def update_to_current_format_version(repository, branch):
         if not os.path.isfile(hidden_file):
             utils.create_empty_file(hidden_file)
 
+    # Update 3 -> 4: drop the files and per-patch log refs kept for
+    # the old infrastructure. The stack log records everything they
+    # did.
+    if get_format_version() == 3:
+        patch_dir = os.path.join(branch_dir, 'patches')
+        if os.path.isdir(patch_dir):
+            shutil.rmtree(patch_dir)
+        refs = repository.refs
+        # Only the log refs of the stack's patches: a patch may have a
+        # name ending in .log itself.
+        patches = []
+        for fn in ['applied', 'unapplied', 'hidden']:
+            path = os.path.join(branch_dir, fn)
+            if os.path.isfile(path):
+                patches.extend(utils.read_strings(path))
+        existing = set(refs.namespace('refs/patches/%s/' % branch))
+        log_refs = [
+            ref for ref in (
+                'refs/patches/%s/%s.log' % (branch, pn) for pn in patches
+            )
+            if ref in existing
+        ]
+        if log_refs:
+            refs.start_transaction()
+            try:
+                for ref in log_refs:
+                    refs.delete(ref)
+                refs.commit_transaction('StGit upgrade')
+            except BaseException:
+                refs.abort_transaction()
+                raise
+        set_format_version(4)
+
     # Make sure we're at the latest version.
     fv = get_format_version()
     if fv not in [None, FORMAT_VERSION]:
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""Timing of the phases of StGit commands.
+
+The interesting phases of a command (merging, checking out, writing
+the patches and the stack log, running git, ...) are wrapped in named
+spans, either with C{with span('name'):} or with the L{timed}
+decorator. Spans nest, so that the time spent in each phase can be
+told apart from the time spent in the phases it contains.
+
+Timing is off unless asked for, and then spans cost next to nothing:
+
+  - With C{STGIT_SUBPROCESS_LOG=profile}, the profiling log ends with
+    a summary line per phase; see L{phase_stats}.
+
+  - With C{STGIT_TRACE=I{file}}, all spans are written to I{file} at
+    exit, in the Chrome trace event format. Open it in
+    C{chrome://tracing} or U{https://ui.perfetto.dev} to see a
+    timeline of the command."""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals,
+)
+
+from collections import OrderedDict
+import functools
+import io
+import json
+import os
+import threading
+import time
+
+from stgit.compat import environ_get
+
+_clock = getattr(time, 'perf_counter', time.time)
+_trace_file = environ_get('STGIT_TRACE') or None
+_enabled = bool(_trace_file)
+_start = _clock()
+# name -> [count, total time, self time] of the finished spans.
+_phases = OrderedDict()
+# The finished spans, as Chrome trace events.
+_events = []
+# The open spans of each thread.
+_local = threading.local()
+
+
+def enable():
+    """Start timing spans, for L{phase_stats}."""
+    global _enabled
+    _enabled = True
+
+
+def _open_spans():
+    try:
+        return _local.spans
+    except AttributeError:
+        _local.spans = []
+        return _local.spans
+
+
+class _Span(object):
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        _open_spans().append(self)
+        self.children = 0.0
+        self.start = _clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = _clock() - self.start
+        spans = _open_spans()
+        spans.pop()
+        if spans:
+            spans[-1].children += duration
+        phase = _phases.setdefault(self.name, [0, 0.0, 0.0])
+        phase[0] += 1
+        phase[1] += duration
+        phase[2] += duration - self.children
+        if _trace_file:
+            event = dict(
+                name=self.name,
+                ph='X',
+                ts=1e6 * (self.start - _start),
+                dur=1e6 * duration,
+                pid=os.getpid(),
+                tid=threading.current_thread().ident,
+            )
+            if self.args:
+                event['args'] = self.args
+            _events.append(event)
+        return False
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_no_span = _NoSpan()
+
+
+def span(name, **args):
+    """Return a context manager that times its body as a phase of the
+    given name. The keyword arguments are shown with the span in the
+    trace."""
+    if _enabled:
+        return _Span(name, args)
+    else:
+        return _no_span
+
+
+def timed(name):
+    """Decorator that times every call of the function as a phase of
+    the given name."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def phase_stats():
+    """Return a line of statistics for every phase timed so far, the
+    slowest first. The self time of a phase leaves out the time spent
+    in the phases within it."""
+    return [
+        'Phase %s: %d calls, %1.3f s total, %1.3f s self'
+        % (name, count, total, self_time)
+        for name, (count, total, self_time) in sorted(
+            _phases.items(), key=lambda item: -item[1][1]
+        )
+    ]
+
+
+def write_trace():
+    """Write the spans timed so far to the C{STGIT_TRACE} file, if
+    there is one."""
+    if not _trace_file:
+        return
+    with io.open(_trace_file, 'wb') as f:
+        f.write(json.dumps(
+            dict(traceEvents=_events, displayTimeUnit='ms'),
+            indent=0,
+        ).encode('utf-8'))
@@ -19,7 +19,12 @@ from stgit.lib.git import (
     MergeConflictException,
     MergeException,
 )
+from stgit.lib.git.repository import git_version
+from stgit.lib.git.treemerge import Rebase, can_merge_trees
+from stgit.lib.journal import Journal, delete_journal
 from stgit.lib.log import log_entry, log_external_mods
+from stgit.lib.patchlist import PatchList
+from stgit.lib.timing import span, timed
 from stgit.out import out
 
 
@@ -114,9 +119,9 @@ class StackTransaction(object):
         self.stack = stack
         self._msg = msg
         self.patches = _TransPatchMap(stack)
-        self._applied = list(self.stack.patchorder.applied)
-        self._unapplied = list(self.stack.patchorder.unapplied)
-        self._hidden = list(self.stack.patchorder.hidden)
+        self._applied = PatchList(self.stack.patchorder.applied)
+        self._unapplied = PatchList(self.stack.patchorder.unapplied)
+        self._hidden = PatchList(self.stack.patchorder.hidden)
         self._error = None
         self._current_tree = self.stack.head.data.tree
         self._base = self.stack.base
@@ -128,6 +133,11 @@ class StackTransaction(object):
         else:
             self._allow_conflicts = allow_conflicts
         self._temp_index = self.temp_index_tree = None
+        self._journal = None
+        self._rewritten = []
+        # The objects created until run() writes the refs go into one
+        # pack, if there are many of them.
+        self.stack.repository.start_object_pack()
         if not allow_bad_head:
             self._assert_head_top_equal()
         if check_clean_iw:
@@ -139,7 +149,7 @@ class StackTransaction(object):
 
     @applied.setter
     def applied(self, value):
-        self._applied = list(value)
+        self._applied = PatchList(value)
 
     @property
     def unapplied(self):
@@ -147,7 +157,7 @@ class StackTransaction(object):
 
     @unapplied.setter
     def unapplied(self, value):
-        self._unapplied = list(value)
+        self._unapplied = PatchList(value)
 
     @property
     def hidden(self):
@@ -155,12 +165,19 @@ class StackTransaction(object):
 
     @hidden.setter
     def hidden(self, value):
-        self._hidden = list(value)
+        self._hidden = PatchList(value)
 
     @property
     def all_patches(self):
         return self._applied + self._unapplied + self._hidden
 
+    @property
+    def rewritten(self):
+        """The (old commit, new commit) pairs of the patches that L{run}
+        gave new commits, in the order a C{post-rewrite} hook would get
+        them."""
+        return self._rewritten
+
     @property
     def base(self):
         return self._base
@@ -210,6 +227,7 @@ class StackTransaction(object):
         if not iw.index.is_clean(self.stack.head):
             self._halt('Index not clean. Use "refresh" or "reset --hard"')
 
+    @timed('checkout')
     def _checkout(self, tree, iw, allow_bad_head):
         if not allow_bad_head:
             self._assert_head_top_equal()
@@ -247,14 +265,58 @@ class StackTransaction(object):
 
     def abort(self, iw=None):
         # The only state we need to restore is index+worktree.
+        self.stack.repository.end_object_pack()
         if iw:
             self._checkout(self.stack.head.data.tree, iw, allow_bad_head=True)
 
+    @timed('transaction')
     def run(self, iw=None, set_head=True, allow_bad_head=False,
             print_current_patch=True):
         """Execute the transaction. Will either succeed, or fail (with an
         exception) and do nothing."""
         self._check_consistency()
+        patchorder = self.stack.patchorder
+        old_applied = patchorder.applied
+        old_order = (old_applied, patchorder.unapplied, patchorder.hidden)
+        msg = self._msg + (' (CONFLICT)' if self._conflicts else '')
+
+        # All refs are written together at the end, so that either all
+        # of them are updated or none is.
+        refs = self.stack.repository.refs
+        refs.start_transaction()
+        try:
+            self._write(iw, set_head, allow_bad_head, msg)
+            if self._journal:
+                # Keep the journal if we halted, so that the rest of the
+                # patches can be pushed later.
+                if self._error:
+                    self._journal.write(self.stack.name)
+                else:
+                    delete_journal(self.stack.repository, self.stack.name)
+            with span('update refs'):
+                refs.commit_transaction(msg)
+        except BaseException:
+            refs.abort_transaction()
+            self.stack.discard_changes()
+            del self._rewritten[:]
+            patchorder.set_order(*old_order)
+            if self._current_tree != self.stack.head.data.tree:
+                self.abort(iw)
+            raise
+        self.stack.repository.end_object_pack()
+        self.stack.repository.copy_notes(
+            (old.sha1, new.sha1) for old, new in self._rewritten
+        )
+
+        if print_current_patch:
+            _print_current_patch(old_applied, self._applied)
+
+        if self._error:
+            return utils.STGIT_CONFLICT
+        else:
+            return utils.STGIT_SUCCESS
+
+    def _write(self, iw, set_head, allow_bad_head, msg):
         log_external_mods(self.stack)
         new_head = self.head
 
@@ -275,9 +337,6 @@ class StackTransaction(object):
             else:
                 out.error(self._error)
 
-        old_applied = self.stack.patchorder.applied
-        msg = self._msg + (' (CONFLICT)' if self._conflicts else '')
-
         # Write patches.
         for pn, commit in self.patches.items():
             if self.stack.patches.exists(pn):
@@ -285,6 +344,8 @@ class StackTransaction(object):
                 if commit is None:
                     p.delete()
                 else:
+                    if p.commit != commit:
+                        self._rewritten.append((p.commit, commit))
                     p.set_commit(commit, msg)
             else:
                 self.stack.patches.new(pn, commit, msg)
@@ -293,14 +354,6 @@ class StackTransaction(object):
         )
         log_entry(self.stack, msg)
 
-        if print_current_patch:
-            _print_current_patch(old_applied, self._applied)
-
-        if self._error:
-            return utils.STGIT_CONFLICT
-        else:
-            return utils.STGIT_SUCCESS
-
     def _halt(self, msg):
         self._error = msg
         raise TransactionHalted(msg)
@@ -319,8 +372,8 @@ class StackTransaction(object):
         other patches that had to be popped to accomplish this. Always
         succeeds."""
         popped = []
-        for i in range(len(self.applied)):
-            if p(self.applied[i]):
+        for i, pn in enumerate(self.applied):
+            if p(pn):
                 popped = self.applied[i:]
                 del self.applied[i:]
                 break
@@ -336,8 +389,8 @@ class StackTransaction(object):
         succeeds."""
         popped = []
         all_patches = self.applied + self.unapplied + self.hidden
-        for i in range(len(self.applied)):
-            if p(self.applied[i]):
+        for i, pn in enumerate(self.applied):
+            if p(pn):
                 popped = self.applied[i:]
                 del self.applied[i:]
                 break
@@ -358,6 +411,120 @@ class StackTransaction(object):
         """Attempt to push the named patch. If this results in conflicts,
         halts the transaction. If index+worktree are given, spill any
         conflicts to them."""
+        self.push_patches(
+            [pn], iw, allow_interactive, [pn] if already_merged else []
+        )
+
+    def push_patches(self, patches, iw=None, allow_interactive=False,
+                     merged=(), resume=None):
+        """Push the named patches in order, like L{push_patch} does for
+        one of them. The patches in C{merged} are already merged
+        upstream.
+
+        The patch commits are all read in one batch before starting.
+        The push then goes in runs of patches stacked on each other:
+        the top-level entries that changed between the base of a run
+        and the current top are found once (see L{Rebase}), and as long
+        as the patches change other entries, each of them only costs a
+        tree with those entries replaced and a commit with a rewritten
+        parent. The first patch that changes one of them is merged as
+        usual (see L{Index.merge}), and halts the transaction if it
+        conflicts; otherwise a new run starts after it. The new commits
+        are written together (see L{Repository.start_object_batch}).
+
+        The pushed patches are kept in a L{Journal}, which L{run}
+        records if the push halts, so that the rest of the patches can
+        be pushed later. When pushing at least C{stgit.journalinterval}
+        patches, it's also recorded every that many patches. Patches
+        that the journal C{resume} says were already pushed onto the
+        same commit are taken from there instead of being pushed
+        again."""
+        repository = self.stack.repository
+        commits = [self.patches[pn] for pn in patches]
+        repository.prefetch_commits(commits)
+        repository.prefetch_commits(c.data.parent for c in commits)
+        interval = config.getint('stgit.journalinterval')
+        if len(patches) < interval:
+            interval = 0
+        self._journal = Journal(
+            repository, self._msg, self.top, list(patches), []
+        )
+        if resume is not None or interval:
+            self._journal.write(self.stack.name)
+        reusable = list(resume.pushed) if resume else []
+        # The run of stacked patches being moved onto the current top,
+        # and the last patch in it.
+        rebase = last = None
+        # Without native object writes, collect the new trees and
+        # commits in memory and hand them to git together, instead of
+        # running git commit-tree once per patch.
+        repository.start_object_batch()
+        try:
+            for pn in patches:
+                orig = self.patches[pn]
+                if (
+                    reusable
+                    and reusable[0][:2] == (pn, orig)
+                    and reusable[0][2].data.parent == self.top
+                ):
+                    self._reuse_patch(pn, reusable.pop(0)[2])
+                    rebase = None
+                else:
+                    reusable = []
+                    tree = None
+                    if pn in merged:
+                        rebase = None
+                    else:
+                        parent = orig.data.parent
+                        if rebase is None or parent != last:
+                            rebase = Rebase(
+                                repository,
+                                parent.data.tree,
+                                self.top.data.tree,
+                            )
+                        tree = rebase.rebase(orig.data.tree)
+                        if tree is None:
+                            rebase = None
+                    last = orig
+                    with span('push_patch', patch=pn):
+                        self._push_patch(
+                            pn, iw, allow_interactive, pn in merged, tree
+                        )
+                if self._journal:
+                    self._journal.pushed.append((pn, orig, self.patches[pn]))
+                    if interval and len(self._journal.pushed) % interval == 0:
+                        self._journal.write(self.stack.name)
+        finally:
+            repository.end_object_batch()
+
+    def resume_patches(self, iw=None, allow_interactive=False):
+        """Push the patches that an interrupted or halted push didn't get
+        to, taking the ones it had already pushed from its journal."""
+        journal = Journal.read(self.stack.repository, self.stack.name)
+        if journal is None:
+            raise TransactionException('No interrupted push to resume')
+        self.push_patches(
+            [
+                pn for pn in journal.patches
+                if pn in self.unapplied or pn in self.hidden
+            ],
+            iw,
+            allow_interactive=allow_interactive,
+            resume=journal,
+        )
+
+    def _reuse_patch(self, pn, commit):
+        """Push the named patch as the given, already pushed, commit."""
+        out.start('Pushing patch "%s"' % pn)
+        if commit != self.patches[pn]:
+            self.patches[pn] = commit
+        self._move_to_applied(pn)
+        out.done('resumed')
+
+    def _push_patch(self, pn, iw, allow_interactive, already_merged,
+                    tree=None):
+        """Push the named patch. If its new C{tree} is already known, it
+        isn't merged again."""
         out.start('Pushing patch "%s"' % pn)
         orig_cd = self.patches[pn].data
         cd = orig_cd.set_committer(None)
@@ -366,12 +533,13 @@ class StackTransaction(object):
         if already_merged:
             # the resulting patch is empty
             tree = cd.parent.data.tree
-        else:
+        elif tree is None:
             base = oldparent.data.tree
             ours = cd.parent.data.tree
             theirs = cd.tree
-            tree, self.temp_index_tree = self.temp_index.merge(
-                base, ours, theirs, self.temp_index_tree)
+            with span('merge'):
+                tree, self.temp_index_tree = self.temp_index.merge(
+                    base, ours, theirs, self.temp_index_tree)
         s = ''
         merge_conflict = False
         if not tree:
@@ -384,8 +552,9 @@ class StackTransaction(object):
             try:
                 interactive = (allow_interactive and
                                config.getbool('stgit.autoimerge'))
-                iw.merge(base, ours, theirs, interactive=interactive)
-                tree = iw.index.write_tree()
+                with span('worktree merge'):
+                    iw.merge(base, ours, theirs, interactive=interactive)
+                    tree = iw.index.write_tree()
                 self._current_tree = tree
                 s = 'modified'
             except MergeConflictException as e:
@@ -423,12 +592,7 @@ class StackTransaction(object):
         # Update the stack state
         if comm:
             self.patches[pn] = comm
-        if pn in self.hidden:
-            x = self.hidden
-        else:
-            x = self.unapplied
-        del x[x.index(pn)]
-        self.applied.append(pn)
+        self._move_to_applied(pn)
 
         if merge_conflict:
             self._halt("%d merge conflict(s)" % len(self._conflicts))
@@ -447,12 +611,13 @@ class StackTransaction(object):
         if cd.is_nochange():
             s = ' (empty)'
         out.info('Pushed %s%s' % (pn, s))
+        self._move_to_applied(pn)
 
+    def _move_to_applied(self, pn):
         if pn in self.hidden:
-            x = self.hidden
+            self.hidden.remove(pn)
         else:
-            x = self.unapplied
-        del x[x.index(pn)]
+            self.unapplied.remove(pn)
         self.applied.append(pn)
 
     def reorder_patches(self, applied, unapplied, hidden=None, iw=None,
@@ -464,8 +629,9 @@ class StackTransaction(object):
                                     zip(self.applied, applied))))
         to_pop = set(self.applied[common:])
         self.pop_patches(lambda pn: pn in to_pop)
-        for pn in applied[common:]:
-            self.push_patch(pn, iw, allow_interactive=allow_interactive)
+        self.push_patches(
+            applied[common:], iw, allow_interactive=allow_interactive
+        )
 
         # We only get here if all the pushes succeeded.
         assert self.applied == applied
@@ -473,6 +639,7 @@ class StackTransaction(object):
         self.unapplied = unapplied
         self.hidden = hidden
 
+    @timed('check_merged')
     def check_merged(self, patches, tree=None, quiet=False):
         """Return a subset of patches already merged."""
         if not quiet:
@@ -504,3 +671,73 @@ class StackTransaction(object):
         if not quiet:
             out.done('%d found' % len(merged))
         return merged
+
+    def check_conflicts(self, patches, tree=None, quiet=False):
+        """Predict which of the patches would conflict if they were pushed
+        in order on top of C{tree} (by default the tree of the current
+        stack top). Return them as a list.
+
+        The patches are checked all at once rather than one after the
+        other: each patch together with the patches below it that it
+        was made on top of, and the patches above a conflict on their
+        own. Those that can't be merged in memory are tried with C{git
+        apply --3way} in parallel (see L{Repository.check_apply}).
+
+        Nothing is written to the repository, so the transaction can
+        simply be aborted afterwards."""
+        if not quiet:
+            out.start('Checking for conflicts')
+        repository = self.stack.repository
+        if tree is None:
+            tree = self.top.data.tree
+        commits = [self.patches[pn] for pn in patches]
+        repository.prefetch_commits(commits)
+        repository.prefetch_commits(c.data.parent for c in commits)
+
+        def conflicts(merges):
+            todo = [
+                (i, base, theirs) for i, (base, theirs) in enumerate(merges)
+                if not can_merge_trees(repository, base, tree, theirs)
+            ]
+            applies = repository.check_apply(
+                tree,
+                [
+                    repository.diff_tree(base, theirs, ['--full-index'])
+                    for i, base, theirs in todo
+                ],
+                three_way=git_version() >= (2, 32),
+            )
+            return set(i for (i, _, _), ok in zip(todo, applies) if not ok)
+
+        # Each series of patches made on top of each other is checked
+        # from the bottom of the series.
+        starts = []
+        bases = []
+        for i, c in enumerate(commits):
+            starts.append(i == 0 or c.data.parent != commits[i - 1])
+            bases.append(c.data.parent.data.tree if starts[-1] else bases[-1])
+        stacked = conflicts(
+            [(b, c.data.tree) for b, c in zip(bases, commits)]
+        )
+        found = set()
+        after_conflict = []
+        in_conflict = False
+        for i in range(len(commits)):
+            if starts[i]:
+                in_conflict = False
+            if in_conflict:
+                after_conflict.append(i)
+            elif i in stacked:
+                found.add(i)
+                in_conflict = True
+        own = conflicts(
+            [
+                (commits[i].data.parent.data.tree, commits[i].data.tree)
+                for i in after_conflict
+            ]
+        )
+        found.update(after_conflict[j] for j in own)
+        conflicting = [pn for i, pn in enumerate(patches) if i in found]
+        if not quiet:
+            out.done('%d found' % len(conflicting))
+        return conflicting
@@ -110,6 +110,10 @@ class MessagePrinter(object):
         self._stderr.write_bytes(byte_data)
         self._stderr.flush()
 
+    def flush(self):
+        self._stdout.flush()
+        self._stderr.flush()
+
     def info(self, *msgs):
         for msg in msgs:
             self._stderr.single_line(msg)
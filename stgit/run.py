@@ -18,6 +18,8 @@ from stgit.compat import (
     text,
 )
 from stgit.exception import StgException
+from stgit.lib import timing
+from stgit.lib.objcache import cache_stats
 from stgit.out import MessagePrinter, out
 
 __copyright__ = """
@@ -64,6 +66,7 @@ _log_mode, _logfile = get_log_mode(environ_get('STGIT_SUBPROCESS_LOG', ''))
 if _log_mode == 'profile':
     _log_starttime = datetime.datetime.now()
     _log_subproctime = 0.0
+    timing.enable()
 
 
 def duration(t1, t2):
@@ -75,7 +78,18 @@ def duration(t1, t2):
     )
 
 
+# Functions returning lines of statistics for the profiling log.
+_profile_stats = [cache_stats, timing.phase_stats]
+
+
+def add_profile_stats(f):
+    """Have L{finish_logging} add the lines returned by C{f} to the
+    profiling log."""
+    _profile_stats.append(f)
+
+
 def finish_logging():
+    timing.write_trace()
     if _log_mode != 'profile':
         return
     ttime = duration(_log_starttime, datetime.datetime.now())
@@ -85,7 +99,9 @@ def finish_logging():
         'Time spent in subprocess calls: %1.3f s (%1.1f%%)' % (
             _log_subproctime, 100 * _log_subproctime / ttime),
         'Remaining time: %1.3f s (%1.1f%%)' % (
-            rtime, 100 * rtime / ttime))
+            rtime, 100 * rtime / ttime),
+        *[line for f in _profile_stats for line in f()])
+    _logfile.flush()
 
 
 class Run(object):
@@ -146,22 +162,26 @@ class Run(object):
             raise self.exc('%s failed with code %d'
                            % (self._cmd[0], self.exitcode))
 
+    def _span(self):
+        return timing.span(' '.join(self._cmd[:2]), cmd=self._cmd)
+
     def _run_io(self):
         """Run with captured IO."""
         self._log_start()
-        try:
-            p = subprocess.Popen(
-                self._prep_cmd(),
-                env=self._prep_env(),
-                cwd=self._cwd,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            outdata, errdata = p.communicate(self._indata)
-            self.exitcode = p.returncode
-        except OSError as e:
-            raise self.exc('%s failed: %s' % (self._cmd[0], e))
+        with self._span():
+            try:
+                p = subprocess.Popen(
+                    self._prep_cmd(),
+                    env=self._prep_env(),
+                    cwd=self._cwd,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                )
+                outdata, errdata = p.communicate(self._indata)
+                self.exitcode = p.returncode
+            except OSError as e:
+                raise self.exc('%s failed: %s' % (self._cmd[0], e))
         if errdata and not self._discard_stderr:
             out.err_bytes(errdata)
         self._log_end(self.exitcode)
@@ -175,15 +195,16 @@ class Run(object):
         """Run without captured IO."""
         assert self._indata is None
         self._log_start()
-        try:
-            p = subprocess.Popen(
-                self._prep_cmd(),
-                env=self._prep_env(),
-                cwd=self._cwd,
-            )
-            self.exitcode = p.wait()
-        except OSError as e:
-            raise self.exc('%s failed: %s' % (self._cmd[0], e))
+        with self._span():
+            try:
+                p = subprocess.Popen(
+                    self._prep_cmd(),
+                    env=self._prep_env(),
+                    cwd=self._cwd,
+                )
+                self.exitcode = p.wait()
+            except OSError as e:
+                raise self.exc('%s failed: %s' % (self._cmd[0], e))
         self._log_end(self.exitcode)
         self._check_exitcode()
 
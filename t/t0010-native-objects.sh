@@ -0,0 +1,204 @@
+#!/bin/sh
+
+test_description='Test reading and writing objects without git subprocesses
+
+Compare what stgit.lib.git.odb reads straight from loose objects and
+pack files against what git cat-file and git ls-tree say, and check
+that objects written natively are identical to those git writes.'
+
+. ./test-lib.sh
+
+cat > compare.py <<EOF
+import subprocess
+import sys
+
+from stgit.lib.git import Repository
+from stgit.lib.git.objects import TreeData
+from stgit.lib.git.odb import ObjectDatabase
+
+repo = Repository('.git')
+odb = ObjectDatabase('.git')
+listing = subprocess.check_output(
+    ['git', 'cat-file', '--batch-all-objects', '--batch-check']
+).decode('utf-8')
+count = 0
+for line in listing.splitlines():
+    sha1, type_, size = line.split()
+    obj = odb.read(sha1)
+    if obj is None:
+        sys.exit('%s could not be read' % sha1)
+    if obj != repo._catfile.cat_file(sha1):
+        sys.exit('%s differs from cat-file' % sha1)
+    if type_ == 'tree':
+        native = TreeData.parse_raw(repo, obj[1])
+        lstree = {}
+        for entry in repo.run(
+            ['git', 'ls-tree', '-z', sha1]
+        ).output_lines('\0'):
+            perm, entry_type, rest = entry.split(' ', 2)
+            entry_sha1, name = rest.split('\t', 1)
+            lstree[name] = (perm, repo.get_object(entry_type, entry_sha1))
+        if dict(native) != lstree:
+            sys.exit('%s differs from ls-tree' % sha1)
+    count += 1
+print(count)
+EOF
+
+cat > write.py <<EOF
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import sys
+
+from stgit.lib.git import (
+    BlobData,
+    CommitData,
+    Date,
+    Person,
+    Repository,
+    TreeData,
+)
+
+repo = Repository('.git')
+head = repo.rev_parse('HEAD')
+blobs = [
+    repo.commit(BlobData(b))
+    for b in [b'', b'hello\\n', bytes(bytearray(range(256)))]
+]
+subtree = repo.commit(TreeData({'f': blobs[1]}))
+tree = repo.commit(TreeData({
+    'sub': subtree,
+    'sub.txt': blobs[0],
+    'sub-x': ('100755', blobs[1]),
+    'link': ('120000', blobs[1]),
+    'module': ('160000', head),
+    'bin': blobs[2],
+}))
+people = [
+    Person('A Ú Thor', 'author@example.com', Date('1234567890 -0730')),
+    Person('Plain', 'plain@example.com', Date('2005-04-07 22:13:13 +0200')),
+    Person('C Ó Mitter', 'committer@example.com', None),
+]
+messages = [b'subject\\n\\nbody\\n', 'Ünïcode\\n'.encode('utf-8'), b'']
+if sys.argv[1] == 'all':
+    # Things we leave to git.
+    people.append(Person(' Spacey. ', 'odd@example.com>', None))
+    messages.append(b'latin-1 \\xe9\\n')
+parents = [[], [head], [head, head.data.parent]]
+for author in people:
+    for committer in people:
+        for message in messages:
+            for p in parents:
+                c = repo.commit(CommitData(
+                    tree=tree, parents=p, message=message,
+                    author=author, committer=committer))
+                print(c.sha1)
+print(tree.sha1)
+print(' '.join(b.sha1 for b in blobs))
+EOF
+
+test_expect_success 'Create history with loose objects' '
+    test_seq 1 200 > big.txt &&
+    git add big.txt &&
+    git commit -m "initial" &&
+    for i in 1 2 3 4 5 6 7 8 9 10
+    do
+        sed -e "s/^$i\$/line $i changed/" big.txt > big.tmp &&
+        mv big.tmp big.txt &&
+        mkdir -p dir$i &&
+        echo "$i" > dir$i/file &&
+        git add big.txt dir$i &&
+        git commit -m "change $i" || return 1
+    done &&
+    "$PYTHON" compare.py > count &&
+    test "$(cat count)" -gt 40
+'
+
+test_expect_success 'Read objects from a pack with ref deltas' '
+    git -c repack.useDeltaBaseOffset=false repack -a -d -f --depth=5 &&
+    test -z "$(find .git/objects -path "*/objects/??/*" -type f)" &&
+    git verify-pack -v .git/objects/pack/pack-*.idx | grep -q " 1 [0-9a-f]\{40\}$" &&
+    "$PYTHON" compare.py
+'
+
+test_expect_success 'Read objects from a pack with offset deltas' '
+    git repack -a -d -f --depth=5 &&
+    git verify-pack -v .git/objects/pack/pack-*.idx | grep -q " 1 [0-9a-f]\{40\}$" &&
+    "$PYTHON" compare.py
+'
+
+test_expect_success 'Read packed and loose objects together' '
+    echo "more" >> big.txt &&
+    git add big.txt &&
+    git commit -m "loose again" &&
+    test -n "$(find .git/objects -path "*/objects/??/*" -type f)" &&
+    "$PYTHON" compare.py
+'
+
+test_expect_success 'Read objects through alternates' '
+    git clone -q --shared . shared &&
+    (
+        cd shared &&
+        echo "shared" > shared.txt &&
+        git add shared.txt &&
+        git commit -m "in shared clone" &&
+        "$PYTHON" ../compare.py
+    )
+'
+
+test_expect_success 'Fall back to git for what cannot be read' '
+    "$PYTHON" -c "
+from stgit.lib.git.odb import ObjectDatabase
+odb = ObjectDatabase(\".git\")
+assert odb.read(\"HEAD\") is None
+assert odb.read(\"HEAD:big.txt\") is None
+assert odb.read(\"0\" * 40) is None
+"
+'
+
+test_expect_success 'Write the same objects as git' '
+    GIT_AUTHOR_DATE="1112911993 +0100" &&
+    GIT_COMMITTER_DATE="1112911993 +0100" &&
+    export GIT_AUTHOR_DATE GIT_COMMITTER_DATE &&
+    for enc in UTF-8 ISO-8859-1
+    do
+        git config i18n.commitencoding $enc &&
+        git config stgit.nativeobjects false &&
+        "$PYTHON" write.py all > expected &&
+        git config stgit.nativeobjects true &&
+        "$PYTHON" write.py all > written &&
+        test_cmp expected written || return 1
+    done &&
+    git config --unset i18n.commitencoding &&
+    git fsck --no-dangling
+'
+
+test_expect_success 'Write objects without running git' '
+    GIT_AUTHOR_DATE="1112911993 +0100" &&
+    GIT_COMMITTER_DATE="1112911993 +0100" &&
+    export GIT_AUTHOR_DATE GIT_COMMITTER_DATE &&
+    git config stgit.nativeobjects true &&
+    STGIT_SUBPROCESS_LOG=debug:log "$PYTHON" write.py clean > written &&
+    test_line_count = 83 written &&
+    test_must_fail grep -e commit-tree -e mktree -e hash-object log
+'
+
+test_expect_success 'Run StGit with native objects' '
+    git config stgit.nativeobjects true &&
+    stg init &&
+    stg uncommit -n 3 &&
+    stg pop &&
+    echo "new" > new.txt &&
+    git add new.txt &&
+    stg new -m "add new.txt" p-new &&
+    stg refresh &&
+    stg push &&
+    stg undo &&
+    stg redo &&
+    stg series -d -e > series.txt &&
+    git config stgit.nativeobjects false &&
+    stg series -d -e > series-expected.txt &&
+    test_cmp series-expected.txt series.txt
+'
+
+test_done
@@ -0,0 +1,97 @@
+#!/bin/sh
+
+test_description='Test writing the objects of a transaction to one pack
+
+With stgit.nativeobjects, a transaction that creates at least
+stgit.unpacklimit objects should write them to a single pack file
+instead of as loose objects.'
+
+. ./test-lib.sh
+
+count_loose () {
+    find .git/objects -path "*/objects/??/*" -type f | wc -l
+}
+
+count_packs () {
+    find .git/objects/pack -name "pack-*.pack" | wc -l
+}
+
+test_expect_success 'Create a stack' '
+    git config stgit.nativeobjects true &&
+    git config stgit.unpacklimit 20 &&
+    echo "base" > base.txt &&
+    git add base.txt &&
+    git commit -m "base" &&
+    git tag base &&
+    echo "upstream" > upstream.txt &&
+    git add upstream.txt &&
+    git commit -m "upstream" &&
+    git tag upstream &&
+    git reset --hard base &&
+    stg init &&
+    for i in $(test_seq 1 30)
+    do
+        stg new -m "patch $i" p$i &&
+        echo "$i" > file$i &&
+        stg add file$i &&
+        stg refresh || return 1
+    done &&
+    git repack -a -d
+'
+
+test_expect_success 'Rebase writes the new patch commits to one pack' '
+    ls .git/objects/pack/pack-*.idx > packs-before &&
+    stg rebase upstream &&
+    ls .git/objects/pack/pack-*.idx > packs-after &&
+    for idx in $(comm -13 packs-before packs-after)
+    do
+        git verify-pack -v $idx > $(basename $idx).contents || return 1
+    done &&
+    for i in $(test_seq 1 30)
+    do
+        sha1=$(stg id p$i) &&
+        grep -l "^$sha1 commit " *.contents >> patch-packs &&
+        test_path_is_missing .git/objects/$(echo $sha1 | cut -c1-2)/$(
+            echo $sha1 | cut -c3-) || return 1
+    done &&
+    test "$(sort -u patch-packs | wc -l)" -eq 1 &&
+    git fsck --no-dangling &&
+    stg series -d > series &&
+    test_line_count = 30 series &&
+    for i in $(test_seq 1 30)
+    do
+        test "$(stg show p$i | grep -c "^+$i\$")" -eq 1 || return 1
+    done
+'
+
+test_expect_success 'Small transactions write loose objects' '
+    packs=$(count_packs) &&
+    loose=$(count_loose) &&
+    stg pop &&
+    stg push &&
+    test "$(count_packs)" -eq $packs &&
+    test "$(count_loose)" -gt $loose &&
+    git fsck --no-dangling
+'
+
+test_expect_success 'Rebase back and forth' '
+    stg rebase base &&
+    test "$(stg id p1^)" = "$(git rev-parse base)" &&
+    stg rebase upstream &&
+    test "$(stg id p1^)" = "$(git rev-parse upstream)" &&
+    stg undo --hard &&
+    test "$(stg id p1^)" = "$(git rev-parse base)" &&
+    git fsck --no-dangling
+'
+
+test_expect_success 'No packs without native objects' '
+    git config stgit.nativeobjects false &&
+    git repack -a -d &&
+    packs=$(count_packs) &&
+    stg rebase upstream &&
+    stg push -a &&
+    test "$(count_packs)" -eq $packs &&
+    test "$(count_loose)" -gt 30
+'
+
+test_done
@@ -0,0 +1,54 @@
+#!/bin/sh
+
+test_description='Test that a stack transaction updates all refs at once
+
+All the refs a StGit command changes should be written by a single
+"git update-ref --stdin", so that either all of them are updated or
+none is.'
+
+. ./test-lib.sh
+
+test_expect_success 'Create some patches' '
+    stg init &&
+    for i in 1 2 3 4 5 6 7 8
+    do
+        stg new -m "patch $i" p$i &&
+        echo "$i" > file$i &&
+        stg add file$i &&
+        stg refresh || return 1
+    done &&
+    stg pop -a
+'
+
+test_expect_success 'Push all patches with one ref update' '
+    STGIT_SUBPROCESS_LOG=debug:log stg push -a &&
+    test "$(grep -c "update-ref" log)" -eq 1 &&
+    grep -q "'"'update-ref', '-m', 'push', '--stdin'"'" log &&
+    test "$(stg top)" = "p8" &&
+    test "$(git rev-parse HEAD)" = "$(stg id p8)"
+'
+
+test_expect_success 'Failing ref update leaves the stack alone' '
+    stg pop -a &&
+    stg series > series-before &&
+    git show-ref > refs-before &&
+    >.git/refs/heads/master.lock &&
+    command_error stg push -a &&
+    rm .git/refs/heads/master.lock &&
+    stg series > series-after &&
+    git show-ref > refs-after &&
+    test_cmp series-before series-after &&
+    test_cmp refs-before refs-after &&
+    stg push -a &&
+    test "$(stg top)" = "p8"
+'
+
+test_expect_success 'Rename a branch' '
+    stg branch --rename master renamed &&
+    test "$(stg branch)" = "renamed" &&
+    test "$(stg series --applied -c)" -eq 8 &&
+    test -z "$(git for-each-ref refs/patches/master)" &&
+    test "$(git for-each-ref refs/patches/renamed | wc -l)" -eq 8
+'
+
+test_done
@@ -0,0 +1,111 @@
+#!/bin/sh
+
+test_description='Test reading refs without git show-ref
+
+Compare what the Refs class reads from packed-refs and loose ref files
+with what git show-ref says.'
+
+. ./test-lib.sh
+
+cat > compare.py <<EOF
+import subprocess
+import sys
+
+from stgit.lib.git import Repository
+
+repo = Repository('.git')
+expected = {}
+listing = subprocess.check_output(['git', 'show-ref']).decode('utf-8')
+for line in listing.splitlines():
+    sha1, ref = line.split(' ', 1)
+    expected[ref] = sha1
+namespaces = set(['refs/'])
+for ref in expected:
+    parts = ref.split('/')
+    for i in range(2, len(parts)):
+        namespaces.add('/'.join(parts[:i]) + '/')
+for ns in sorted(namespaces, reverse=True):
+    names = set(repo.refs.namespace(ns))
+    if names != set(r for r in expected if r.startswith(ns)):
+        sys.exit('%s: %s' % (ns, sorted(names)))
+repo.refs.reset_cache()
+for ref, sha1 in expected.items():
+    if repo.refs.get(ref).sha1 != sha1:
+        sys.exit('%s differs' % ref)
+for ref in ['refs/heads/nosuch', 'refs/nosuch/x', 'HEAD', 'refs/heads/a']:
+    if ref not in expected and repo.refs.exists(ref):
+        sys.exit('%s should not exist' % ref)
+print(len(expected))
+EOF
+
+test_expect_success 'Create refs' '
+    test_commit_bulk() {
+        for i in $(test_seq 1 $1)
+        do
+            echo $i > file &&
+            git add file &&
+            git commit -q -m "commit $i" &&
+            git tag -a -m "tag $i" v$i &&
+            git branch b$i &&
+            git branch nested/b$i || return 1
+        done
+    } &&
+    test_commit_bulk 20 &&
+    git update-ref refs/remotes/origin/master HEAD~3 &&
+    git symbolic-ref refs/remotes/origin/HEAD refs/remotes/origin/master &&
+    "$PYTHON" compare.py > count &&
+    test "$(cat count)" -eq 63
+'
+
+test_expect_success 'Read packed refs' '
+    git pack-refs --all &&
+    test "$(find .git/refs -type f)" = .git/refs/remotes/origin/HEAD &&
+    grep -q "^# pack-refs with:.* sorted" .git/packed-refs &&
+    grep -q "^\\^" .git/packed-refs &&
+    "$PYTHON" compare.py
+'
+
+test_expect_success 'Loose refs override packed refs' '
+    git update-ref refs/heads/b3 HEAD~1 &&
+    git update-ref refs/heads/nested/b5 HEAD~7 &&
+    git update-ref refs/heads/new HEAD~2 &&
+    git update-ref -d refs/heads/b7 &&
+    "$PYTHON" compare.py
+'
+
+test_expect_success 'Read a packed-refs file without a header' '
+    git pack-refs --all &&
+    sed -e "/^#/d" .git/packed-refs > packed &&
+    mv packed .git/packed-refs &&
+    "$PYTHON" compare.py
+'
+
+test_expect_success 'Notice refs changed by git' '
+    git pack-refs --all &&
+    "$PYTHON" -c "
+from stgit.lib.git import Repository
+import subprocess
+repo = Repository(\".git\")
+def check(ref, rev):
+    sha1 = subprocess.check_output([\"git\", \"rev-parse\", rev])
+    assert repo.refs.get(ref).sha1 == sha1.decode(\"ascii\").strip(), ref
+check(\"refs/heads/b1\", \"b1\")
+subprocess.check_call([\"git\", \"update-ref\", \"refs/heads/b1\", \"HEAD\"])
+check(\"refs/heads/b1\", \"HEAD\")
+subprocess.check_call([\"git\", \"pack-refs\", \"--all\"])
+subprocess.check_call([\"git\", \"update-ref\", \"refs/heads/b1\", \"HEAD~1\"])
+check(\"refs/heads/b1\", \"HEAD~1\")
+subprocess.check_call([\"git\", \"branch\", \"-D\", \"b2\"])
+assert not repo.refs.exists(\"refs/heads/b2\")
+"
+'
+
+test_expect_success 'Run StGit without git show-ref' '
+    stg init &&
+    stg new -m p1 &&
+    STGIT_SUBPROCESS_LOG=debug:log stg top &&
+    test_must_fail grep -e show-ref -e for-each-ref log &&
+    "$PYTHON" compare.py
+'
+
+test_done
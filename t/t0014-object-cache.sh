@@ -0,0 +1,47 @@
+#!/bin/sh
+
+test_description='Test the limit on cached object data
+
+With a tiny stgit.objectcachesize, the data of cached commits and
+trees gets dropped and read again all the time, which must not change
+what StGit does. The cache statistics go to the profiling log.'
+
+. ./test-lib.sh
+
+test_expect_success 'Create a stack' '
+    stg init &&
+    for i in 1 2 3 4 5 6 7 8 9 10
+    do
+        stg new -m "patch $i" p$i &&
+        echo "$i" > file$i &&
+        stg add file$i &&
+        stg refresh || return 1
+    done &&
+    stg pop -n 4
+'
+
+test_expect_success 'Run commands with a tiny object cache' '
+    stg series -d > series-expected &&
+    stg log > log-expected &&
+    git config stgit.objectcachesize 2 &&
+    stg series -d > series &&
+    stg log > log &&
+    test_cmp series-expected series &&
+    test_cmp log-expected log &&
+    stg push -a &&
+    stg goto p3 &&
+    stg delete p5 &&
+    stg series -d > series &&
+    test_line_count = 9 series &&
+    test "$(stg top)" = p3
+'
+
+test_expect_success 'Report cache statistics in the profiling log' '
+    STGIT_SUBPROCESS_LOG=profile:log stg series -d &&
+    grep "^Object cache commits: [0-9]* hits, [0-9]* misses, [1-9][0-9]* evictions" log &&
+    git config stgit.objectcachesize 0 &&
+    STGIT_SUBPROCESS_LOG=profile:log2 stg series -d &&
+    grep "^Object cache commits: [0-9]* hits, [0-9]* misses, 0 evictions" log2
+'
+
+test_done
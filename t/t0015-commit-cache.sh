@@ -0,0 +1,66 @@
+#!/bin/sh
+
+test_description='Test the persistent commit cache
+
+Commits that StGit has parsed once are kept in .git/stgit-cache, so
+that later commands do not have to ask git for them.'
+
+. ./test-lib.sh
+
+test_expect_success 'Create a stack' '
+    stg init &&
+    for i in 1 2 3 4 5 6
+    do
+        stg new -m "patch $i" p$i &&
+        echo "$i" > file$i &&
+        stg add file$i &&
+        stg refresh || return 1
+    done &&
+    stg pop -n 2 &&
+    stg series -d > series-expected &&
+    test -f .git/stgit-cache/commits.sqlite
+'
+
+test_expect_success 'Read commits from the cache' '
+    stg cache --stats > stats-before &&
+    stg series -d > series &&
+    test_cmp series-expected series &&
+    stg cache --stats > stats &&
+    test "$(grep Misses stats)" = "$(grep Misses stats-before)" &&
+    test "$(grep Hits stats)" != "$(grep Hits stats-before)"
+'
+
+test_expect_success 'Disable the cache' '
+    test_config stgit.commitcachesize 0 &&
+    stg series -d > series &&
+    test_cmp series-expected series &&
+    command_error stg cache --stats
+'
+
+test_expect_success 'Do not use the cache with replace refs' '
+    p1=$(stg id p1) &&
+    test_when_finished "git replace -d $p1" &&
+    git replace $p1 "$(stg id p2)" &&
+    stg series -d > series &&
+    grep "^+ p1 *# patch 2$" series
+'
+
+test_expect_success 'Drop the least recently used commits' '
+    test_config stgit.commitcachesize 3 &&
+    stg push -a &&
+    stg series -d > series &&
+    stg cache > stats &&
+    grep "^Entries: 3$" stats
+'
+
+test_expect_success 'Clear the cache' '
+    stg cache --clear &&
+    stg cache > stats &&
+    grep "^Entries: 0$" stats &&
+    stg series -d > series &&
+    test_line_count = 6 series &&
+    stg cache > stats &&
+    test_must_fail grep "^Entries: 0$" stats
+'
+
+test_done
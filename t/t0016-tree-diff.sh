@@ -0,0 +1,103 @@
+#!/bin/sh
+
+test_description='Test comparing trees without git diff-tree
+
+Compare the files that Repository.diff_tree_files says differ between
+trees with what git diff-tree -r says.'
+
+. ./test-lib.sh
+
+cat > compare.py <<EOF
+import itertools
+import subprocess
+import sys
+
+from stgit.lib.git import Repository
+
+repo = Repository('.git')
+commits = subprocess.check_output(
+    ['git', 'rev-list', '--all']
+).decode('utf-8').split()
+trees = [repo.rev_parse(c, object_type='tree') for c in commits]
+count = 0
+for t1, t2 in itertools.product(trees, repeat=2):
+    expected = []
+    output = subprocess.check_output(
+        ['git', 'diff-tree', '-r', '-z', t1.sha1, t2.sha1]
+    )
+    fields = iter(output.decode('utf-8').split('\0'))
+    for x in fields:
+        if x:
+            omode, nmode, osha1, nsha1, status = x[1:].split(' ')
+            fn = next(fields)
+            expected.append((omode, nmode, osha1, nsha1, status, fn))
+    actual = [
+        (omode, nmode, ob.sha1, nb.sha1, status, fn1)
+        for omode, nmode, ob, nb, status, fn1, fn2
+        in repo.diff_tree_files(t1, t2)
+    ]
+    if actual != expected:
+        sys.exit('%s %s:\n%s\n%s' % (t1.sha1, t2.sha1, actual, expected))
+    count += len(actual)
+print(count)
+EOF
+
+test_expect_success 'Create trees' '
+    mkdir -p a/b/c d &&
+    echo 1 > a/b/c/file &&
+    echo 2 > a/file &&
+    echo 3 > a.txt &&
+    echo 4 > d/file &&
+    echo 5 > x &&
+    git add . &&
+    git commit -m "initial" &&
+    echo changed > a/b/c/file &&
+    chmod +x x &&
+    git commit -a -m "change file and mode" &&
+    git rm -q -r d &&
+    mkdir d &&
+    echo 6 > d/file &&
+    echo 7 > d/other &&
+    git add d &&
+    git commit -m "recreate d" &&
+    git rm -q a.txt &&
+    mkdir a.txt &&
+    echo 8 > a.txt/file &&
+    git add a.txt &&
+    git commit -m "file to directory" &&
+    git rm -q -r a &&
+    echo 9 > a &&
+    git add a &&
+    git commit -m "directory to file" &&
+    git rm -q x &&
+    ln -s a x &&
+    git add x &&
+    git commit -m "file to symlink" &&
+    git update-index --add --cacheinfo 160000 "$(git rev-parse HEAD)" sub &&
+    git commit -m "add a gitlink" &&
+    git update-index --cacheinfo 160000 "$(git rev-parse HEAD~2)" sub &&
+    mkdir sub &&
+    git commit -m "change the gitlink" &&
+    stg init &&
+    stg new -m "patch" &&
+    echo 10 > "a file with spaces" &&
+    echo 11 > d/other &&
+    git add "a file with spaces" &&
+    stg refresh --force
+'
+
+test_expect_success 'Compare with git diff-tree' '
+    "$PYTHON" compare.py > count &&
+    test "$(cat count)" -gt 100
+'
+
+test_expect_success 'List the files of a patch' '
+    stg files --bare > files &&
+    cat > expected <<-\EOF &&
+	a file with spaces
+	d/other
+	EOF
+    test_cmp expected files
+'
+
+test_done
@@ -0,0 +1,131 @@
+#!/bin/sh
+
+test_description='Test merging trees in memory
+
+Patches that change different files than the commits below them are
+pushed without a temporary index, and runs of patches that change
+other top-level entries are moved onto the new base in bulk. Check that the merged trees are the
+same as those git apply would make.'
+
+. ./test-lib.sh
+
+cat > compare.py <<EOF
+import itertools
+import subprocess
+import sys
+
+from stgit.lib.git import MergeException, Repository
+from stgit.lib.git.treemerge import Rebase, merge_trees
+
+repo = Repository('.git')
+# The commits of the branch and the patches, but not the stack log.
+refs = [
+    ref for ref in subprocess.check_output(
+        ['git', 'for-each-ref', '--format=%(refname)']
+    ).decode('utf-8').split()
+    if not ref.endswith(('.stgit', '.log'))
+]
+commits = subprocess.check_output(
+    ['git', 'rev-list'] + refs
+).decode('utf-8').split()
+trees = set(repo.rev_parse(c, object_type='tree') for c in commits)
+merged = 0
+for base, ours, theirs in itertools.permutations(trees, 3):
+    result = merge_trees(repo, base, ours, theirs)
+    index = repo.temp_index()
+    try:
+        index.read_tree(ours)
+        index.apply_treediff(base, theirs, quiet=True)
+        expected = index.write_tree()
+    except MergeException:
+        expected = None
+    finally:
+        index.delete()
+    if expected is not None and result not in (None, expected):
+        sys.exit('%s %s %s' % (base.sha1, ours.sha1, theirs.sha1))
+    rebased = Rebase(repo, base, ours).rebase(theirs)
+    if expected is not None and rebased not in (None, expected):
+        sys.exit('rebase %s %s %s' % (base.sha1, ours.sha1, theirs.sha1))
+    if expected is None and rebased is not None:
+        sys.exit('rebase %s %s %s' % (base.sha1, ours.sha1, theirs.sha1))
+    if result is not None:
+        merged += 1
+print(merged)
+EOF
+
+test_expect_success 'Create a stack' '
+    mkdir -p dir/sub other &&
+    for f in a dir/b dir/sub/c other/d
+    do
+        echo "$f" > $f || return 1
+    done &&
+    git add . &&
+    git commit -m "initial" &&
+    stg init &&
+    stg new -m "change a" p1 &&
+    echo change >> a &&
+    stg refresh &&
+    stg new -m "change dir/sub/c" p2 &&
+    echo change >> dir/sub/c &&
+    stg refresh &&
+    stg new -m "add dir/e" p3 &&
+    echo e > dir/e &&
+    stg add dir/e &&
+    stg refresh &&
+    stg new -m "remove other" p4 &&
+    stg rm other/d &&
+    stg refresh &&
+    stg pop -a &&
+    echo change >> dir/b &&
+    git commit -a -m "change dir/b" &&
+    echo f > dir/sub/f &&
+    git add dir/sub/f &&
+    git commit -m "add dir/sub/f"
+'
+
+test_expect_success 'Push patches with in-memory merges' '
+    STGIT_SUBPROCESS_LOG=profile:log stg push -a &&
+    grep "^Tree merges: [1-9][0-9]* in memory, 0 fell back" log &&
+    grep "^Tree merges: .*, [1-9][0-9]* rebased$" log &&
+    test_must_fail grep -e "subprocess.*apply" -e write-tree log &&
+    test "$(stg top)" = p4 &&
+    test_line_count = 2 dir/sub/c &&
+    test -f dir/sub/f &&
+    test_line_count = 2 dir/b &&
+    test -f dir/e &&
+    test_path_is_missing other
+'
+
+test_expect_success 'Fall back to git apply for the same file' '
+    stg pop -a &&
+    echo "other change" >> a &&
+    git commit -a -m "change a" &&
+    STGIT_SUBPROCESS_LOG=profile:log2 conflict stg push p1 &&
+    grep "^Tree merges: 0 in memory, 1 fell back" log2 &&
+    stg undo --hard
+'
+
+test_expect_success 'Move a patch onto a base that made a file a directory' '
+    stg new -m "add g" p5 &&
+    echo g > g &&
+    stg add g &&
+    stg refresh &&
+    stg pop &&
+    git rm -q a &&
+    mkdir a &&
+    echo x > a/x &&
+    git add a/x &&
+    git commit -m "a is a directory" &&
+    STGIT_SUBPROCESS_LOG=profile:log3 stg push p5 &&
+    grep "^Tree merges: .*, 1 rebased$" log3 &&
+    test -f a/x &&
+    test -f g &&
+    test "$(stg files p5)" = "A g"
+'
+
+test_expect_success 'Compare with git apply' '
+    "$PYTHON" compare.py > merged &&
+    test "$(cat merged)" -gt 0
+'
+
+test_done
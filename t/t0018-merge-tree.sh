@@ -0,0 +1,70 @@
+#!/bin/sh
+
+test_description='Test merging with git merge-tree
+
+With git 2.38 or later, merges that git apply cannot do are done with
+git merge-tree, without an index or a worktree, unless the
+stgit.mergetree config option turns that off.'
+
+. ./test-lib.sh
+
+if ! git merge-tree -h 2>&1 | grep -q -e --write-tree
+then
+    skip_all='git merge-tree --write-tree is not available'
+    test_done
+fi
+
+# The tests choose the backend themselves.
+sane_unset GIT_CONFIG_COUNT
+
+test_expect_success 'Create a stack' '
+    test_seq 1 20 > file &&
+    git add file &&
+    git commit -m "initial" &&
+    stg init &&
+    stg new -m "change file" p1 &&
+    sed "s/^2$/two/" file > file.new && mv file.new file &&
+    stg refresh &&
+    stg new -m "change file again" p2 &&
+    sed "s/^19$/nineteen/" file > file.new && mv file.new file &&
+    stg refresh &&
+    stg pop -a &&
+    git mv file renamed &&
+    git commit -m "rename file"
+'
+
+test_expect_success 'Push patches to a renamed file with git merge-tree' '
+    git config stgit.mergetree yes &&
+    STGIT_SUBPROCESS_LOG=profile:log stg push -a &&
+    grep "merge-tree" log &&
+    test_must_fail grep -e merge-recursive -e "subprocess.*apply" log &&
+    test "$(stg top)" = p2 &&
+    test_path_is_missing file &&
+    grep -x two renamed &&
+    grep -x nineteen renamed &&
+    test -z "$(git status --porcelain -uno)"
+'
+
+test_expect_success 'Push patches with merge-recursive' '
+    stg undo --hard &&
+    git config stgit.mergetree no &&
+    STGIT_SUBPROCESS_LOG=profile:log2 stg push -a &&
+    grep "merge-recursive" log2 &&
+    test_must_fail grep "merge-tree" log2 &&
+    test "$(stg top)" = p2 &&
+    grep -x two renamed &&
+    grep -x nineteen renamed
+'
+
+test_expect_success 'Spill conflicts to the worktree' '
+    stg pop -a &&
+    git config stgit.mergetree yes &&
+    sed "s/^2$/deux/" renamed > file.new && mv file.new renamed &&
+    git commit -a -m "change renamed" &&
+    conflict stg push p1 &&
+    grep -e "^<<<<<<< current" renamed &&
+    grep -e "^>>>>>>> patched" renamed &&
+    test "$(stg status renamed)" = "UU renamed"
+'
+
+test_done
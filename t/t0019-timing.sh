@@ -0,0 +1,65 @@
+#!/bin/sh
+
+test_description='Test timing the phases of commands
+
+The profiling log sums up the time spent in each phase, and
+$STGIT_TRACE names a file to write all the timed spans to, in the
+Chrome trace event format.'
+
+. ./test-lib.sh
+
+cat > check-trace.py <<EOF
+import json
+import sys
+
+with open('trace.json') as f:
+    events = json.load(f)['traceEvents']
+names = set(e['name'] for e in events)
+for phase in sys.argv[1:]:
+    if phase not in names:
+        sys.exit('no %s span' % phase)
+for e in events:
+    if e['ph'] != 'X' or e['dur'] < 0 or e['ts'] < 0:
+        sys.exit('bad event %r' % e)
+pushed = [e['args']['patch'] for e in events if e['name'] == 'push_patch']
+print(' '.join(pushed))
+EOF
+
+test_expect_success 'Create a stack' '
+    test_seq 1 10 > file &&
+    git add file &&
+    git commit -m "initial" &&
+    stg init &&
+    stg new -m "change file" p1 &&
+    sed "s/^2$/two/" file > file.new && mv file.new file &&
+    stg refresh &&
+    stg new -m "change file again" p2 &&
+    sed "s/^9$/nine/" file > file.new && mv file.new file &&
+    stg refresh &&
+    stg pop -a &&
+    sed "s/^5$/five/" file > file.new && mv file.new file &&
+    git commit -a -m "change the middle of file"
+'
+
+test_expect_success 'Summarize the phases in the profiling log' '
+    STGIT_SUBPROCESS_LOG=profile:log stg push p1 &&
+    grep "^Phase transaction: 1 calls" log &&
+    grep "^Phase push_patch: 1 calls" log &&
+    grep "^Phase log_entry: " log &&
+    grep "^Phase set_commit: 1 calls" log &&
+    grep "^Phase git " log
+'
+
+test_expect_success 'No summary without profiling' '
+    STGIT_SUBPROCESS_LOG=debug:log2 stg pop p1 &&
+    test_must_fail grep "^Phase" log2
+'
+
+test_expect_success 'Write a trace' '
+    STGIT_TRACE=trace.json stg push p1 p2 &&
+    "$PYTHON" check-trace.py transaction push_patch checkout log_entry \
+        set_commit > pushed &&
+    test "$(cat pushed)" = "p1 p2"
+'
+
+test_done
@@ -0,0 +1,111 @@
+#!/bin/sh
+
+test_description='Test keeping the stack in a snapshot
+
+With stgit.stacksnapshot, the order and commits of all patches are kept
+in one blob that refs/stacks/<branch> points to, instead of in the
+applied, unapplied and hidden files and one ref per patch.'
+
+. ./test-lib.sh
+
+count_subprocesses () {
+    rm -f log &&
+    STGIT_SUBPROCESS_LOG=profile:log "$@" > /dev/null &&
+    grep -c "^Running subprocess" log
+}
+
+test_expect_success 'Create a stack with a snapshot' '
+    git config stgit.stacksnapshot yes &&
+    stg init &&
+    for i in 1 2 3 4 5
+    do
+        stg new -m "patch $i" p$i &&
+        echo "$i" > file$i &&
+        stg add file$i &&
+        stg refresh || return 1
+    done &&
+    git rev-parse --verify refs/stacks/master &&
+    test -z "$(git for-each-ref refs/patches/master)" &&
+    test_path_is_missing .git/patches/master/applied &&
+    git cat-file -p refs/stacks/master:stack > stack &&
+    grep "^  p5: $(stg id p5)\$" stack
+'
+
+test_expect_success 'Change the stack' '
+    stg pop -n 2 &&
+    stg hide p5 &&
+    stg rename p1 first &&
+    stg delete p3 &&
+    stg edit -m "patch two" p2 &&
+    stg goto p4 &&
+    test "$(echo $(stg series --noprefix -a))" = "first p2 p4 p5" &&
+    test "$(echo $(stg series --applied --noprefix))" = "first p2 p4" &&
+    test "$(stg top)" = p4 &&
+    test "$(git rev-parse HEAD)" = "$(stg id p4)" &&
+    test "$(git log -1 --format=%s $(stg id p2))" = "patch two"
+'
+
+test_expect_success 'Undo and redo' '
+    stg undo &&
+    test "$(stg top)" = p2 &&
+    stg redo &&
+    test "$(stg top)" = p4
+'
+
+test_expect_success 'An aborted command leaves the snapshot alone' '
+    snapshot=$(git rev-parse refs/stacks/master) &&
+    stg pop &&
+    echo conflict > file4 &&
+    command_error stg push --keep 2>err &&
+    grep "Command aborted" err &&
+    test "$(stg top)" = p2 &&
+    stg id p4 &&
+    rm file4 &&
+    stg push &&
+    test "$(git rev-parse refs/stacks/master^)" != "$snapshot"
+'
+
+test_expect_success 'The snapshot keeps the patches from garbage collection' '
+    git gc --prune=now &&
+    git fsck --no-dangling &&
+    stg series -a -d > series &&
+    test_line_count = 4 series
+'
+
+test_expect_success 'Clone and rename the branch' '
+    stg branch --clone clone &&
+    test "$(echo $(stg series --noprefix))" = "first p2 p4" &&
+    git rev-parse --verify refs/stacks/clone &&
+    stg branch --rename clone renamed &&
+    test_must_fail git rev-parse --verify -q refs/stacks/clone &&
+    test "$(echo $(stg series --noprefix))" = "first p2 p4" &&
+    stg branch master &&
+    stg branch --delete --force renamed &&
+    test_must_fail git rev-parse --verify -q refs/stacks/renamed
+'
+
+test_expect_success 'Read the stack with the same subprocesses for any size' '
+    small=$(count_subprocesses stg series -d) &&
+    for i in $(test_seq 6 40)
+    do
+        stg new -m "patch $i" p$i || return 1
+    done &&
+    big=$(count_subprocesses stg series -d) &&
+    test "$big" -eq "$small"
+'
+
+test_expect_success 'Go back to files and refs' '
+    stg series -a -d > series-before &&
+    git config stgit.stacksnapshot no &&
+    stg series -a -d > series-after &&
+    test_cmp series-before series-after &&
+    test_must_fail git rev-parse --verify -q refs/stacks/master &&
+    test "$(git rev-parse refs/patches/master/p4)" = "$(stg id p4)" &&
+    test_path_is_file .git/patches/master/applied &&
+    stg pop -a &&
+    stg push -a &&
+    stg series -d > series &&
+    test_line_count = 38 series
+'
+
+test_done
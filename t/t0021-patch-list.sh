@@ -0,0 +1,86 @@
+#!/bin/sh
+
+test_description='Test the indexed lists of patches
+
+The applied, unapplied and hidden patches are kept in PatchLists, which
+find a patch by name in constant time.'
+
+. ./test-lib.sh
+
+cat > check-patchlist.py <<EOF
+from stgit.lib.patchlist import PatchList
+
+pl = PatchList(['p%d' % i for i in range(10)])
+pl.remove('p0')
+pl.remove('p4')
+pl.remove('p9')
+assert pl == ['p1', 'p2', 'p3', 'p5', 'p6', 'p7', 'p8'], pl
+assert len(pl) == 7 and 'p4' not in pl and 'p5' in pl
+assert pl.index('p5') == 3 and pl[3] == 'p5' and pl[-1] == 'p8'
+assert pl[1:3] == ['p2', 'p3'] and isinstance(pl[1:3], list)
+del pl[5:]
+assert pl == ('p1', 'p2', 'p3', 'p5', 'p6') and 'p7' not in pl
+del pl[1]
+assert pl.index('p6') == 3
+pl.append('p0')
+pl.insert(0, 'p9')
+pl.rename('p3', 'three')
+assert pl == ['p9', 'p1', 'three', 'p5', 'p6', 'p0'], pl
+assert pl.index('three') == 2 and 'p3' not in pl
+assert pl.pop() == 'p0' and pl.pop(0) == 'p9'
+assert ['x'] + pl + ['y'] == ['x', 'p1', 'three', 'p5', 'p6', 'y']
+assert list(reversed(pl)) == ['p6', 'p5', 'three', 'p1']
+for bad in [lambda: pl.append('p1'), lambda: pl.remove('p0'),
+            lambda: pl.index('p0')]:
+    try:
+        bad()
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('no ValueError')
+print('ok')
+EOF
+
+test_expect_success 'PatchList operations' '
+    test "$("$PYTHON" check-patchlist.py)" = ok
+'
+
+test_expect_success 'Create a stack' '
+    stg init &&
+    for i in $(test_seq 1 30)
+    do
+        stg new -m "patch $i" p$i || return 1
+    done &&
+    stg pop -a &&
+    stg push p1..p10
+'
+
+test_expect_success 'Float, sink, hide and push patches' '
+    stg float p3 p5 &&
+    test "$(echo $(stg series --applied --noprefix))" = \
+        "p1 p2 p4 p6 p7 p8 p9 p10 p3 p5" &&
+    stg sink --to p2 p12 p9 &&
+    test "$(echo $(stg series --applied --noprefix))" = \
+        "p1 p12 p9 p2 p4 p6 p7 p8 p10 p3 p5" &&
+    stg hide p11 p20..p30 &&
+    test "$(echo $(stg series --unapplied --noprefix))" = \
+        "p13 p14 p15 p16 p17 p18 p19" &&
+    stg push p19 p14 &&
+    stg pop p12 &&
+    test "$(echo $(stg series --unapplied --noprefix))" = \
+        "p12 p13 p15 p16 p17 p18" &&
+    test "$(stg series --hidden --noprefix | wc -l)" -eq 12
+'
+
+test_expect_success 'Rename, delete and commit patches' '
+    stg rename p9 nine &&
+    stg delete p4 p16 &&
+    test "$(echo $(stg series --noprefix -a))" = \
+        "p1 nine p2 p6 p7 p8 p10 p3 p5 p19 p14 p12 p13 p15 p17 p18 \
+p11 p20 p21 p22 p23 p24 p25 p26 p27 p28 p29 p30" &&
+    stg commit -n 2 &&
+    test "$(echo $(stg series --applied --noprefix))" = \
+        "p2 p6 p7 p8 p10 p3 p5 p19 p14"
+'
+
+test_done
@@ -0,0 +1,62 @@
+#!/bin/sh
+
+test_description='Test checking ref names without git
+
+Patch names are checked with a Python version of the rules of git
+check-ref-format, which should agree with git on any name.'
+
+. ./test-lib.sh
+
+cat > check-ref-format.py <<EOF
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import random
+import subprocess
+
+from stgit.lib.git.repository import check_ref_format
+
+names = [
+    'a', 'a/b', 'refs/heads/master', '@', 'a/@', '@/a', 'a/@{b', 'a/b@',
+    'a/{b}', 'a/.b', 'a/b.', 'a/b.lock', 'a/b.lock/c', 'a/.lock', 'a/lock',
+    'a/b..c', 'a/b.c', '/a/b', 'a/b/', 'a//b', 'a/b c', 'a/b\tc',
+    'a/b\x7fc', 'a/b\x01c', 'a/b~1', 'a/b^', 'a/b:c', 'a/b?', 'a/b*',
+    'a/b[c', 'a/b]c', 'a/b\\\\c', 'a/é', 'a/☃', 'a/-b', 'a/b-',
+    '.a/b', 'a./b', 'a/b/.', 'a/./b', 'a/../b', 'a/b{', 'a/}',
+]
+alphabet = ['a', 'b', '.', '/', '@', '{', '}', '.lock', ' ', '~', '^',
+            ':', '?', '*', '[', ']', '\\\\', '\t', '\x7f', '\x1f', 'é', '-']
+rng = random.Random(22)
+for _ in range(600):
+    s = ''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 8)))
+    names.extend([s, 'refs/patches/master/' + s, 'refs/' + s + '/x'])
+
+with open(os.devnull, 'w') as devnull:
+    for name in names:
+        if name.startswith('-'):
+            # git would take it for an option
+            continue
+        git = subprocess.call(
+            ['git', 'check-ref-format', name.encode('utf-8')],
+            stderr=devnull,
+        ) == 0
+        if check_ref_format(name) != git:
+            print('%r: git says %s' % (name, git))
+EOF
+
+test_expect_success 'Agree with git check-ref-format' '
+    "$PYTHON" check-ref-format.py > mismatches &&
+    test_must_be_empty mismatches
+'
+
+test_expect_success 'Check patch names without running git' '
+    stg init &&
+    STGIT_SUBPROCESS_LOG=debug:log stg new -m "a patch" good-name &&
+    test_must_fail grep "check-ref-format" log &&
+    command_error stg new -m "another" "bad..name" 2>err &&
+    grep "Invalid patch name" err &&
+    test "$(echo $(stg series --noprefix))" = good-name
+'
+
+test_done
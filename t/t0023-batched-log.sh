@@ -0,0 +1,74 @@
+#!/bin/sh
+
+test_description='Test writing stack log entries in one batch
+
+Without stgit.nativeobjects, all the objects of a stack log entry
+should be handed to git in a single git unpack-objects, however many
+patches it records. The same goes for the commits of the patches
+pushed onto a new base.'
+
+. ./test-lib.sh
+
+count_runs () {
+    grep -c "Running subprocess.*'$1'" "$2"
+}
+
+test_expect_success 'Create a stack' '
+    git config stgit.nativeobjects false &&
+    test_commit base &&
+    stg init &&
+    for i in $(test_seq 1 40)
+    do
+        stg new -m "patch $i" p$i || return 1
+    done &&
+    git fsck --no-dangling
+'
+
+test_expect_success 'Pop and push all patches' '
+    STGIT_SUBPROCESS_LOG=debug:pop.log stg pop -a &&
+    STGIT_SUBPROCESS_LOG=debug:push.log stg push -a &&
+    for log in pop.log push.log
+    do
+        test "$(count_runs unpack-objects $log)" -eq 1 &&
+        test "$(count_runs hash-object $log)" -eq 0 &&
+        test "$(count_runs mktree $log)" -eq 0 &&
+        test "$(count_runs commit-tree $log)" -eq 0 || return 1
+    done &&
+    git fsck --no-dangling
+'
+
+test_expect_success 'Rebase with the new commits in one batch' '
+    git checkout -b upstream "$(stg id {base})" &&
+    test_commit newbase &&
+    git checkout master &&
+    STGIT_SUBPROCESS_LOG=debug:rebase.log stg rebase upstream &&
+    test "$(stg series --applied -c)" -eq 40 &&
+    test "$(git rev-parse "$(stg id p1)^")" = \
+        "$(git rev-parse upstream)" &&
+    test "$(count_runs hash-object rebase.log)" -eq 0 &&
+    test "$(count_runs mktree rebase.log)" -eq 0 &&
+    test "$(count_runs commit-tree rebase.log)" -eq 0 &&
+    git fsck --no-dangling
+'
+
+test_expect_success 'Undo and redo with the batched log' '
+    stg delete p20..p40 &&
+    test "$(stg series --applied -c)" -eq 19 &&
+    stg undo &&
+    test "$(stg series --applied -c)" -eq 40 &&
+    stg redo &&
+    test "$(stg series --applied -c)" -eq 19 &&
+    stg log -n 1 | grep -q "redo" &&
+    git fsck --no-dangling
+'
+
+test_expect_success 'Batch in shared repositories with native objects' '
+    git config stgit.nativeobjects true &&
+    git config core.sharedrepository group &&
+    STGIT_SUBPROCESS_LOG=debug:shared.log stg pop -a &&
+    test "$(count_runs unpack-objects shared.log)" -eq 1 &&
+    stg push -a &&
+    git fsck --no-dangling
+'
+
+test_done
@@ -0,0 +1,87 @@
+#!/bin/sh
+
+test_description='Test compacting the stack log
+
+"stg log --compact" keeps only the most recent stack log entries, and
+undo and redo should keep working within them.'
+
+. ./test-lib.sh
+
+log_entries () {
+    git log --format="%ct %s" refs/heads/master.stgit^
+}
+
+test_expect_success 'Create a stack with a long log' '
+    stg init &&
+    for i in 1 2 3
+    do
+        stg new -m "patch $i" p$i &&
+        echo "$i" > file$i &&
+        stg add file$i &&
+        stg refresh || return 1
+    done &&
+    git rev-parse refs/patches/master/p1 > old-p1 &&
+    stg delete p1 &&
+    for i in 1 2 3
+    do
+        stg pop &&
+        stg push || return 1
+    done &&
+    test "$(log_entries | wc -l)" -gt 10
+'
+
+test_expect_success 'Compact the log to the last four entries' '
+    log_entries | head -n 4 > expected &&
+    stg log --compact -n 4 &&
+    log_entries > actual &&
+    test_cmp expected actual &&
+    test "$(stg log | wc -l)" -eq 4 &&
+    git fsck --no-dangling
+'
+
+test_expect_success 'Undo and redo within the entries kept' '
+    stg undo -n 3 &&
+    test "$(echo $(stg series --noprefix -a))" = "p2 p3" &&
+    test "$(echo $(stg series --applied --noprefix))" = "p2" &&
+    command_error stg undo 2>err &&
+    grep "Not enough undo information available" err &&
+    stg redo &&
+    test "$(echo $(stg series --applied --noprefix))" = "p2 p3"
+'
+
+test_expect_success 'Dropped entries can be garbage collected' '
+    git cat-file -e $(cat old-p1) &&
+    stg log --compact -n 2 &&
+    git reflog expire --expire=now --all &&
+    git gc -q --prune=now &&
+    test_must_fail git cat-file -e $(cat old-p1) &&
+    git fsck --no-dangling
+'
+
+test_expect_success 'Keep as many entries as configured' '
+    stg pop &&
+    stg push &&
+    git config stgit.logkeep 3 &&
+    stg log --compact &&
+    test "$(stg log | wc -l)" -eq 3 &&
+    stg log --compact > out 2>&1 &&
+    grep "Nothing to compact" out
+'
+
+test_expect_success 'Keep recent entries' '
+    stg pop &&
+    git config stgit.logkeep 1 &&
+    git config stgit.logkeepdays 100000 &&
+    stg log --compact > out 2>&1 &&
+    grep "Nothing to compact" out &&
+    git config stgit.logkeepdays 0 &&
+    stg log --compact &&
+    test "$(stg log | wc -l)" -eq 1
+'
+
+test_expect_success 'Refuse other options' '
+    command_error stg log --compact --full &&
+    command_error stg log --compact p2
+'
+
+test_done
@@ -0,0 +1,106 @@
+#!/bin/sh
+
+test_description='Test the index of stack log entries
+
+"stg undo" and "stg redo" use an index of the log entries to find
+their destination without reading the entries in between, and should
+end up exactly where walking the log would.'
+
+. ./test-lib.sh
+
+cat > check-undo.py <<EOF
+from stgit.lib import log
+from stgit.lib.stack import StackRepository
+
+repo = StackRepository.default()
+stack = repo.current_stack
+parsed = []
+from_commit = log.LogEntry.from_commit.__func__
+
+
+def counting_from_commit(cls, repo, commit):
+    parsed.append(commit)
+    return from_commit(cls, repo, commit)
+
+
+log.LogEntry.from_commit = classmethod(counting_from_commit)
+
+
+def destination(steps):
+    del parsed[:]
+    try:
+        return log.undo_state(stack, steps).commit.sha1, len(parsed)
+    except log.LogException as e:
+        return str(e), len(parsed)
+
+
+steps = list(range(-4, 0)) + list(range(1, 60))
+indexed = [destination(s) for s in steps]
+assert repo.log_index is not None
+repo._log_index = False
+walked = [destination(s) for s in steps]
+for s, (i, n), (w, _) in zip(steps, indexed, walked):
+    assert i == w, (s, i, w)
+    assert n <= 1, (s, n)
+print('ok')
+EOF
+
+test_expect_success 'Create a log with undos and redos' '
+    stg init &&
+    for i in 1 2 3 4 5 6
+    do
+        stg new -m "patch $i" p$i || return 1
+    done &&
+    for i in 1 2 3 4 5
+    do
+        stg pop -n 2 &&
+        stg push -n 2 || return 1
+    done &&
+    stg pop -n 3 &&
+    stg pop &&
+    stg undo -n 2 &&
+    stg pop -n 2 &&
+    stg undo &&
+    stg redo &&
+    stg pop -a &&
+    stg undo -n 3 &&
+    stg undo &&
+    stg redo -n 2 &&
+    stg push -n 2 &&
+    stg undo &&
+    stg undo &&
+    stg goto p5 &&
+    stg pop &&
+    stg undo -n 4 &&
+    stg undo -n 2 &&
+    test_path_is_file .git/stgit-cache/log-index.sqlite
+'
+
+test_expect_success 'Undo and redo to the same entries as walking the log' '
+    test "$("$PYTHON" check-undo.py)" = ok
+'
+
+test_expect_success 'Index an existing log' '
+    rm .git/stgit-cache/log-index.sqlite &&
+    test "$("$PYTHON" check-undo.py)" = ok
+'
+
+test_expect_success 'Index a compacted log' '
+    stg log --compact -n 10 &&
+    test "$("$PYTHON" check-undo.py)" = ok &&
+    command_error stg undo -n 10 2>err &&
+    grep "Not enough undo information available" err
+'
+
+test_expect_success 'Undo and redo without the index' '
+    git config stgit.logindex no &&
+    series=$(stg series) &&
+    stg pop &&
+    stg pop &&
+    stg undo -n 2 &&
+    test "$(stg series)" = "$series" &&
+    stg redo &&
+    test "$(stg series)" != "$series"
+'
+
+test_done
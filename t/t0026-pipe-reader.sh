@@ -0,0 +1,74 @@
+#!/bin/sh
+
+test_description='Test the buffered reader of git helper output
+
+The output of "git cat-file --batch" and "git diff-tree --stdin" is
+read through a PipeReader, which must hand back the exact bytes that
+were written to the pipe, however they were split into reads.'
+
+. ./test-lib.sh
+
+cat > check-pipereader.py <<EOF
+import os
+import threading
+
+from stgit.lib.git.repository import PipeReader, RepositoryException
+
+big = bytes(bytearray(i % 251 for i in range(300000)))
+chunks = [b'first line\n', b'12 ', b'bytes\nhello world!', b'tail\n',
+          big, b'\n', b'a', b'b', b'c\nok\n']
+r, w = os.pipe()
+
+
+def writer():
+    for c in chunks:
+        os.write(w, c)
+    os.close(w)
+
+
+t = threading.Thread(target=writer)
+t.daemon = True
+t.start()
+reader = PipeReader(r)
+reader.min_chunk = reader._chunk = 7
+assert reader.read_line() == b'first line'
+assert reader.read_line() == b'12 bytes'
+data = reader.read(12)
+assert type(data) is bytes and data == b'hello world!', repr(data)
+assert reader.read(0) == b''
+assert reader.read(5) == b'tail\n'
+data = reader.read(len(big))
+assert type(data) is bytes and data == big
+assert reader.read_line() == b''
+data = reader.read_until(b'ok\n')
+assert type(data) is bytes and data == b'abc\nok\n', repr(data)
+t.join()
+try:
+    reader.read(1)
+except RepositoryException:
+    pass
+else:
+    raise AssertionError('no RepositoryException')
+os.close(r)
+print('ok')
+EOF
+
+test_expect_success 'Read lines, sized blocks and replies from a pipe' '
+    test "$("$PYTHON" check-pipereader.py)" = ok
+'
+
+test_expect_success 'Read large objects through git cat-file' '
+    test_seq 1 20000 >big &&
+    git add big &&
+    git commit -m big &&
+    stg init &&
+    stg new -m "a patch" p1 &&
+    test_seq 2 20001 >big &&
+    stg refresh &&
+    stg pop &&
+    stg push &&
+    test_seq 2 20001 | test_cmp - big &&
+    test "$(stg show p1 | grep -c "^[-+][0-9]")" -eq 2
+'
+
+test_done
@@ -39,7 +39,7 @@ test_expect_success \
     test_path_is_missing .git/refs/patches &&
     test "$(git config --get branch.new.remote)" = "origin" &&
     test "$(git config --get branch.new.stgit.parentbranch)" = "regular-branch" &&
-    test "$(git config --get branch.new.stgit.stackformatversion)" = "3" &&
+    test "$(git config --get branch.new.stgit.stackformatversion)" = "4" &&
     test "$(git rev-parse HEAD)" = "$(git rev-parse new)"
 '
 
@@ -143,4 +143,26 @@ test_expect_success \
     command_error stg push p99999 2>&1 | grep -e "Unknown patch name: p99999"
 '
 
+test_expect_success \
+    'Copy the notes of all rewritten patches at once' '
+    stg pop -a &&
+    echo base > base &&
+    git add base &&
+    git commit -m base &&
+    STGIT_SUBPROCESS_LOG=debug:log stg push -a &&
+    test "$(grep -c "Running subprocess.*notes.*copy" log)" -eq 1 &&
+    for i in 0 1 2 3 4 5 6 7 8 9; do
+        [ "$(git notes show $(stg id p$i))" = "note$i" ] || return 1
+    done
+'
+
+test_expect_success \
+    'Do not copy notes when there are none' '
+    git update-ref -d refs/notes/commits &&
+    stg pop -a &&
+    git commit --allow-empty -m another &&
+    STGIT_SUBPROCESS_LOG=debug:log2 stg push -a &&
+    test_must_fail grep "Running subprocess.*notes" log2
+'
+
 test_done
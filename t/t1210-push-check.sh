@@ -0,0 +1,127 @@
+#!/bin/sh
+
+test_description='Test predicting conflicts with --check
+
+The --check option of push, goto and rebase reports the patches that
+would conflict without pushing anything.'
+
+. ./test-lib.sh
+
+list_objects () {
+    find .git/objects -type f | sort
+}
+
+test_expect_success 'Create a stack' '
+    test_seq 1 10 > a &&
+    test_seq 1 10 > b &&
+    git add a b &&
+    git commit -m "initial" &&
+    stg init &&
+    stg new -m "change a" p1 &&
+    sed "s/^2$/two/" a > a.new && mv a.new a &&
+    stg refresh &&
+    stg new -m "change a again" p2 &&
+    sed "s/^two$/TWO/" a > a.new && mv a.new a &&
+    stg refresh &&
+    stg new -m "change b" p3 &&
+    sed "s/^9$/nine/" b > b.new && mv b.new b &&
+    stg refresh &&
+    stg new -m "change a at the end" p4 &&
+    sed "s/^9$/nine/" a > a.new && mv a.new a &&
+    stg refresh &&
+    stg new -m "change b at the start" p5 &&
+    sed "s/^1$/one/" b > b.new && mv b.new b &&
+    stg refresh &&
+    stg pop -a &&
+    git tag base
+'
+
+test_expect_success 'No conflicts with an unchanged base' '
+    stg push --check -a > out 2>&1 &&
+    test_must_fail grep "would conflict" out &&
+    test "$(echo $(stg series --unapplied --noprefix))" = "p1 p2 p3 p4 p5"
+'
+
+test_expect_success 'Patches stacked on each other do not conflict' '
+    sed "s/^5$/five/" a > a.new && mv a.new a &&
+    git commit -a -m "change the middle of a" &&
+    stg push --check -a > out 2>&1 &&
+    test_must_fail grep "would conflict" out
+'
+
+test_expect_success 'Report a conflicting patch' '
+    sed "s/^2$/deux/" a > a.new && mv a.new a &&
+    git commit -a -m "change line 2 of a" &&
+    conflict stg push --check -a > out 2>&1 &&
+    cat > expected <<-\EOF &&
+	p1 would conflict
+	p2 would conflict
+	EOF
+    grep "would conflict" out > actual &&
+    test_cmp expected actual &&
+    test -z "$(stg series --applied)"
+'
+
+test_expect_success 'Check the patches after a conflict on their own' '
+    sed "s/^9$/neuf/" b > b.new && mv b.new b &&
+    git commit -a -m "change line 9 of b" &&
+    git tag upstream &&
+    conflict stg goto --check p5 > out 2>&1 &&
+    cat > expected <<-\EOF &&
+	p1 would conflict
+	p2 would conflict
+	p3 would conflict
+	EOF
+    grep "would conflict" out > actual &&
+    test_cmp expected actual &&
+    test -z "$(stg series --applied)"
+'
+
+test_expect_success 'Check a rebase' '
+    stg rebase base &&
+    stg push -a &&
+    stg rebase --check base > out 2>&1 &&
+    test_must_fail grep "would conflict" out &&
+    conflict stg rebase --check upstream > out 2>&1 &&
+    grep "p1 would conflict" out &&
+    test "$(stg top)" = p5 &&
+    test "$(stg id {base})" = "$(git rev-parse base)"
+'
+
+test_expect_success 'Checking writes no objects' '
+    for native in true false
+    do
+        git config stgit.nativeobjects $native &&
+        git checkout -q -b other-$native base &&
+        sed "s/^4$/four-$native/" b > b.new && mv b.new b &&
+        git commit -q -a -m "change line 4 of b" &&
+        git checkout -q master &&
+        list_objects > before &&
+        stg rebase --check other-$native > out 2>&1 &&
+        test_must_fail grep "would conflict" out &&
+        conflict stg rebase --check upstream > out 2>&1 &&
+        grep "p1 would conflict" out &&
+        list_objects > after &&
+        test_cmp before after &&
+        stg rebase --nopush upstream &&
+        list_objects > before &&
+        conflict stg push --check -a > out 2>&1 &&
+        grep "p3 would conflict" out &&
+        conflict stg goto --check p5 > out 2>&1 &&
+        grep "p3 would conflict" out &&
+        list_objects > after &&
+        test_cmp before after &&
+        test_must_fail ls -d .git/objects.temp-* &&
+        test -z "$(stg series --applied)" &&
+        stg rebase base &&
+        stg push -a || return 1
+    done &&
+    git config --unset stgit.nativeobjects
+'
+
+test_expect_success 'The prediction matches pushing' '
+    conflict stg rebase upstream &&
+    test "$(stg top)" = p1
+'
+
+test_done
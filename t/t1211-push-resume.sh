@@ -0,0 +1,108 @@
+#!/bin/sh
+
+test_description='Test resuming long pushes
+
+Pushes of at least stgit.journalinterval patches, and pushes that halt
+on a conflict, record the patches pushed so far in a journal, so that
+"stg push --resume" and "stg rebase --continue" can push the rest of
+them later.'
+
+. ./test-lib.sh
+
+test_expect_success 'Create a stack' '
+    test_seq 1 10 > a &&
+    for i in 1 2 3 4
+    do
+        echo "$i" > f$i || return 1
+    done &&
+    git add a f1 f2 f3 f4 &&
+    git commit -m "initial" &&
+    git tag base &&
+    stg init &&
+    for i in 1 2 3 4
+    do
+        stg new -m "patch $i" p$i &&
+        echo "patch $i" >> f$i &&
+        stg refresh || return 1
+    done &&
+    stg new -m "change a" p5 &&
+    sed "s/^5$/five/" a > a.new && mv a.new a &&
+    stg refresh &&
+    stg pop -a &&
+    git config stgit.journalinterval 1
+'
+
+test_expect_success 'Nothing to resume without a journal' '
+    command_error stg push --resume 2>err &&
+    grep "No interrupted push to resume" err
+'
+
+test_expect_success 'Keep the journal of an aborted push' '
+    sed "s/^5$/cinq/" a > a.new && mv a.new a &&
+    command_error stg push --keep -a &&
+    test -z "$(stg series --applied)" &&
+    git rev-parse --verify refs/journals/master
+'
+
+test_expect_success 'Resume the push' '
+    git checkout a &&
+    stg push --resume > out 2>&1 &&
+    test "$(grep -c "(resumed)" out)" = 5 &&
+    test "$(echo $(stg series --applied --noprefix))" = "p1 p2 p3 p4 p5" &&
+    test_must_fail git rev-parse --verify -q refs/journals/master
+'
+
+test_expect_success 'Continue a rebase after a conflict' '
+    stg pop -a &&
+    echo upstream >> f2 &&
+    git commit -a -m "change f2" &&
+    git tag upstream &&
+    stg rebase base &&
+    stg push -a &&
+    conflict stg rebase upstream &&
+    test "$(stg top)" = p2 &&
+    printf "2\nupstream\npatch 2\n" > f2 &&
+    git add f2 &&
+    stg refresh &&
+    stg rebase --continue &&
+    test "$(echo $(stg series --applied --noprefix))" = "p1 p2 p3 p4 p5" &&
+    test_must_fail git rev-parse --verify -q refs/journals/master
+'
+
+test_expect_success 'Continue a short rebase after a conflict' '
+    git config --unset stgit.journalinterval &&
+    git checkout -b short "$(stg id {base})" &&
+    sed "s/^upstream$/short/" f2 > f2.new && mv f2.new f2 &&
+    git commit -a -m "change f2 on short" &&
+    git checkout master &&
+    conflict stg rebase short &&
+    test "$(stg top)" = p2 &&
+    git rev-parse --verify refs/journals/master &&
+    printf "2\nshort\npatch 2\n" > f2 &&
+    git add f2 &&
+    stg refresh &&
+    stg rebase --continue &&
+    test "$(echo $(stg series --applied --noprefix))" = "p1 p2 p3 p4 p5" &&
+    test_must_fail git rev-parse --verify -q refs/journals/master
+'
+
+test_expect_success 'Journal of a branch named like a journal ref' '
+    stg branch --create master.journal &&
+    stg new -m "patch on master.journal" q1 &&
+    git rev-parse --verify refs/patches/master.journal/q1 &&
+    stg branch master &&
+    git checkout -b short2 "$(stg id {base})" &&
+    sed "s/^short$/short2/" f2 > f2.new && mv f2.new f2 &&
+    git commit -a -m "change f2 on short2" &&
+    git checkout master &&
+    conflict stg rebase short2 &&
+    git rev-parse --verify refs/journals/master &&
+    printf "2\nshort2\npatch 2\n" > f2 &&
+    git add f2 &&
+    stg refresh &&
+    stg rebase --continue &&
+    test "$(echo $(stg series --applied --noprefix))" = "p1 p2 p3 p4 p5" &&
+    test_must_fail git rev-parse --verify -q refs/journals/master
+'
+
+test_done
@@ -8,6 +8,7 @@ test_description='Undo external modifications of the stack'
 cat >> .git/info/exclude <<EOF
 /expected.txt
 /head?.txt
+/out.txt
 EOF
 
 test_expect_success 'Initialize StGit stack' '
@@ -62,4 +63,25 @@ test_expect_success 'Undo the commit' '
     test_cmp expected.txt a
 '
 
+test_expect_success 'Repair and undo with native objects' '
+    git config stgit.nativeobjects yes &&
+    git rev-parse HEAD > head0.txt &&
+    echo 333 >> a &&
+    stg add a &&
+    git commit -m p3 &&
+    git rev-parse HEAD > head1.txt &&
+    stg repair > out.txt 2>&1 &&
+    test_must_fail grep "stack log" out.txt &&
+    test "$(echo $(stg series))" = "+ p1 > p3" &&
+    stg undo &&
+    git rev-parse HEAD > head2.txt &&
+    test_cmp head1.txt head2.txt &&
+    test "$(echo $(stg series))" = "> p1" &&
+    stg undo &&
+    git rev-parse HEAD > head3.txt &&
+    test_cmp head0.txt head3.txt &&
+    test "$(echo $(stg series))" = "> p1" &&
+    test_cmp expected.txt a
+'
+
 test_done
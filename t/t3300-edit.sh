@@ -235,6 +235,14 @@ test_expect_success 'Fail to set invalid author date' '
     test "$(adate HEAD)" = "2013-01-28 22:30:00 -0300"
 '
 
+test_expect_success 'Fail to set invalid author date with native objects' '
+    test_config stgit.nativeobjects yes &&
+    command_error stg edit p2 --authdate "28 Jan 1813" &&
+    command_error stg edit p2 --authdate "2150-01-01 00:00:00 +0000" &&
+    test "$(adate HEAD)" = "2013-01-28 22:30:00 -0300" &&
+    git fsck --no-dangling
+'
+
 test_expect_success 'Set author date to "now"' '
     before=$(date "+%F %T %z") &&
     stg edit p2 --authdate now &&
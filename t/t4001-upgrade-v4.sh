@@ -0,0 +1,53 @@
+#!/bin/sh
+
+test_description='Test the upgrade to stack format version 4
+
+Format version 4 has no per-patch files under .git/patches/<branch>/patches
+and no per-patch log refs; upgrading a version 3 stack removes them, but
+not the refs of patches whose names happen to end in .log.'
+
+. ./test-lib.sh
+
+test_expect_success 'Create a version 3 stack' '
+    stg init &&
+    for i in 1 2 3 a.log
+    do
+        stg new -m "patch $i" p$i &&
+        echo "$i" > file$i &&
+        stg add file$i &&
+        stg refresh || return 1
+    done &&
+    stg pop -n 2 &&
+    git config branch.master.stgit.stackformatversion 3 &&
+    for i in 1 2 3 a.log
+    do
+        mkdir -p .git/patches/master/patches/p$i &&
+        stg id p$i > .git/patches/master/patches/p$i/top &&
+        git update-ref refs/patches/master/p$i.log $(stg id p$i) || return 1
+    done
+'
+
+test_expect_success 'Upgrade to version 4' '
+    stg series > series &&
+    test_line_count = 4 series &&
+    test "$(git config branch.master.stgit.stackformatversion)" = 4 &&
+    test_path_is_missing .git/patches/master/patches &&
+    test "$(git for-each-ref refs/patches/master | wc -l)" -eq 4 &&
+    git rev-parse --verify refs/patches/master/pa.log &&
+    stg show pa.log | grep "^+a.log\$"
+'
+
+test_expect_success 'No compat files or log refs for new patches' '
+    stg push -a &&
+    stg new -m "patch 4" p4 &&
+    echo 4 > file4 &&
+    stg add file4 &&
+    stg refresh &&
+    stg rename p4 p5 &&
+    test_path_is_missing .git/patches/master/patches &&
+    test "$(git for-each-ref --format="%(refname)" \
+        "refs/patches/master/*.log")" = refs/patches/master/pa.log &&
+    test "$(echo $(stg series --noprefix))" = "p1 p2 p3 pa.log p5"
+'
+
+test_done
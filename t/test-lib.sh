@@ -378,6 +378,15 @@ export GIT_AUTHOR_EMAIL GIT_AUTHOR_NAME
 export GIT_COMMITTER_EMAIL GIT_COMMITTER_NAME
 export EDITOR
 
+# Select the merge backend; see STG_TEST_MERGE_TREE in t/README.
+if test -n "$STG_TEST_MERGE_TREE"
+then
+	GIT_CONFIG_COUNT=1
+	GIT_CONFIG_KEY_0=stgit.mergetree
+	GIT_CONFIG_VALUE_0=$STG_TEST_MERGE_TREE
+	export GIT_CONFIG_COUNT GIT_CONFIG_KEY_0 GIT_CONFIG_VALUE_0
+fi
+
 # Tests using GIT_TRACE typically don't want <timestamp> <file>:<line> output
 GIT_TRACE_BARE=1
 export GIT_TRACE_BARE